@@ -9,15 +9,239 @@ Jani Analytics - Product Analytics for Jani Backups
 - Рефералы
 """
 import gzip
+import io
+import json
+import multiprocessing
+import os
 import re
+import shutil
 import sqlite3
-from datetime import datetime, timedelta
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, TextIO
+
+from metrics import METRICS, TimedCursor
+from retention import MAU_DAYS, WAU_DAYS, build_activity, day_to_date, retention
 
 # SQL INSERT парсер
-INSERT_PATTERN = re.compile(r"INSERT INTO (\w+) .*?VALUES\s*(.+?);$", re.IGNORECASE | re.MULTILINE | re.DOTALL)
-VALUES_PATTERN = re.compile(r"\(([^)]+)\)")
+INSERT_PATTERN = re.compile(
+    r"INSERT INTO (?:\w+\.)?\"?(\w+)\"?\s*(?:\(([^)]*)\)\s*)?VALUES\s*(.+?);\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+# Токенизатор VALUES: один литерал (+ необязательный ::cast) и следующий за ним ',' или ')'
+VALUES_ROW_START_PATTERN = re.compile(r"\s*,?\s*\(")
+VALUES_TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<estr>[Ee]'[^'\\]*(?:(?:\\.|'')[^'\\]*)*')   # E'...' с backslash-escape
+      | (?P<str>'[^']*(?:''[^']*)*')                    # '...' с ''
+      | (?P<bare>[^,()'\s:]+(?:\([^()]*\))?)            # NULL, true, 42, -1.5, now()
+    )
+    (?:::[A-Za-z_][\w ]*(?:\([\d, ]*\))?(?:\[\])*)?     # ::timestamp with time zone, ::text[]
+    \s*(?P<sep>[,)])
+""", re.VERBOSE | re.DOTALL)
+# Лексер iter_sql_statements: начало литерала ('...', E'...', $tag$...$tag$) или комментария вне литерала
+STATEMENT_LEXER_PATTERN = re.compile(r"(?<![\w$])[Ee]'|'|\$(?:[A-Za-z_]\w*)?\$|--")
+# Конец литерала с той же грамматикой, что в VALUES_TOKEN_PATTERN ('' и \' в E'...')
+STRING_END_PATTERNS = {
+    "'": re.compile(r"[^']*(?:''[^']*)*'(?!')"),
+    "E'": re.compile(r"[^'\\]*(?:(?:\\.|'')[^'\\]*)*'(?!')", re.DOTALL),
+}
+ESTRING_ESCAPE_PATTERN = re.compile(
+    r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|u([0-9a-fA-F]{4})|U([0-9a-fA-F]{8})|(.))|''",
+    re.DOTALL
+)
+
+# COPY ... FROM stdin (формат pg_dump по умолчанию)
+COPY_PATTERN = re.compile(r"COPY (?:\w+\.)?\"?(\w+)\"?\s*(?:\(([^)]*)\)\s*)?FROM stdin;\s*$", re.IGNORECASE)
+COPY_ESCAPE_PATTERN = re.compile(r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))")
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+# CREATE TABLE из дампа (pg_dump пишет схему перед данными); тело в скобках разбирает parse_create_table
+CREATE_TABLE_PATTERN = re.compile(
+    r'CREATE (?:UNLOGGED )?TABLE (?:IF NOT EXISTS )?(?:"?\w+"?\.)?"?(\w+)"?\s*\(', re.IGNORECASE
+)
+CREATE_COLUMN_PATTERN = re.compile(r'\s*("(?:[^"]|"")+"|\w+)\s+(.*)', re.DOTALL)
+# Конец типа колонки: дальше идут ограничения и DEFAULT
+COLUMN_TYPE_END_PATTERN = re.compile(
+    r'\s+(?:NOT\s+NULL|NULL|DEFAULT|COLLATE|CONSTRAINT|GENERATED|REFERENCES|PRIMARY|UNIQUE|CHECK)\b', re.IGNORECASE
+)
+# Определения в CREATE TABLE, которые не колонки
+TABLE_CONSTRAINTS = ('constraint', 'primary', 'unique', 'check', 'foreign', 'exclude', 'like')
+# Имя таблицы INSERT без разбора значений (для пропуска таблиц из SKIP_TABLES)
+INSERT_TABLE_PATTERN = re.compile(r'INSERT INTO (?:\w+\.)?"?(\w+)"?', re.IGNORECASE)
+
+# Тип PostgreSQL -> affinity SQLite: первое совпадение, иначе TEXT (даты, uuid, json, enum, массивы)
+TYPE_AFFINITY = (
+    (re.compile(r'\[\]$'), 'TEXT'),
+    (re.compile(r'^(?:(?:small|big)?int(?:eger|[248])?|(?:small|big)?serial[248]?|bool(?:ean)?)\b'), 'INTEGER'),
+    (re.compile(r'^(?:numeric|decimal|real|double precision|float[48]?)\b'), 'REAL'),
+    (re.compile(r'^bytea\b'), 'BLOB'),
+)
+# Колонка, известная только по заголовку COPY/INSERT (дамп без CREATE TABLE): тип неизвестен
+UNTYPED_AFFINITY = 'NUMERIC'
+
+# Таблицы дампа, которые не загружаются (через запятую), например большие текстовые,
+# ненужные аналитике: их строки пропускаются без разбора
+SKIP_TABLES = frozenset(t.strip().lower() for t in os.getenv('INGEST_SKIP_TABLES', '').split(',') if t.strip())
+
+# Сколько строк одной таблицы копим перед вставкой в SQLite
+BATCH_SIZE = 5000
+
+# Как часто (в строках дампа) сообщать о прогрессе загрузки
+PROGRESS_ROWS = 20000
+
+# Размер (в символах) куска дампа, отдаваемого одному процессу при параллельном разборе
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Запуск процессов разбора: fork из многопоточного процесса uvicorn может унести
+# в дочерний процесс захваченные другими потоками блокировки и зависнуть
+PARSE_MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+if PARSE_MP_CONTEXT.get_start_method() == 'forkserver':
+    # Процессы разбора получают готовый analytics от forkserver, а не импортируют его каждый сам
+    PARSE_MP_CONTEXT.set_forkserver_preload(['analytics'])
+
+# Таблицы, которые при инкрементальной загрузке обновляются по ключу, а не перезаливаются.
+# version - колонки, по которым видно, что строка изменилась; None - строки не меняются
+# после вставки (тогда key - один целочисленный id, и учет идет битовыми картами).
+# check - колонки, по которым такие строки базы сверяются с дампом (см. BASE_CHECK_ROWS)
+INCREMENTAL_TABLES = {
+    'dialogs': {'key': ('id',), 'version': None, 'check': ('user_id', 'created_at')},
+    'payments': {'key': ('id',), 'version': ('status', 'created_at')},
+    'user_character_state': {'key': ('user_id', 'character_id'), 'version': ('updated_at',)},
+    'dialog_summaries': {'key': ('user_id', 'character_id'), 'version': ('updated_at', 'summarized_message_count')},
+}
+
+# Сколько строк без версии, уже лежащих в базе, сверяется с дампом по колонкам check.
+# Расхождение - база не предыдущая версия этих данных, и загрузка идет целиком
+BASE_CHECK_ROWS = 1000
+
+# PRAGMA на время загрузки: БД пересоздается с нуля, durability не нужна
+LOAD_PRAGMAS = (
+    "PRAGMA journal_mode = MEMORY",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",  # 256 MB
+    "PRAGMA temp_store = MEMORY",
+)
+# После загрузки возвращаем обычный режим для чтения
+READ_PRAGMAS = (
+    "PRAGMA journal_mode = DELETE",
+    "PRAGMA synchronous = FULL",
+)
+
+# Версия схемы SQLite-БД бэкапа: менять при изменении _create_sqlite_schema
+SCHEMA_VERSION = 7
+
+# Версия кода аналитики: менять при изменении запросов Analytics (инвалидирует снимки)
+ANALYTICS_VERSION = 11
+
+# Время снятия дампа из заголовка pg_dump (пишется с --verbose): "-- Started on 2026-01-20 03:00:01 UTC"
+DUMP_STARTED_PATTERN = re.compile(r'^-- Started on (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+# Сколько строк заголовка дампа просматривать в поисках времени снятия
+DUMP_HEADER_LINES = 50
+# Колонки, по максимуму которых оценивается время дампа без заголовка
+DUMP_TIME_COLUMNS = (
+    ('dialogs', 'created_at'),
+    ('users', 'created_at'),
+    ('users', 'last_active_at'),
+    ('payments', 'created_at'),
+)
+
+# Вычисляемые (VIRTUAL) колонки поверх TEXT-времени из дампа: {таблица: [(колонка, выражение)]}.
+# *_epoch - секунды UTC, *_day - номер дня от 1970-01-01; по ним строятся индексы,
+# тогда как фильтр по DATE(created_at)/strftime(...) индекс использовать не может.
+# {epoch:col} подставляется выражением _epoch_sql(col).
+DERIVED_COLUMNS = {
+    'users': [
+        ('created_epoch', '{epoch:created_at}'),
+        ('created_day', 'created_epoch / 86400'),
+        ('last_active_epoch', '{epoch:last_active_at}'),
+        ('last_active_day', 'last_active_epoch / 86400'),
+    ],
+    'dialogs': [
+        ('created_epoch', '{epoch:created_at}'),
+        ('created_day', 'created_epoch / 86400'),
+        ('created_hour', 'created_epoch % 86400 / 3600'),
+        ('created_dow', '(created_epoch / 86400 + 4) % 7'),  # 1970-01-01 - четверг; 0 - воскресенье, как %w
+    ],
+    'payments': [
+        ('created_epoch', '{epoch:created_at}'),
+        ('created_day', 'created_epoch / 86400'),
+    ],
+}
+
+# Агрегаты, которые строятся при загрузке по dialogs и payments и из которых
+# читает Analytics: {таблица: SELECT}. Дни и часы берутся из DERIVED_COLUMNS.
+# dialog_grain - временная таблица одного прохода по dialogs (см. build_rollups).
+ROLLUPS = {
+    'user_message_counts': """
+        SELECT user_id, SUM(messages) AS messages,
+               SUM(CASE WHEN is_user THEN messages ELSE 0 END) AS user_messages
+        FROM dialog_grain GROUP BY user_id
+    """,
+    'daily_messages': """
+        SELECT DATE(day_num * 86400, 'unixepoch') AS day, SUM(messages) AS messages,
+               SUM(CASE WHEN is_user THEN messages ELSE 0 END) AS user_messages,
+               SUM(tokens) AS tokens, SUM(tokens_count) AS tokens_count,
+               COUNT(DISTINCT user_id) AS active_users
+        FROM dialog_grain GROUP BY day_num
+    """,
+    'hourly_dow_matrix': """
+        SELECT (day_num + 4) % 7 AS dow, hour, SUM(messages) AS messages
+        FROM dialog_grain GROUP BY dow, hour
+    """,
+    'character_daily_stats': """
+        SELECT character_id, DATE(day_num * 86400, 'unixepoch') AS day, SUM(messages) AS messages,
+               SUM(CASE WHEN is_user THEN messages ELSE 0 END) AS user_messages,
+               COUNT(DISTINCT user_id) AS active_users
+        FROM dialog_grain GROUP BY character_id, day_num
+    """,
+    'model_usage': """
+        SELECT model, SUM(messages) AS messages
+        FROM dialog_grain WHERE model IS NOT NULL GROUP BY model
+    """,
+    'daily_revenue': """
+        SELECT DATE(created_day * 86400, 'unixepoch') AS day, status, tier,
+               COUNT(*) AS payments, COALESCE(SUM(amount_stars), 0) AS revenue
+        FROM payments GROUP BY created_day, status, tier
+    """,
+    'user_revenue': """
+        SELECT user_id, COUNT(*) AS payments, COALESCE(SUM(amount_stars), 0) AS revenue
+        FROM payments WHERE status = 'success' AND user_id IS NOT NULL GROUP BY user_id
+    """,
+    'daily_signups': """
+        SELECT created_day AS day_num, DATE(created_day * 86400, 'unixepoch') AS day, COUNT(*) AS users
+        FROM users WHERE created_day IS NOT NULL GROUP BY created_day
+    """,
+    # Сегменты пользователя: сегментированные метрики - GROUP BY по флагам, без подзапросов
+    'user_segments': """
+        SELECT u.id AS user_id,
+               u.id IN (SELECT user_id FROM subscriptions WHERE status = 'active') AS is_premium,
+               r.user_id IS NOT NULL AS is_paying,
+               u.referred_by IS NOT NULL AS is_referred,
+               u.id IN (SELECT created_by FROM characters WHERE created_by IS NOT NULL) AS is_ugc_creator,
+               u.is_adult_confirmed IS 1 AS is_adult,
+               COALESCE(u.language, 'unknown') AS language,
+               COALESCE(m.user_messages, 0) AS user_messages,
+               COALESCE(r.revenue, 0) AS revenue
+        FROM users u
+        LEFT JOIN user_message_counts m ON m.user_id = u.id
+        LEFT JOIN user_revenue r ON r.user_id = u.id
+    """,
+}
+
+# Карты активности и ряд DAU/WAU/MAU (см. retention.build_activity)
+ACTIVITY_TABLES = ('user_activity', 'activity_daily')
+
+# Служебные таблицы БД бэкапа (не данные дампа)
+SERVICE_TABLES = ('ingest_stats', 'backup_meta', *ROLLUPS, *ACTIVITY_TABLES)
+
+# Окно дневных графиков Analytics по умолчанию (дней до as_of)
+WINDOW_DAYS = 30
 
 UPLOADS_DIR = Path(__file__).parent / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
@@ -33,78 +257,533 @@ def parse_value(val: str) -> any:
     if val.startswith("'") and val.endswith("'"):
         return val[1:-1].replace("''", "'")
     try:
-        if '.' in val:
+        if '.' in val or 'e' in val or 'E' in val:
             return float(val)
         return int(val)
     except ValueError:
         return val
 
 
+def _unescape_estring(match: re.Match) -> str:
+    if match.group(0) == "''":
+        return "'"
+    octal, hex_, short_u, long_u, char = match.groups()
+    if octal:
+        return chr(int(octal, 8))
+    code = hex_ or short_u or long_u
+    if code:
+        return chr(int(code, 16))
+    return COPY_ESCAPES.get(char, char)
+
+
+def _split_values(values_str: str) -> Iterator[list]:
+    """Разбивает VALUES (...), (...) на списки значений.
+
+    Один проход регуляркой по литералам: строки с запятыми, скобками,
+    '' и E'...' внутри, касты ::type и многострочные VALUES.
+    На некорректном фрагменте разбор стейтмента прекращается.
+    """
+    pos = 0
+    while True:
+        match = VALUES_ROW_START_PATTERN.match(values_str, pos)
+        if not match:
+            return
+        pos = match.end()
+        values = []
+        while True:
+            match = VALUES_TOKEN_PATTERN.match(values_str, pos)
+            if not match:
+                return
+            pos = match.end()
+            token = match.group('str')
+            if token is not None:
+                values.append(token[1:-1].replace("''", "'") if "''" in token else token[1:-1])
+            elif match.group('bare') is not None:
+                values.append(parse_value(match.group('bare')))
+            else:
+                values.append(ESTRING_ESCAPE_PATTERN.sub(_unescape_estring, match.group('estr')[2:-1]))
+            if match.group('sep') == ')':
+                break
+        yield values
+
+
+def _unescape_copy(match: re.Match) -> str:
+    octal, hex_, char = match.groups()
+    if octal:
+        return chr(int(octal, 8))
+    if hex_:
+        return chr(int(hex_, 16))
+    return COPY_ESCAPES.get(char, char)
+
+
+def decode_copy_row(line: str) -> list:
+    """Декодирует строку данных COPY (text format): TAB-разделители, \\N и \\-escape"""
+    values = line.rstrip('\n').split('\t')
+    for i, val in enumerate(values):
+        if '\\' in val:
+            values[i] = None if val == '\\N' else COPY_ESCAPE_PATTERN.sub(_unescape_copy, val)
+    return values
+
+
+def _parse_column_list(columns: Optional[str]) -> Optional[tuple]:
+    """'(id, "name", ...)' из заголовка COPY/INSERT -> кортеж имен колонок"""
+    if not columns:
+        return None
+    return tuple(c.strip().strip('"').lower() for c in columns.split(','))
+
+
+def sqlite_affinity(pg_type: Optional[str]) -> str:
+    """Тип колонки PostgreSQL -> тип SQLite с той же affinity; None - тип неизвестен"""
+    if pg_type is None:
+        return UNTYPED_AFFINITY
+    for pattern, affinity in TYPE_AFFINITY:
+        if pattern.search(pg_type):
+            return affinity
+    return 'TEXT'
+
+
+def parse_create_table(statement: str) -> Optional[tuple[str, list]]:
+    """CREATE TABLE из дампа -> (таблица, [(колонка, тип PostgreSQL)]); None - не CREATE TABLE"""
+    match = CREATE_TABLE_PATTERN.match(statement)
+    if not match:
+        return None
+    
+    # Определения разделены запятыми верхнего уровня: numeric(10,2) и DEFAULT 'a,b' не режем
+    definitions, depth, in_quotes, start = [], 1, False, match.end()
+    for i in range(match.end(), len(statement)):
+        ch = statement[i]
+        if ch == "'":
+            in_quotes = not in_quotes
+        elif in_quotes:
+            continue
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if not depth:
+                definitions.append(statement[start:i])
+                break
+        elif ch == ',' and depth == 1:
+            definitions.append(statement[start:i])
+            start = i + 1
+    
+    columns = []
+    for definition in definitions:
+        column = CREATE_COLUMN_PATTERN.match(definition)
+        if not column or column.group(1).lower() in TABLE_CONSTRAINTS:
+            continue
+        pg_type = COLUMN_TYPE_END_PATTERN.split(column.group(2), 1)[0]
+        columns.append((column.group(1).strip('"').lower(), ' '.join(pg_type.lower().split())))
+    return match.group(1).lower(), columns
+
+
+def _literal_after(line: str, quote: Optional[str]) -> Optional[str]:
+    """Открытый литерал в конце строки дампа: None, "'", "E'" или $tag$; quote - открытый в ее начале"""
+    pos = 0
+    while True:
+        if quote is None:
+            match = STATEMENT_LEXER_PATTERN.search(line, pos)
+            if not match or match.group() == '--':
+                return None
+            quote, pos = match.group().upper(), match.end()
+        if quote[0] == '$':
+            end = line.find(quote, pos)
+            if end < 0:
+                return quote
+            pos = end + len(quote)
+        else:
+            match = STRING_END_PATTERNS[quote].match(line, pos)
+            if not match:
+                return quote
+            pos = match.end()
+        quote = None
+
+
+def iter_sql_statements(lines: Iterable[str]) -> Iterator[str]:
+    """Склеивает строки дампа в SQL-стейтменты, не читая дамп целиком.
+
+    Литералы разбираются с той же грамматикой, что и VALUES: ';' и
+    переводы строк внутри '...', E'...' и $$...$$ не режут стейтмент.
+    Строки данных после COPY ... FROM stdin должен вычитать вызывающий
+    код из того же итератора (см. iter_dump_rows). Незавершенный к концу
+    дампа стейтмент (обрезанный дамп) - ValueError, а не тихая потеря строк.
+    """
+    buf = []
+    quote = None
+    for line in lines:
+        # Пустые строки, комментарии и метакоманды psql (\connect, \restrict) между стейтментами
+        if not buf and (not line.strip() or line.startswith('--') or line.startswith('\\')):
+            continue
+        buf.append(line)
+        if quote in (None, "'") and not any(s in line for s in ("E'", "e'", '$', '--')):
+            # Только обычные литералы: '' не меняет четность, хватает счета кавычек
+            if line.count("'") & 1:
+                quote = None if quote else "'"
+        else:
+            quote = _literal_after(line, quote)
+        if quote is None and line.rstrip().endswith(';'):
+            statement = ''.join(buf)
+            buf = []
+            yield statement
+    if buf:
+        raise ValueError(f"Unterminated SQL statement at end of dump: {buf[0][:80]!r}")
+
+
+def _skip_copy_data(lines: Iterator[str]):
+    """Вычитывает строки данных COPY до \\. без разбора"""
+    for line in lines:
+        if line.startswith('\\.'):
+            break
+
+
+def _skipped_insert(statement: str, skip_tables: frozenset) -> bool:
+    """INSERT в таблицу из skip_tables (проверка без разбора значений)"""
+    if not skip_tables:
+        return False
+    match = INSERT_TABLE_PATTERN.match(statement)
+    return bool(match) and match.group(1).lower() in skip_tables
+
+
+def iter_dump_rows(lines: Iterable[str], on_create: Optional[Callable[[str, list], None]] = None,
+                   skip_tables: frozenset = frozenset()) -> Iterator[tuple[str, Optional[tuple], list]]:
+    """Потоково отдает строки таблиц из дампа как (table_name, columns, values).
+
+    columns берутся из заголовка COPY/INSERT; None - если дамп их не указал.
+    on_create, если задан, получает (таблица, колонки) каждого CREATE TABLE
+    (см. parse_create_table). Таблицы из skip_tables пропускаются без разбора.
+    """
+    lines = iter(lines)
+    for statement in iter_sql_statements(lines):
+        match = COPY_PATTERN.match(statement)
+        if match:
+            table_name = match.group(1).lower()
+            if table_name in skip_tables:
+                _skip_copy_data(lines)
+                continue
+            columns = _parse_column_list(match.group(2))
+            for line in lines:
+                if line.startswith('\\.'):
+                    break
+                yield table_name, columns, decode_copy_row(line)
+            continue
+        
+        if on_create and statement[:6].upper() == 'CREATE':
+            table = parse_create_table(statement)
+            if table and table[0] not in skip_tables:
+                on_create(*table)
+            continue
+        
+        if _skipped_insert(statement, skip_tables):
+            continue
+        match = INSERT_PATTERN.match(statement)
+        if not match:
+            continue
+        table_name = match.group(1).lower()
+        columns = _parse_column_list(match.group(2))
+        for values in _split_values(match.group(3)):
+            yield table_name, columns, values
+
+
+def iter_dump_segments(lines: Iterable[str], segment_size: int = SEGMENT_SIZE,
+                       on_create: Optional[Callable[[str, list], None]] = None,
+                       skip_tables: frozenset = frozenset()) -> Iterator[str]:
+    """Режет дамп на самостоятельные куски для параллельного разбора.
+
+    Границы ищутся дешево (без разбора значений): кусок - это несколько
+    INSERT-стейтментов или часть блока COPY с повторенным заголовком.
+    CREATE TABLE уходят в on_create (в этом процессе, до кусков с данными
+    таблицы), остальные стейтменты (SET, ALTER, ...) отбрасываются,
+    как и данные таблиц из skip_tables.
+    """
+    lines = iter(lines)
+    buf, size = [], 0
+    for statement in iter_sql_statements(lines):
+        match = COPY_PATTERN.match(statement)
+        if match and match.group(1).lower() in skip_tables:
+            _skip_copy_data(lines)
+            continue
+        if match:
+            copy_buf, copy_size = [statement], 0
+            for line in lines:
+                if line.startswith('\\.'):
+                    break
+                copy_buf.append(line)
+                copy_size += len(line)
+                if copy_size >= segment_size:
+                    copy_buf.append('\\.\n')
+                    yield ''.join(copy_buf)
+                    copy_buf, copy_size = [statement], 0
+            if copy_size:
+                copy_buf.append('\\.\n')
+                yield ''.join(copy_buf)
+            continue
+        
+        if on_create and statement[:6].upper() == 'CREATE':
+            table = parse_create_table(statement)
+            if table and table[0] not in skip_tables:
+                on_create(*table)
+            continue
+        
+        if statement[:6].upper() != 'INSERT' or _skipped_insert(statement, skip_tables):
+            continue
+        buf.append(statement)
+        size += len(statement)
+        if size >= segment_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def parse_dump_segment(segment: str) -> list:
+    """Разбирает кусок дампа (см. iter_dump_segments) в [(table, columns, rows)]"""
+    groups = {}
+    for table_name, columns, values in iter_dump_rows(segment.splitlines(keepends=True)):
+        key = (table_name, columns)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(values)
+    return [(table_name, columns, rows) for (table_name, columns), rows in groups.items()]
+
+
 def parse_sql_dump(sql_content: str) -> dict:
     """Парсит SQL дамп и возвращает данные таблиц"""
     tables = {}
-    
-    # Ищем все INSERT INTO
-    for match in INSERT_PATTERN.finditer(sql_content):
-        table_name = match.group(1).lower()
-        values_str = match.group(2)
-        
-        if table_name not in tables:
-            tables[table_name] = []
-        
-        # Парсим каждый набор значений
-        for value_match in VALUES_PATTERN.finditer(values_str):
-            row_str = value_match.group(1)
-            # Разбиваем по запятым, учитывая строки в кавычках
-            values = []
-            current = ""
-            in_quotes = False
-            for char in row_str:
-                if char == "'" and (not current or current[-1] != '\\'):
-                    in_quotes = not in_quotes
-                    current += char
-                elif char == ',' and not in_quotes:
-                    values.append(parse_value(current))
-                    current = ""
-                else:
-                    current += char
-            if current:
-                values.append(parse_value(current))
-            tables[table_name].append(values)
-    
+    for table_name, _, values in iter_dump_rows(sql_content.splitlines(keepends=True)):
+        tables.setdefault(table_name, []).append(values)
     return tables
 
 
-def load_backup_to_sqlite(backup_path: Path, db_path: Path) -> sqlite3.Connection:
-    """Загружает бэкап в SQLite для быстрых запросов"""
-    # Распаковываем если gzip
-    if str(backup_path).endswith('.gz'):
-        with gzip.open(backup_path, 'rt', encoding='utf-8', errors='replace') as f:
-            sql_content = f.read()
-    else:
-        with open(backup_path, 'r', encoding='utf-8', errors='replace') as f:
-            sql_content = f.read()
+class _TimedReader(io.RawIOBase):
+    """Бинарный поток, копящий время чтения из source в phases[phase].
+
+    exclude - фаза вложенного _TimedReader: ее время за этот вызов не считается
+    (распаковка gzip не включает чтение сжатого файла с диска).
+    owns - поток, который нужно закрыть вместе с этим.
+    """
+
+    def __init__(self, source: BinaryIO, phases: dict, phase: str, exclude: Optional[str] = None,
+                 owns: Optional[BinaryIO] = None):
+        self.source = source
+        self.phases = phases
+        self.phase = phase
+        self.exclude = exclude
+        self.owns = owns
+        phases.setdefault(phase, 0.0)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        nested = self.phases[self.exclude] if self.exclude else 0
+        started = time.perf_counter()
+        size = self.source.readinto(buffer)
+        elapsed = time.perf_counter() - started
+        if self.exclude:
+            elapsed -= self.phases[self.exclude] - nested
+        self.phases[self.phase] += elapsed
+        return size
+
+    def tell(self) -> int:
+        return self.source.tell()
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+            if self.owns:
+                self.owns.close()
+        super().close()
+
+
+def _open_dump(backup_path: Path, phases: Optional[dict] = None) -> TextIO:
+    """Открывает дамп (в т.ч. .gz) как текстовый поток.
+
+    С phases время чтения файла и распаковки копится в phases['read']
+    и phases['decompress'].
+    """
+    compressed = str(backup_path).endswith('.gz')
+    if phases is None:
+        if compressed:
+            f = gzip.open(backup_path, 'rt', encoding='utf-8', errors='replace')
+            f.dump_file = f.buffer.fileobj
+        else:
+            f = open(backup_path, 'r', encoding='utf-8', errors='replace')
+            f.dump_file = f.buffer
+        return f
+
+    file = io.BufferedReader(_TimedReader(open(backup_path, 'rb', buffering=0), phases, 'read'))
+    stream = file
+    if compressed:
+        # GzipFile не закрывает переданный ему fileobj - его закрывает _TimedReader
+        stream = io.BufferedReader(
+            _TimedReader(gzip.GzipFile(fileobj=file), phases, 'decompress', exclude='read', owns=file)
+        )
+    f = io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+    f.dump_file = file
+    return f
+
+
+def _dump_position(f: TextIO) -> int:
+    """Сколько байт файла дампа уже прочитано (для .gz - сжатых байт)"""
+    return f.dump_file.tell()
+
+
+def _load_rows_parallel(lines: Iterable[str], loader: 'BulkLoader', workers: int,
+                        on_segment: Optional[Callable[[], None]] = None, skip_tables: frozenset = frozenset()):
+    """Разбирает куски дампа в пуле процессов и пишет результат в один поток SQLite.
+
+    В работе держим не больше 2 * workers кусков, так что память ограничена.
+    Результаты пишутся в порядке следования кусков в дампе.
+    """
+    with ProcessPoolExecutor(max_workers=workers, mp_context=PARSE_MP_CONTEXT) as pool:
+        pending = deque()
+        segments = iter_dump_segments(lines, on_create=loader.define_table, skip_tables=skip_tables)
+        for segment in segments:
+            pending.append(pool.submit(parse_dump_segment, segment))
+            if len(pending) >= workers * 2:
+                for table_name, columns, rows in pending.popleft().result():
+                    loader.add_rows(table_name, columns, rows)
+                if on_segment:
+                    on_segment()
+        while pending:
+            for table_name, columns, rows in pending.popleft().result():
+                loader.add_rows(table_name, columns, rows)
+            if on_segment:
+                on_segment()
+
+
+def load_backup_to_sqlite(backup_path: Path, db_path: Path, workers: int = 1,
+                          progress: Optional[Callable[[dict], None]] = None,
+                          base_db: Optional[Path] = None,
+                          skip_tables: frozenset = SKIP_TABLES) -> sqlite3.Connection:
+    """Загружает бэкап в SQLite для быстрых запросов.
+
+    Дамп читается потоково, строки вставляются пачками по BATCH_SIZE,
+    поэтому потребление памяти не зависит от размера дампа.
+    При workers > 1 разбор идет в workers процессах, запись - в текущем.
+    progress, если задан, периодически получает
+    {'phase', 'bytes_read', 'bytes_total', 'rows': {table: inserted}}.
+    С base_db (БД предыдущего бэкапа) загрузка инкрементальная: берется копия
+    base_db, и в INCREMENTAL_TABLES пишутся только новые, измененные и
+    удаленные строки (см. IncrementalLoader). Если строки базы не совпали
+    с дампом (BaseMismatchError), загрузка повторяется целиком без base_db;
+    использованную базу см. в get_ingest_base().
+    Таблицы и колонки дампа, которых нет в _create_sqlite_schema, создаются
+    по его CREATE TABLE и заголовкам COPY (см. BulkLoader.define_table);
+    таблицы из skip_tables не загружаются.
+    Статистику вставки по таблицам см. в get_ingest_stats(), времена фаз
+    (read, decompress, parse, insert, rollups, index) - в get_ingest_phases().
+    """
+    bytes_total = backup_path.stat().st_size
+    started = time.perf_counter()
+    phases = {}
     
-    # Парсим
-    tables = parse_sql_dump(sql_content)
+    def report(phase: str, bytes_read: int):
+        if progress:
+            rows = {t: s['inserted'] for t, s in loader.stats.items()}
+            progress({'phase': phase, 'bytes_read': bytes_read, 'bytes_total': bytes_total, 'rows': rows})
     
     # Создаем SQLite БД
     if db_path.exists():
         db_path.unlink()
+    if base_db:
+        shutil.copyfile(base_db, db_path)
     
     conn = sqlite3.connect(str(db_path))
     conn.row_factory = sqlite3.Row
+    for pragma in LOAD_PRAGMAS:
+        conn.execute(pragma)
     
     # Создаем таблицы
+    if base_db:
+        conn.execute("DROP TABLE IF EXISTS ingest_stats")
     _create_sqlite_schema(conn)
+    _add_derived_columns(conn)
+    phases['prepare'] = time.perf_counter() - started
+    
+    # Парсим и заполняем данными одной транзакцией
+    loader = IncrementalLoader(conn) if base_db else BulkLoader(conn)
+    report('parsing', 0)
+    phase_started = time.perf_counter()
+    try:
+        with _open_dump(backup_path, phases) as f:
+            if workers > 1:
+                _load_rows_parallel(
+                    f, loader, workers, on_segment=lambda: report('parsing', _dump_position(f)),
+                    skip_tables=skip_tables
+                )
+            else:
+                rows = iter_dump_rows(f, on_create=loader.define_table, skip_tables=skip_tables)
+                for n, (table_name, columns, values) in enumerate(rows, 1):
+                    loader.add(table_name, columns, values)
+                    if progress and not n % PROGRESS_ROWS:
+                        report('parsing', _dump_position(f))
+    except BaseMismatchError:
+        # Строкам базы нельзя доверять: те же id - другие данные
+        conn.close()
+        return load_backup_to_sqlite(backup_path, db_path, workers, progress, None, skip_tables)
+    # Разбор - все время цикла, кроме чтения, распаковки и вставки
+    phases['parse'] = (
+        time.perf_counter() - phase_started - phases['read'] - phases.get('decompress', 0) - loader.write_seconds
+    )
+    phase_started = time.perf_counter()
+    loader.finish()
+    _save_dump_timestamp(conn, _read_dump_timestamp(backup_path))
+    if base_db:
+        conn.execute("INSERT OR REPLACE INTO backup_meta VALUES ('ingest_base', ?)", (base_db.name,))
+    conn.commit()
+    phases['insert'] = loader.write_seconds + time.perf_counter() - phase_started
     
-    # Заполняем данными
-    _insert_data(conn, tables)
+    # Агрегаты для Analytics: один проход по dialogs
+    report('rollups', bytes_total)
+    phase_started = time.perf_counter()
+    build_rollups(conn)
+    conn.commit()
+    phases['rollups'] = time.perf_counter() - phase_started
     
+    # Индексы строим по уже загруженным данным
+    report('indexing', bytes_total)
+    phase_started = time.perf_counter()
+    _create_sqlite_indexes(conn)
     conn.commit()
+    phases['index'] = time.perf_counter() - phase_started
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+    
+    phases['total'] = time.perf_counter() - started
+    _save_ingest_phases(conn, phases)
+    report('done', bytes_total)
     return conn
 
 
+def _save_ingest_phases(conn: sqlite3.Connection, phases: dict):
+    """Пишет времена фаз загрузки в backup_meta и в METRICS процесса"""
+    phases = {phase: round(seconds, 4) for phase, seconds in phases.items()}
+    conn.execute("INSERT OR REPLACE INTO backup_meta VALUES ('ingest_phases', ?)", (json.dumps(phases),))
+    conn.commit()
+    METRICS.observe_ingest(phases)
+
+
+def get_ingest_base(conn: sqlite3.Connection) -> Optional[str]:
+    """Имя файла БД, поверх которой шла инкрементальная загрузка; None - загрузка целиком"""
+    try:
+        row = conn.execute("SELECT value FROM backup_meta WHERE key = 'ingest_base'").fetchone()
+    except sqlite3.OperationalError:
+        # БД, загруженные до появления backup_meta
+        return None
+    return row[0] if row else None
+
+
+def get_ingest_phases(conn: sqlite3.Connection) -> dict:
+    """Времена фаз загрузки бэкапа: {фаза: секунды}"""
+    try:
+        row = conn.execute("SELECT value FROM backup_meta WHERE key = 'ingest_phases'").fetchone()
+    except sqlite3.OperationalError:
+        # БД, загруженные до появления backup_meta
+        return {}
+    return json.loads(row[0]) if row else {}
+
+
 def _create_sqlite_schema(conn: sqlite3.Connection):
     """Создает схему SQLite"""
     conn.executescript("""
@@ -250,148 +929,671 @@ def _create_sqlite_schema(conn: sqlite3.Connection):
             PRIMARY KEY (user_id, character_id)
         );
         
+        CREATE TABLE IF NOT EXISTS ingest_stats (
+            table_name TEXT PRIMARY KEY,
+            rows_inserted INTEGER,
+            rows_rejected INTEGER,
+            rows_skipped INTEGER,
+            rows_unchanged INTEGER,
+            rows_deleted INTEGER
+        );
+        
+        CREATE TABLE IF NOT EXISTS backup_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+
+
+def _epoch_sql(column: str) -> str:
+    """SQL: секунды UTC из TEXT-времени pg ('2026-01-20 03:00:01.123+03', '+05:30', 'Z' или без зоны)"""
+    return (
+        f"CAST(strftime('%s', substr({column}, 1, 19) || CASE"
+        f" WHEN length({column}) <= 19 THEN ''"
+        f" WHEN substr({column}, -3, 1) IN ('+', '-') THEN substr({column}, -3) || ':00'"
+        f" WHEN substr({column}, -6, 1) IN ('+', '-') THEN substr({column}, -6)"
+        f" ELSE '' END) AS INTEGER)"
+    )
+
+
+def _add_derived_columns(conn: sqlite3.Connection):
+    """Добавляет недостающие DERIVED_COLUMNS (в т.ч. в БД предыдущих версий)"""
+    for table_name, columns in DERIVED_COLUMNS.items():
+        existing = {r[1] for r in conn.execute(f"PRAGMA table_xinfo({table_name})")}
+        for name, expression in columns:
+            if name in existing:
+                continue
+            expression = re.sub(r'\{epoch:(\w+)\}', lambda m: _epoch_sql(m.group(1)), expression)
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {name} INTEGER AS ({expression}) VIRTUAL")
+
+
+def _normalize_timestamp(value: str) -> str:
+    """'2026-01-20T03:00:01.123+00' -> '2026-01-20 03:00:01' (формат, понятный DATE())"""
+    return value[:19].replace('T', ' ')
+
+
+def _day_number(timestamp: str) -> int:
+    """'YYYY-MM-DD HH:MM:SS' (UTC) -> номер дня от 1970-01-01"""
+    return int(datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp()) // 86400
+
+
+def _last_full_day(timestamp: str) -> int:
+    """Номер последнего полного дня к моменту timestamp (сам его день - только на последней секунде)"""
+    return _day_number(timestamp) if timestamp.endswith('23:59:59') else _day_number(timestamp) - 1
+
+
+def _read_dump_timestamp(backup_path: Path) -> Optional[str]:
+    """Время снятия дампа из заголовка pg_dump, если он его содержит"""
+    with _open_dump(backup_path) as f:
+        for _, line in zip(range(DUMP_HEADER_LINES), f):
+            match = DUMP_STARTED_PATTERN.match(line)
+            if match:
+                return match.group(1)
+    return None
+
+
+def _save_dump_timestamp(conn: sqlite3.Connection, header_time: Optional[str]):
+    """Пишет в backup_meta время дампа: из заголовка или max(created_at) по данным"""
+    dumped_at = header_time
+    if not dumped_at:
+        candidates = [
+            conn.execute(f"SELECT MAX({column}) FROM {table}").fetchone()[0]
+            for table, column in DUMP_TIME_COLUMNS
+        ]
+        candidates = [_normalize_timestamp(str(c)) for c in candidates if c]
+        dumped_at = max(candidates) if candidates else None
+    if dumped_at:
+        conn.execute("INSERT OR REPLACE INTO backup_meta VALUES ('dumped_at', ?)", (dumped_at,))
+
+
+def get_dump_timestamp(conn: sqlite3.Connection) -> Optional[str]:
+    """Время снятия дампа ('YYYY-MM-DD HH:MM:SS'), сохраненное при загрузке"""
+    try:
+        row = conn.execute("SELECT value FROM backup_meta WHERE key = 'dumped_at'").fetchone()
+    except sqlite3.OperationalError:
+        # БД, загруженные до появления backup_meta
+        return None
+    return row[0] if row else None
+
+
+def build_rollups(conn: sqlite3.Connection):
+    """(Пере)строит таблицы ROLLUPS по загруженным dialogs и payments.
+
+    dialogs читается один раз: группировка до зерна
+    (пользователь, персонаж, роль, день, час, модель), из которого
+    дальше собираются все агрегаты сообщений.
+    """
+    conn.execute("DROP TABLE IF EXISTS temp.dialog_grain")
+    conn.execute("""
+        CREATE TEMP TABLE dialog_grain AS
+        SELECT user_id, character_id, role = 'user' AS is_user,
+               created_day AS day_num, created_hour AS hour,
+               model_used AS model,
+               COUNT(*) AS messages,
+               SUM(tokens_used) AS tokens, COUNT(tokens_used) AS tokens_count
+        FROM dialogs
+        GROUP BY user_id, character_id, is_user, day_num, hour, model
+    """)
+    for table_name, select in ROLLUPS.items():
+        conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+        conn.execute(f"CREATE TABLE {table_name} AS {select}")
+    # Активность пользователей по дням - из того же зерна; ряд DAU/WAU/MAU
+    # продолжаем до дня снятия дампа, чтобы он был и для as_of по умолчанию
+    first_day, last_day = conn.execute(
+        "SELECT MIN(day_num), MAX(day_num) FROM dialog_grain WHERE user_id IS NOT NULL"
+    ).fetchone()
+    dumped_at = get_dump_timestamp(conn)
+    if dumped_at and last_day is not None:
+        last_day = max(last_day, _day_number(dumped_at))
+    build_activity(
+        conn,
+        """
+            SELECT DISTINCT user_id, day_num FROM dialog_grain
+            WHERE user_id IS NOT NULL AND day_num IS NOT NULL
+            ORDER BY user_id, day_num
+        """,
+        first_day, last_day
+    )
+    conn.execute("DROP TABLE temp.dialog_grain")
+
+
+def backup_db_outdated(conn: sqlite3.Connection) -> bool:
+    """True, если в БД нет вычисляемых колонок, индексов или агрегатов текущей версии"""
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master")}
+    derived = {
+        r[1] for t in DERIVED_COLUMNS for r in conn.execute(f"PRAGMA table_xinfo({t})")
+    }
+    return not (all(t in existing for t in (*ROLLUPS, *ACTIVITY_TABLES)) and all(
+        name in derived for columns in DERIVED_COLUMNS.values() for name, _ in columns
+    ) and 'idx_users_referred' in existing)
+
+
+def upgrade_backup_db(conn: sqlite3.Connection) -> bool:
+    """Достраивает вычисляемые колонки, индексы и агрегаты в БД,
+    загруженной предыдущей версией. True, если что-то менял"""
+    if not backup_db_outdated(conn):
+        return False
+    _add_derived_columns(conn)
+    _create_sqlite_indexes(conn)
+    build_rollups(conn)
+    conn.commit()
+    return True
+
+
+def _create_sqlite_indexes(conn: sqlite3.Connection):
+    """Создает индексы. Вызывается после загрузки данных: так быстрее, чем обновлять их на каждой вставке"""
+    conn.executescript("""
         CREATE INDEX IF NOT EXISTS idx_dialogs_user ON dialogs(user_id);
         CREATE INDEX IF NOT EXISTS idx_dialogs_character ON dialogs(character_id);
-        CREATE INDEX IF NOT EXISTS idx_dialogs_created ON dialogs(created_at);
+        DROP INDEX IF EXISTS idx_dialogs_created;
+        CREATE INDEX IF NOT EXISTS idx_dialogs_day ON dialogs(created_day);
         CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);
         CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id);
+        -- Покрывающие индексы под запросы Analytics и build_rollups
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_status_user ON subscriptions(status, user_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_status_user ON payments(status, user_id, amount_stars);
+        CREATE INDEX IF NOT EXISTS idx_users_referred ON users(referred_by);
     """)
 
 
-def _insert_data(conn: sqlite3.Connection, tables: dict):
-    """Вставляет данные в SQLite"""
-    # Маппинг колонок для каждой таблицы
-    table_columns = {
-        'users': ['id', 'telegram_user_id', 'username', 'created_at', 'display_name', 'gender', 
-                  'language', 'is_adult_confirmed', 'last_active_at', 'nickname', 'voice_person',
-                  'bonus_messages', 'limit_start_date', 'referred_by', 'active_days_count', 
-                  'last_activity_date', 'last_character_id'],
-        'characters': ['id', 'name', 'description_long', 'avatar_url', 'system_prompt', 'access_type',
-                      'is_active', 'created_at', 'grammatical_gender', 'popularity_score', 
-                      'messages_count', 'unique_users_count', 'llm_provider', 'llm_model',
-                      'llm_temperature', 'llm_top_p', 'llm_repetition_penalty', 'driver_prompt_version',
-                      'initial_attraction', 'initial_trust', 'initial_affection', 'initial_dominance',
-                      'created_by', 'is_private', 'is_approved', 'rejection_reason'],
-        'subscriptions': ['id', 'user_id', 'status', 'start_at', 'end_at', 'created_at'],
-        'dialogs': ['id', 'user_id', 'character_id', 'role', 'message_text', 'created_at',
-                   'is_regenerated', 'tokens_used', 'model_used'],
-        'payments': ['id', 'user_id', 'amount_stars', 'telegram_payment_id', 'status', 'tier', 
-                    'charge_id', 'created_at'],
-        'chat_sessions': ['id', 'user_id', 'character_id', 'last_message_at', 'messages_count',
-                         'created_at', 'llm_model', 'llm_temperature', 'llm_top_p'],
-        'character_ratings': ['user_id', 'character_id', 'rating', 'created_at'],
-        'referral_rewards': ['id', 'referrer_id', 'referred_id', 'reward_type', 'messages_awarded', 'created_at'],
-        'tags': ['id', 'name', 'created_at'],
-        'character_tags': ['character_id', 'tag_id'],
-        'user_character_state': ['user_id', 'character_id', 'attraction', 'trust', 'affection', 
-                                'dominance', 'updated_at'],
-        'dialog_summaries': ['user_id', 'character_id', 'summary_text', 'updated_at', 'summarized_message_count'],
-    }
+# Порядок колонок для INSERT без явного списка колонок, если в дампе нет CREATE TABLE
+TABLE_COLUMNS = {
+    'users': ['id', 'telegram_user_id', 'username', 'created_at', 'display_name', 'gender', 
+              'language', 'is_adult_confirmed', 'last_active_at', 'nickname', 'voice_person',
+              'bonus_messages', 'limit_start_date', 'referred_by', 'active_days_count', 
+              'last_activity_date', 'last_character_id'],
+    'characters': ['id', 'name', 'description_long', 'avatar_url', 'system_prompt', 'access_type',
+                  'is_active', 'created_at', 'grammatical_gender', 'popularity_score', 
+                  'messages_count', 'unique_users_count', 'llm_provider', 'llm_model',
+                  'llm_temperature', 'llm_top_p', 'llm_repetition_penalty', 'driver_prompt_version',
+                  'initial_attraction', 'initial_trust', 'initial_affection', 'initial_dominance',
+                  'created_by', 'is_private', 'is_approved', 'rejection_reason'],
+    'subscriptions': ['id', 'user_id', 'status', 'start_at', 'end_at', 'created_at'],
+    'dialogs': ['id', 'user_id', 'character_id', 'role', 'message_text', 'created_at',
+               'is_regenerated', 'tokens_used', 'model_used'],
+    'payments': ['id', 'user_id', 'amount_stars', 'telegram_payment_id', 'status', 'tier', 
+                'charge_id', 'created_at'],
+    'chat_sessions': ['id', 'user_id', 'character_id', 'last_message_at', 'messages_count',
+                     'created_at', 'llm_model', 'llm_temperature', 'llm_top_p'],
+    'character_ratings': ['user_id', 'character_id', 'rating', 'created_at'],
+    'referral_rewards': ['id', 'referrer_id', 'referred_id', 'reward_type', 'messages_awarded', 'created_at'],
+    'tags': ['id', 'name', 'created_at'],
+    'character_tags': ['character_id', 'tag_id'],
+    'user_character_state': ['user_id', 'character_id', 'attraction', 'trust', 'affection', 
+                            'dominance', 'updated_at'],
+    'dialog_summaries': ['user_id', 'character_id', 'summary_text', 'updated_at', 'summarized_message_count'],
+}
+
+
+class BulkLoader:
+    """Пакетная вставка строк дампа в SQLite.
+
+    INSERT-стейтмент строится один раз на (таблица, колонки), строки
+    копятся и пишутся через executemany пачками по BATCH_SIZE.
+    Отклоненные строки считаются по таблицам в self.stats.
+    Таблицы и колонки, которых нет в схеме, создаются по CREATE TABLE
+    дампа (define_table) или по заголовку COPY/INSERT.
+    """
     
-    for table_name, rows in tables.items():
-        if table_name not in table_columns:
-            continue
+    def __init__(self, conn: sqlite3.Connection, batch_size: int = BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.stats = {}  # {table: {'inserted', 'rejected', 'skipped', 'unchanged', 'deleted'}}
+        self.write_seconds = 0.0  # время записи пачек из add/add_rows
+        self._batches = {}
+        self._statements = {}
+        self._schema = {}
+        self._columns = {}  # {table: порядок колонок из CREATE TABLE дампа}
+    
+    def define_table(self, table_name: str, columns: list):
+        """CREATE TABLE из дампа: [(колонка, тип PostgreSQL)].
+
+        Создает таблицу или добавляет в нее недостающие колонки; порядок
+        колонок дампа используется для INSERT без списка колонок.
+        """
+        if not columns or table_name in SERVICE_TABLES:
+            return
+        self._add_columns(table_name, columns)
+        self._columns[table_name] = tuple(name for name, _ in columns)
+        # Стейтменты таблицы строились по старой схеме
+        self._statements = {key: st for key, st in self._statements.items() if key[0] != table_name}
+    
+    def column_order(self, table_name: str) -> Optional[tuple]:
+        """Порядок колонок для строк без списка колонок: из дампа или TABLE_COLUMNS"""
+        return self._columns.get(table_name) or TABLE_COLUMNS.get(table_name)
+    
+    def _add_columns(self, table_name: str, columns: list):
+        """Создает таблицу или добавляет колонки, которых в ней нет: [(колонка, тип PostgreSQL или None)]"""
+        types = self._table_types(table_name)
+        missing, seen = [], set(types)
+        for name, pg_type in columns:
+            if name not in seen:
+                seen.add(name)
+                missing.append(f'"{name}" {sqlite_affinity(pg_type)}')
+        if not missing:
+            return
+        if types:
+            for column in missing:
+                self.conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN {column}')
+        else:
+            self.conn.execute(f'CREATE TABLE "{table_name}" ({", ".join(missing)})')
+        self._schema.pop(table_name, None)
+    
+    def add(self, table_name: str, columns: Optional[tuple], values: list):
+        key = (table_name, columns)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = []
+        batch.append(values)
+        if len(batch) >= self.batch_size:
+            self._timed_write(table_name, columns, batch)
+            self._batches[key] = []
+    
+    def add_rows(self, table_name: str, columns: Optional[tuple], rows: list):
+        key = (table_name, columns)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = []
+        batch.extend(rows)
+        if len(batch) >= self.batch_size:
+            self._timed_write(table_name, columns, batch)
+            self._batches[key] = []
+    
+    def _timed_write(self, table_name: str, columns: Optional[tuple], rows: list):
+        started = time.perf_counter()
+        self._write(table_name, columns, rows)
+        self.write_seconds += time.perf_counter() - started
+    
+    def flush(self):
+        for (table_name, columns), batch in self._batches.items():
+            if batch:
+                self._write(table_name, columns, batch)
+        self._batches = {}
+    
+    def finish(self):
+        """Дописывает оставшиеся пачки и сохраняет статистику"""
+        self.flush()
+        self.save_stats()
+    
+    def save_stats(self):
+        """Сохраняет статистику загрузки в таблицу ingest_stats"""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO ingest_stats VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (t, s['inserted'], s['rejected'], s['skipped'], s['unchanged'], s['deleted'])
+                for t, s in self.stats.items()
+            ]
+        )
+    
+    def _table_stats(self, table_name: str) -> dict:
+        if table_name not in self.stats:
+            self.stats[table_name] = {'inserted': 0, 'rejected': 0, 'skipped': 0, 'unchanged': 0, 'deleted': 0}
+        return self.stats[table_name]
+    
+    def _table_types(self, table_name: str) -> dict:
+        """{column: declared type} для таблицы SQLite"""
+        if table_name not in self._schema:
+            self._schema[table_name] = {
+                r[1]: r[2].upper() for r in self.conn.execute(f"PRAGMA table_info(\"{table_name}\")")
+            }
+        return self._schema[table_name]
+    
+    def _statement(self, table_name: str, columns: Optional[tuple]) -> Optional[tuple]:
+        """(sql, width) для вставки строк с данным порядком колонок.
+
+        Параметры нумерованные (?N) и ссылаются на позицию значения в строке
+        дампа, так что строки COPY передаются в executemany без перекладки.
+        """
+        key = (table_name, columns)
+        if key in self._statements:
+            return self._statements[key]
+        
+        types = self._table_types(table_name)
+        if columns is None:
+            columns = self.column_order(table_name) if types else None
+        elif table_name not in SERVICE_TABLES and any(col not in types for col in columns):
+            # Таблица или колонки не описаны в дампе (дамп только с данными): тип неизвестен
+            self._add_columns(table_name, [(col, None) for col in columns])
+            types = self._table_types(table_name)
+        if not columns:
+            self._statements[key] = None
+            return None
+        
+        cols, params = [], []
+        for i, col in enumerate(columns, 1):
+            if col not in types:
+                continue
+            cols.append(col)
+            if types[col] == 'INTEGER':
+                # COPY отдает boolean как 't'/'f'
+                params.append(f"CASE ?{i} WHEN 't' THEN 1 WHEN 'f' THEN 0 ELSE ?{i} END")
+            else:
+                params.append(f"?{i}")
+        if not cols:
+            self._statements[key] = None
+            return None
+        
+        # Число значений в строке должно совпадать с максимальным номером параметра
+        width = max(i for i, col in enumerate(columns, 1) if col in types)
+        quoted = ','.join(f'"{col}"' for col in cols)
+        sql = f'INSERT OR IGNORE INTO "{table_name}" ({quoted}) VALUES ({",".join(params)})'
+        self._statements[key] = (sql, width)
+        return self._statements[key]
+    
+    def _write(self, table_name: str, columns: Optional[tuple], rows: list):
+        stats = self._table_stats(table_name)
+        statement = self._statement(table_name, columns)
+        if statement is None:
+            stats['skipped'] += len(rows)
+            return
+        
+        sql, width = statement
+        if any(len(row) != width for row in rows):
+            # Подгоняем количество значений под количество колонок
+            pad = [None] * width
+            rows = [row[:width] if len(row) >= width else list(row) + pad[len(row):] for row in rows]
+        
+        before = self.conn.total_changes
+        self.conn.execute("SAVEPOINT bulk_batch")
+        try:
+            self.conn.executemany(sql, rows)
+        except (sqlite3.Error, ValueError, TypeError):
+            # Пачка не прошла целиком - повторяем построчно, чтобы найти плохие строки
+            self.conn.execute("ROLLBACK TO bulk_batch")
+            before = self.conn.total_changes
+            for row in rows:
+                try:
+                    self.conn.execute(sql, row)
+                except (sqlite3.Error, ValueError, TypeError):
+                    pass
+        self.conn.execute("RELEASE bulk_batch")
+        
+        inserted = self.conn.total_changes - before
+        stats['inserted'] += inserted
+        # Сюда же попадают дубликаты по PRIMARY KEY, проигнорированные INSERT OR IGNORE
+        stats['rejected'] += len(rows) - inserted
+
+
+class BaseMismatchError(ValueError):
+    """Строка базы инкрементальной загрузки не совпала со строкой дампа с тем же ключом"""
+
+
+class IncrementalLoader(BulkLoader):
+    """BulkLoader поверх копии БД предыдущего бэкапа.
+
+    Таблицы вне INCREMENTAL_TABLES очищаются и загружаются заново (они
+    маленькие). В INCREMENTAL_TABLES строка пишется (INSERT OR REPLACE),
+    только если ее ключа не было в базе или изменилась версия; ключи базы,
+    которых нет в новом дампе, в конце удаляются. Строки без версии
+    считаются неизменными по одному ключу, поэтому первые BASE_CHECK_ROWS
+    из них сверяются с базой по колонкам check (иначе BaseMismatchError).
+    """
+    
+    def __init__(self, conn: sqlite3.Connection, batch_size: int = BATCH_SIZE):
+        super().__init__(conn, batch_size)
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table_name in tables:
+            if table_name not in INCREMENTAL_TABLES and not table_name.startswith('sqlite_'):
+                conn.execute(f"DELETE FROM {table_name}")
+        self._base = {t: self._load_base(t, spec) for t, spec in INCREMENTAL_TABLES.items() if t in tables}
+        self._positions = {}
+    
+    def _load_base(self, table_name: str, spec: dict) -> dict:
+        """Ключи (и версии) строк, уже лежащих в базе"""
+        key_sql = ', '.join(spec['key'])
+        if spec['version'] is None:
+            # Неизменяемые строки с целочисленным id - битовые карты "есть в базе" / "есть в дампе"
+            max_id = self.conn.execute(f"SELECT COALESCE(MAX({key_sql}), 0) FROM {table_name}").fetchone()[0]
+            base = bytearray(max_id // 8 + 1)
+            for (row_id,) in self.conn.execute(f"SELECT {key_sql} FROM {table_name}"):
+                base[row_id >> 3] |= 1 << (row_id & 7)
+            return {'base': base, 'seen': bytearray(len(base)), 'checked': 0}
+        
+        version_sql = ', '.join(spec['version'])
+        width = len(spec['key'])
+        versions = {}
+        for row in self.conn.execute(f"SELECT {key_sql}, {version_sql} FROM {table_name}"):
+            versions[tuple(row[:width])] = tuple(None if v is None else str(v) for v in row[width:])
+        return {'base': versions, 'seen': set()}
+    
+    def _key_positions(self, table_name: str, columns: Optional[tuple]) -> Optional[tuple]:
+        """Позиции колонок ключа и версии в строке дампа"""
+        cache_key = (table_name, columns)
+        if cache_key not in self._positions:
+            spec = INCREMENTAL_TABLES[table_name]
+            order = list(columns or self.column_order(table_name) or ())
+            names = spec['key'] + (spec['version'] or ())
+            if all(name in order for name in names):
+                key = tuple(order.index(c) for c in spec['key'])
+                version = tuple(order.index(c) for c in spec['version'] or ())
+                # Без колонок check в дампе строки базы сверить не с чем
+                check = spec.get('check') or ()
+                check = tuple(order.index(c) for c in check) if all(c in order for c in check) else ()
+                self._positions[cache_key] = (key, version, check)
+            else:
+                # Без ключа в дампе сравнивать не с чем - пишем все строки
+                self._positions[cache_key] = None
+        return self._positions[cache_key]
+    
+    def _statement(self, table_name: str, columns: Optional[tuple]) -> Optional[tuple]:
+        statement = super()._statement(table_name, columns)
+        if statement and table_name in self._base:
+            sql, width = statement
+            return sql.replace('INSERT OR IGNORE', 'INSERT OR REPLACE', 1), width
+        return statement
+    
+    def _write(self, table_name: str, columns: Optional[tuple], rows: list):
+        base = self._base.get(table_name)
+        positions = self._key_positions(table_name, columns) if base else None
+        if positions:
+            rows = self._changed_rows(table_name, base, positions, rows)
+        if rows:
+            super()._write(table_name, columns, rows)
+    
+    def _changed_rows(self, table_name: str, base: dict, positions: tuple, rows: list) -> list:
+        stats = self._table_stats(table_name)
+        key_idx, version_idx, check_idx = positions
+        changed = []
+        
+        if not version_idx:
+            bitmap, seen = base['base'], base['seen']
+            (i,) = key_idx
+            limit = len(bitmap) * 8
+            to_check = BASE_CHECK_ROWS - base['checked'] if check_idx else 0
+            for row in rows:
+                try:
+                    row_id = int(row[i])
+                except (IndexError, TypeError, ValueError):
+                    changed.append(row)
+                    continue
+                if 0 <= row_id < limit and bitmap[row_id >> 3] & (1 << (row_id & 7)):
+                    if to_check > 0:
+                        self._check_base_row(table_name, row_id, row, check_idx)
+                        to_check -= 1
+                        base['checked'] += 1
+                    seen[row_id >> 3] |= 1 << (row_id & 7)
+                    stats['unchanged'] += 1
+                else:
+                    changed.append(row)
+            return changed
         
-        cols = table_columns[table_name]
+        versions, seen = base['base'], base['seen']
         for row in rows:
-            # Подгоняем количество значений под количество колонок
-            values = list(row[:len(cols)])
-            while len(values) < len(cols):
-                values.append(None)
-            
-            placeholders = ','.join(['?' for _ in cols])
             try:
-                conn.execute(
-                    f"INSERT OR IGNORE INTO {table_name} ({','.join(cols)}) VALUES ({placeholders})",
-                    values
-                )
-            except Exception as e:
-                # Пропускаем ошибки вставки
-                pass
+                key = tuple(int(row[i]) for i in key_idx)
+                version = tuple(None if row[i] is None else str(row[i]) for i in version_idx)
+            except (IndexError, TypeError, ValueError):
+                changed.append(row)
+                continue
+            seen.add(key)
+            if versions.get(key) == version:
+                stats['unchanged'] += 1
+            else:
+                changed.append(row)
+        return changed
+    
+    def _check_base_row(self, table_name: str, row_id: int, row: list, check_idx: tuple):
+        """Сверяет строку базы с тем же id со строкой дампа по колонкам check"""
+        spec = INCREMENTAL_TABLES[table_name]
+        stored = self.conn.execute(
+            f"SELECT {', '.join(spec['check'])} FROM {table_name} WHERE {spec['key'][0]} = ?", (row_id,)
+        ).fetchone()
+        expected = tuple(None if row[i] is None else str(row[i]) for i in check_idx)
+        if tuple(None if v is None else str(v) for v in stored) != expected:
+            raise BaseMismatchError(f"{table_name} {row_id} differs from the base: {tuple(stored)} != {expected}")
+    
+    def finish(self):
+        self.flush()
+        self._delete_missing()
+        self.save_stats()
+    
+    def _delete_missing(self):
+        """Удаляет строки базы, которых нет в новом дампе"""
+        for table_name, base in self._base.items():
+            spec = INCREMENTAL_TABLES[table_name]
+            if spec['version'] is None:
+                bitmap = int.from_bytes(base['base'], 'little') & ~int.from_bytes(base['seen'], 'little')
+                missing = bitmap.to_bytes(len(base['base']), 'little')
+                keys = [
+                    (byte_no * 8 + bit,)
+                    for byte_no, byte in enumerate(missing) if byte
+                    for bit in range(8) if byte & (1 << bit)
+                ]
+            else:
+                keys = [key for key in base['base'] if key not in base['seen']]
+            if not keys:
+                continue
+            where = ' AND '.join(f"{c} = ?" for c in spec['key'])
+            self.conn.executemany(f"DELETE FROM {table_name} WHERE {where}", keys)
+            self._table_stats(table_name)['deleted'] += len(keys)
+
+
+def _insert_data(conn: sqlite3.Connection, tables: dict) -> dict:
+    """Вставляет данные в SQLite, возвращает статистику по таблицам"""
+    loader = BulkLoader(conn)
+    for table_name, rows in tables.items():
+        loader.add_rows(table_name, None, rows)
+    loader.flush()
+    return loader.stats
+
+
+def get_ingest_stats(conn: sqlite3.Connection) -> dict:
+    """Статистика загрузки бэкапа: {table: {'inserted', 'rejected', 'skipped', 'unchanged', 'deleted'}}"""
+    try:
+        rows = conn.execute("""
+            SELECT table_name, rows_inserted, rows_rejected, rows_skipped, rows_unchanged, rows_deleted
+            FROM ingest_stats ORDER BY table_name
+        """).fetchall()
+    except sqlite3.OperationalError:
+        # БД, загруженные до появления ingest_stats
+        return {}
+    return {
+        r[0]: {'inserted': r[1], 'rejected': r[2], 'skipped': r[3], 'unchanged': r[4], 'deleted': r[5]}
+        for r in rows
+    }
+
+
+def table_row_counts(conn: sqlite3.Connection) -> dict:
+    """{table: количество строк} для таблиц данных бэкапа"""
+    tables = [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+    return {t: conn.execute(f"SELECT COUNT(*) FROM \"{t}\"").fetchone()[0] for t in tables if t not in SERVICE_TABLES}
 
 
 class Analytics:
-    """Класс для аналитических запросов"""
+    """Класс для аналитических запросов.
+
+    Сообщения и платежи читаются из агрегатов ROLLUPS, а не из dialogs
+    и payments: запросы дашборда не зависят от объема истории.
+
+    Все окна по времени (DAU/WAU/MAU, графики по дням) отсчитываются от as_of,
+    а не от текущего времени, поэтому результат - чистая функция (бэкап, as_of).
+    По умолчанию as_of - время снятия дампа (см. get_dump_timestamp).
+    """
     
-    def __init__(self, conn: sqlite3.Connection):
+    def __init__(self, conn: sqlite3.Connection, as_of: Optional[str] = None, window_days: int = WINDOW_DAYS):
         self.conn = conn
+        self.as_of = _normalize_timestamp(
+            as_of or get_dump_timestamp(conn) or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        )
+        self.window_days = window_days
+        # Параметры окна для запросов: окно включает весь день as_of.
+        # Даты считаются здесь, а не DATE() в SQL, чтобы запросы шли на любом движке
+        as_of_day = _day_number(self.as_of)
+        self._window = {
+            'as_of_day': as_of_day, 'from_day': as_of_day - window_days,
+            'from_date': day_to_date(as_of_day - window_days), 'to_date': day_to_date(as_of_day + 1),
+            # День DAU/WAU/MAU - последний полный день к моменту as_of, явному или по умолчанию
+            'activity_day': _last_full_day(self.as_of),
+        }
+    
+    def _cursor(self, section: str) -> TimedCursor:
+        """Курсор раздела: время каждого запроса пишется в METRICS (см. metrics.py)"""
+        return TimedCursor(self.conn, section)
     
     def get_overview(self) -> dict:
         """Общий обзор"""
-        cur = self.conn.cursor()
-        
-        total_users = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        total_messages = cur.execute("SELECT COUNT(*) FROM dialogs").fetchone()[0]
-        total_characters = cur.execute("SELECT COUNT(*) FROM characters WHERE is_active = 1").fetchone()[0]
-        total_payments = cur.execute("SELECT COUNT(*) FROM payments WHERE status = 'success'").fetchone()[0]
-        total_revenue = cur.execute("SELECT COALESCE(SUM(amount_stars), 0) FROM payments WHERE status = 'success'").fetchone()[0]
+        cur = self._cursor('overview')
+        
+        total_users = cur.execute("SELECT COUNT(*) FROM users", metric='total_users').fetchone()[0]
+        total_messages = cur.execute(
+            "SELECT COALESCE(SUM(messages), 0) FROM daily_messages", metric='total_messages'
+        ).fetchone()[0]
+        total_characters = cur.execute(
+            "SELECT COUNT(*) FROM characters WHERE is_active = 1", metric='total_characters'
+        ).fetchone()[0]
+        total_payments, total_revenue = cur.execute("""
+            SELECT COALESCE(SUM(payments), 0), COALESCE(SUM(revenue), 0) FROM daily_revenue WHERE status = 'success'
+        """, metric='payments').fetchone()
+        paying_users = cur.execute("SELECT COUNT(*) FROM user_revenue", metric='paying_users').fetchone()[0]
         
         return {
             'total_users': total_users,
             'total_messages': total_messages,
             'total_characters': total_characters,
             'total_payments': total_payments,
-            'total_revenue': total_revenue
+            'total_revenue': total_revenue,
+            'paying_users': paying_users,
+            'conversion_rate': round(paying_users / total_users * 100, 2) if total_users else 0
         }
     
     def get_user_analytics(self) -> dict:
         """Аналитика пользователей"""
-        cur = self.conn.cursor()
-        
-        # Общее количество
-        total = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        cur = self._cursor('users')
         
-        # С подписками
-        premium = cur.execute("""
-            SELECT COUNT(DISTINCT user_id) FROM subscriptions 
-            WHERE status = 'active'
-        """).fetchone()[0]
+        # Общее количество, с подписками, 18+ подтверждение, рефералы
+        total, premium, adult_confirmed, referred = cur.execute("""
+            SELECT COUNT(*), COALESCE(SUM(is_premium), 0), COALESCE(SUM(is_adult), 0), COALESCE(SUM(is_referred), 0)
+            FROM user_segments
+        """, metric='segments').fetchone()
         
         # По языкам
         languages = cur.execute("""
-            SELECT COALESCE(language, 'unknown') as lang, COUNT(*) as cnt 
-            FROM users GROUP BY lang ORDER BY cnt DESC
-        """).fetchall()
+            SELECT language as lang, COUNT(*) as cnt 
+            FROM user_segments GROUP BY lang ORDER BY cnt DESC, lang
+        """, metric='languages').fetchall()
         
         # По полу
         genders = cur.execute("""
             SELECT COALESCE(gender, 'unknown') as g, COUNT(*) as cnt 
-            FROM users GROUP BY g ORDER BY cnt DESC
-        """).fetchall()
-        
-        # 18+ подтверждение
-        adult_confirmed = cur.execute("""
-            SELECT COUNT(*) FROM users WHERE is_adult_confirmed = 1
-        """).fetchone()[0]
+            FROM users GROUP BY g ORDER BY cnt DESC, g
+        """, metric='genders').fetchall()
         
-        # Рефералы
-        referred = cur.execute("""
-            SELECT COUNT(*) FROM users WHERE referred_by IS NOT NULL
-        """).fetchone()[0]
-        
-        # Новые пользователи по дням (последние 30 дней)
+        # Новые пользователи по дням (window_days дней до as_of)
         new_users_by_day = cur.execute("""
-            SELECT DATE(created_at) as day, COUNT(*) as cnt
-            FROM users
-            WHERE created_at >= DATE('now', '-30 days')
-            GROUP BY day ORDER BY day
-        """).fetchall()
-        
-        # DAU/WAU/MAU (по last_active_at)
-        dau = cur.execute("""
-            SELECT COUNT(*) FROM users 
-            WHERE DATE(last_active_at) = DATE('now')
-        """).fetchone()[0]
-        
-        wau = cur.execute("""
-            SELECT COUNT(*) FROM users 
-            WHERE last_active_at >= DATE('now', '-7 days')
-        """).fetchone()[0]
-        
-        mau = cur.execute("""
-            SELECT COUNT(*) FROM users 
-            WHERE last_active_at >= DATE('now', '-30 days')
-        """).fetchone()[0]
+            SELECT day, users FROM daily_signups
+            WHERE day_num BETWEEN :from_day AND :as_of_day
+            ORDER BY day_num
+        """, self._window, metric='new_users_by_day').fetchall()
+        
+        # DAU/WAU/MAU на день as_of и их ряд за окно (по активности в dialogs)
+        activity = cur.execute("""
+            SELECT day, dau, wau, mau FROM activity_daily
+            WHERE day_num BETWEEN :from_day AND :as_of_day
+            ORDER BY day_num
+        """, self._window, metric='activity_by_day').fetchall()
+        dau, wau, mau = self.get_activity_totals().values()
         
         return {
             'total': total,
@@ -404,95 +1606,116 @@ class Analytics:
             'referred': referred,
             'referred_pct': round(referred / total * 100, 1) if total else 0,
             'new_users_by_day': [{'date': r[0], 'count': r[1]} for r in new_users_by_day],
+            'activity_date': day_to_date(self._window['activity_day']),
             'dau': dau,
             'wau': wau,
-            'mau': mau
+            'mau': mau,
+            'stickiness': round(dau / mau * 100, 1) if mau else 0,
+            'activity_by_day': [
+                {'date': r[0], 'dau': r[1], 'wau': r[2], 'mau': r[3],
+                 'stickiness': round(r[1] / r[3] * 100, 1) if r[3] else 0}
+                for r in activity
+            ]
         }
     
+    def get_activity_totals(self) -> dict:
+        """DAU/WAU/MAU на день activity_day - последний полный день к моменту as_of.
+
+        Внутри ряда activity_daily - готовая строка; после его конца (as_of позже
+        дампа) окна считаются по user_activity: активности позже last_day нет.
+        """
+        cur = self._cursor('users')
+        row = cur.execute("""
+            SELECT dau, wau, mau FROM activity_daily WHERE day_num = :activity_day
+        """, self._window, metric='activity_today').fetchone()
+        if row is None:
+            row = cur.execute(f"""
+                SELECT COALESCE(SUM(CASE WHEN last_day = :activity_day THEN 1 ELSE 0 END), 0),
+                       COALESCE(SUM(CASE WHEN last_day > :activity_day - {WAU_DAYS} THEN 1 ELSE 0 END), 0),
+                       COUNT(*)
+                FROM user_activity
+                WHERE last_day > :activity_day - {MAU_DAYS} AND first_day <= :activity_day
+            """, self._window, metric='activity_after_series').fetchone()
+        return dict(zip(('dau', 'wau', 'mau'), row))
+    
     def get_message_analytics(self) -> dict:
         """Аналитика сообщений"""
-        cur = self.conn.cursor()
+        cur = self._cursor('messages')
         
         # Общее количество
-        total = cur.execute("SELECT COUNT(*) FROM dialogs").fetchone()[0]
-        total_user_msgs = cur.execute("SELECT COUNT(*) FROM dialogs WHERE role = 'user'").fetchone()[0]
+        total, total_user_msgs, tokens, tokens_count = cur.execute("""
+            SELECT COALESCE(SUM(messages), 0), COALESCE(SUM(user_messages), 0),
+                   COALESCE(SUM(tokens), 0), COALESCE(SUM(tokens_count), 0)
+            FROM daily_messages
+        """, metric='totals').fetchone()
         
-        # Среднее на пользователя
+        # Среднее на пользователя (среди писавших хотя бы одно сообщение)
         avg_per_user = cur.execute("""
-            SELECT AVG(cnt) FROM (
-                SELECT COUNT(*) as cnt FROM dialogs WHERE role = 'user' GROUP BY user_id
-            )
-        """).fetchone()[0] or 0
-        
-        # Среднее для бесплатных
-        avg_per_free_user = cur.execute("""
-            SELECT AVG(cnt) FROM (
-                SELECT COUNT(*) as cnt FROM dialogs d
-                WHERE d.role = 'user' 
-                AND d.user_id NOT IN (SELECT DISTINCT user_id FROM subscriptions WHERE status = 'active')
-                GROUP BY d.user_id
-            )
-        """).fetchone()[0] or 0
-        
-        # Среднее для premium
-        avg_per_premium_user = cur.execute("""
-            SELECT AVG(cnt) FROM (
-                SELECT COUNT(*) as cnt FROM dialogs d
-                WHERE d.role = 'user' 
-                AND d.user_id IN (SELECT DISTINCT user_id FROM subscriptions WHERE status = 'active')
-                GROUP BY d.user_id
-            )
-        """).fetchone()[0] or 0
+            SELECT AVG(user_messages) FROM user_message_counts WHERE user_messages > 0
+        """, metric='avg_per_user').fetchone()[0] or 0
+        
+        # Среднее для бесплатных и для premium
+        avg_by_premium = dict(cur.execute("""
+            SELECT is_premium, AVG(user_messages) FROM user_segments
+            WHERE user_messages > 0
+            GROUP BY is_premium
+        """, metric='avg_by_premium').fetchall())
+        avg_per_free_user = avg_by_premium.get(0) or 0
+        avg_per_premium_user = avg_by_premium.get(1) or 0
+        
+        # Среднее по сегментам язык x premium
+        by_segment = cur.execute("""
+            SELECT language, is_premium, COUNT(*) as users, AVG(user_messages) as avg_messages
+            FROM user_segments
+            WHERE user_messages > 0
+            GROUP BY language, is_premium
+            ORDER BY users DESC, language, is_premium
+        """, metric='by_segment').fetchall()
         
         # Распределение сообщений
         distribution = cur.execute("""
             SELECT 
                 CASE 
-                    WHEN cnt <= 10 THEN '1-10'
-                    WHEN cnt <= 50 THEN '11-50'
-                    WHEN cnt <= 100 THEN '51-100'
-                    WHEN cnt <= 500 THEN '101-500'
+                    WHEN user_messages <= 10 THEN '1-10'
+                    WHEN user_messages <= 50 THEN '11-50'
+                    WHEN user_messages <= 100 THEN '51-100'
+                    WHEN user_messages <= 500 THEN '101-500'
                     ELSE '500+'
                 END as bucket,
                 COUNT(*) as users
-            FROM (
-                SELECT user_id, COUNT(*) as cnt FROM dialogs WHERE role = 'user' GROUP BY user_id
-            )
+            FROM user_message_counts
+            WHERE user_messages > 0
             GROUP BY bucket
-            ORDER BY MIN(cnt)
-        """).fetchall()
+            ORDER BY MIN(user_messages)
+        """, metric='distribution').fetchall()
         
         # Среднее токенов
-        avg_tokens = cur.execute("""
-            SELECT AVG(tokens_used) FROM dialogs WHERE tokens_used IS NOT NULL
-        """).fetchone()[0] or 0
+        avg_tokens = tokens / tokens_count if tokens_count else 0
         
         # По моделям
         models = cur.execute("""
-            SELECT COALESCE(model_used, 'unknown') as model, COUNT(*) as cnt
-            FROM dialogs WHERE model_used IS NOT NULL
-            GROUP BY model ORDER BY cnt DESC
-        """).fetchall()
+            SELECT model, messages FROM model_usage ORDER BY messages DESC, model
+        """, metric='models').fetchall()
         
         # По часам
         hourly = cur.execute("""
-            SELECT CAST(strftime('%H', created_at) AS INTEGER) as hour, COUNT(*) as cnt
-            FROM dialogs GROUP BY hour ORDER BY hour
-        """).fetchall()
+            SELECT hour, SUM(messages) as cnt
+            FROM hourly_dow_matrix GROUP BY hour ORDER BY hour NULLS FIRST
+        """, metric='hourly').fetchall()
         
         # По дням недели
         daily = cur.execute("""
-            SELECT CAST(strftime('%w', created_at) AS INTEGER) as dow, COUNT(*) as cnt
-            FROM dialogs GROUP BY dow ORDER BY dow
-        """).fetchall()
+            SELECT dow, SUM(messages) as cnt
+            FROM hourly_dow_matrix GROUP BY dow ORDER BY dow NULLS FIRST
+        """, metric='daily').fetchall()
         
-        # Сообщения по дням (последние 30 дней)
+        # Сообщения по дням (window_days дней до as_of)
         msgs_by_day = cur.execute("""
-            SELECT DATE(created_at) as day, COUNT(*) as cnt
-            FROM dialogs
-            WHERE created_at >= DATE('now', '-30 days')
-            GROUP BY day ORDER BY day
-        """).fetchall()
+            SELECT day, messages
+            FROM daily_messages
+            WHERE day >= :from_date AND day < :to_date
+            ORDER BY day
+        """, self._window, metric='messages_by_day').fetchall()
         
         return {
             'total': total,
@@ -500,6 +1723,10 @@ class Analytics:
             'avg_per_user': round(avg_per_user, 1),
             'avg_per_free_user': round(avg_per_free_user, 1),
             'avg_per_premium_user': round(avg_per_premium_user, 1),
+            'by_segment': [
+                {'language': r[0], 'premium': bool(r[1]), 'users': r[2], 'avg_messages': round(r[3], 1)}
+                for r in by_segment
+            ],
             'distribution': [{'bucket': r[0], 'users': r[1]} for r in distribution],
             'avg_tokens': round(avg_tokens, 1),
             'models': [{'name': r[0], 'count': r[1]} for r in models],
@@ -510,7 +1737,7 @@ class Analytics:
     
     def get_character_analytics(self) -> dict:
         """Аналитика персонажей"""
-        cur = self.conn.cursor()
+        cur = self._cursor('characters')
         
         # Топ персонажей
         top_characters = cur.execute("""
@@ -519,9 +1746,9 @@ class Analytics:
                    COALESCE(c.created_by, 0) as is_ugc
             FROM characters c
             WHERE c.is_active = 1
-            ORDER BY c.messages_count DESC
+            ORDER BY c.messages_count DESC, c.id
             LIMIT 20
-        """).fetchall()
+        """, metric='top_characters').fetchall()
         
         # A/B тестирование по версии промпта
         ab_test = cur.execute("""
@@ -530,11 +1757,12 @@ class Analytics:
                 COUNT(DISTINCT c.id) as characters,
                 SUM(c.messages_count) as total_messages,
                 SUM(c.unique_users_count) as total_users,
-                AVG(CAST(c.messages_count AS FLOAT) / NULLIF(c.unique_users_count, 0)) as avg_msgs_per_user
+                AVG(CAST(c.messages_count AS DOUBLE) / NULLIF(c.unique_users_count, 0)) as avg_msgs_per_user
             FROM characters c
             WHERE c.is_active = 1 AND c.driver_prompt_version IS NOT NULL
             GROUP BY c.driver_prompt_version
-        """).fetchall()
+            ORDER BY c.driver_prompt_version
+        """, metric='ab_test').fetchall()
         
         # Рейтинги
         ratings = cur.execute("""
@@ -547,7 +1775,8 @@ class Analytics:
             JOIN characters c ON c.id = cr.character_id
             WHERE c.driver_prompt_version IS NOT NULL
             GROUP BY c.driver_prompt_version
-        """).fetchall()
+            ORDER BY c.driver_prompt_version
+        """, metric='ratings').fetchall()
         
         # UGC vs Official
         ugc_stats = cur.execute("""
@@ -559,7 +1788,19 @@ class Analytics:
             FROM characters
             WHERE is_active = 1
             GROUP BY type
-        """).fetchall()
+            ORDER BY type
+        """, metric='ugc_stats').fetchall()
+        
+        # Самые активные персонажи за окно (window_days дней до as_of)
+        top_recent = cur.execute("""
+            SELECT s.character_id, c.name, SUM(s.messages) as messages, MAX(s.active_users) as peak_daily_users
+            FROM character_daily_stats s
+            LEFT JOIN characters c ON c.id = s.character_id
+            WHERE s.day >= :from_date AND s.day < :to_date
+            GROUP BY s.character_id, c.name
+            ORDER BY messages DESC, s.character_id
+            LIMIT 10
+        """, self._window, metric='top_recent').fetchall()
         
         # Emotional state distribution по версии промпта
         emotional_by_version = cur.execute("""
@@ -572,7 +1813,8 @@ class Analytics:
             JOIN characters c ON c.id = ucs.character_id
             WHERE c.driver_prompt_version IS NOT NULL
             GROUP BY c.driver_prompt_version
-        """).fetchall()
+            ORDER BY c.driver_prompt_version
+        """, metric='emotional_by_version').fetchall()
         
         return {
             'top_characters': [
@@ -597,6 +1839,10 @@ class Analytics:
                 {'type': r[0], 'count': r[1], 'messages': r[2], 'users': r[3]}
                 for r in ugc_stats
             ],
+            'top_recent': [
+                {'id': r[0], 'name': r[1], 'messages': r[2], 'peak_daily_users': r[3]}
+                for r in top_recent
+            ],
             'emotional_by_version': [
                 {
                     'version': r[0], 
@@ -609,29 +1855,27 @@ class Analytics:
     
     def get_financial_analytics(self) -> dict:
         """Финансовая аналитика"""
-        cur = self.conn.cursor()
+        cur = self._cursor('financial')
         
-        total_users = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        total_users = cur.execute("SELECT COUNT(*) FROM users", metric='total_users').fetchone()[0]
         
         # Общий доход
         total_revenue = cur.execute("""
-            SELECT COALESCE(SUM(amount_stars), 0) FROM payments WHERE status = 'success'
-        """).fetchone()[0]
+            SELECT COALESCE(SUM(revenue), 0) FROM daily_revenue WHERE status = 'success'
+        """, metric='total_revenue').fetchone()[0]
         
         # Количество платящих
-        paying_users = cur.execute("""
-            SELECT COUNT(DISTINCT user_id) FROM payments WHERE status = 'success'
-        """).fetchone()[0]
+        paying_users = cur.execute("SELECT COUNT(*) FROM user_revenue", metric='paying_users').fetchone()[0]
         
         # По тарифам
         by_tier = cur.execute("""
             SELECT COALESCE(tier, 'unknown') as tier, 
-                   COUNT(*) as count, 
-                   SUM(amount_stars) as revenue
-            FROM payments 
+                   SUM(payments) as count, 
+                   SUM(revenue) as revenue
+            FROM daily_revenue 
             WHERE status = 'success'
-            GROUP BY tier ORDER BY revenue DESC
-        """).fetchall()
+            GROUP BY 1 ORDER BY revenue DESC, tier
+        """, metric='by_tier').fetchall()
         
         # ARPU / ARPPU
         arpu = total_revenue / total_users if total_users else 0
@@ -643,20 +1887,21 @@ class Analytics:
         # Активные подписки
         active_subs = cur.execute("""
             SELECT COUNT(*) FROM subscriptions WHERE status = 'active'
-        """).fetchone()[0]
+        """, metric='active_subscriptions').fetchone()[0]
         
         # Статусы платежей
         payment_statuses = cur.execute("""
-            SELECT status, COUNT(*) as cnt FROM payments GROUP BY status
-        """).fetchall()
+            SELECT status, SUM(payments) as cnt FROM daily_revenue GROUP BY status ORDER BY status NULLS FIRST
+        """, metric='payment_statuses').fetchall()
         
-        # Доход по дням
+        # Доход по дням (window_days дней до as_of)
         revenue_by_day = cur.execute("""
-            SELECT DATE(created_at) as day, SUM(amount_stars) as revenue
-            FROM payments 
-            WHERE status = 'success' AND created_at >= DATE('now', '-30 days')
+            SELECT day, SUM(revenue) as revenue
+            FROM daily_revenue 
+            WHERE status = 'success'
+              AND day >= :from_date AND day < :to_date
             GROUP BY day ORDER BY day
-        """).fetchall()
+        """, self._window, metric='revenue_by_day').fetchall()
         
         return {
             'total_revenue': total_revenue,
@@ -672,42 +1917,40 @@ class Analytics:
     
     def get_referral_analytics(self) -> dict:
         """Аналитика рефералов"""
-        cur = self.conn.cursor()
+        cur = self._cursor('referrals')
         
         # Всего рефералов
         total_referred = cur.execute("""
             SELECT COUNT(*) FROM users WHERE referred_by IS NOT NULL
-        """).fetchone()[0]
+        """, metric='total_referred').fetchone()[0]
         
         # Активные рефереры
         active_referrers = cur.execute("""
             SELECT COUNT(DISTINCT referred_by) FROM users WHERE referred_by IS NOT NULL
-        """).fetchone()[0]
+        """, metric='active_referrers').fetchone()[0]
         
         # Топ рефереров
         top_referrers = cur.execute("""
             SELECT u.id, u.username, u.nickname, COUNT(r.id) as referrals
             FROM users u
             JOIN users r ON r.referred_by = u.id
-            GROUP BY u.id
-            ORDER BY referrals DESC
+            GROUP BY u.id, u.username, u.nickname
+            ORDER BY referrals DESC, u.id
             LIMIT 10
-        """).fetchall()
+        """, metric='top_referrers').fetchall()
         
         # Награды
         rewards = cur.execute("""
             SELECT reward_type, COUNT(*) as count, SUM(messages_awarded) as messages
             FROM referral_rewards
             GROUP BY reward_type
-        """).fetchall()
+            ORDER BY reward_type NULLS FIRST
+        """, metric='rewards').fetchall()
         
         # Конверсия рефералов в платящих
         referred_paying = cur.execute("""
-            SELECT COUNT(DISTINCT u.id) 
-            FROM users u
-            JOIN payments p ON p.user_id = u.id
-            WHERE u.referred_by IS NOT NULL AND p.status = 'success'
-        """).fetchone()[0]
+            SELECT COUNT(*) FROM user_segments WHERE is_referred = 1 AND is_paying = 1
+        """, metric='referred_paying').fetchone()[0]
         
         return {
             'total_referred': total_referred,
@@ -722,48 +1965,43 @@ class Analytics:
         }
     
     def get_retention_analytics(self) -> dict:
-        """Аналитика retention"""
-        cur = self.conn.cursor()
-        
-        # Когорты по неделям регистрации
-        cohorts = cur.execute("""
-            SELECT 
-                strftime('%Y-%W', created_at) as cohort_week,
-                COUNT(*) as users,
-                SUM(CASE WHEN active_days_count >= 1 THEN 1 ELSE 0 END) as d1,
-                SUM(CASE WHEN active_days_count >= 7 THEN 1 ELSE 0 END) as d7,
-                SUM(CASE WHEN active_days_count >= 30 THEN 1 ELSE 0 END) as d30
-            FROM users
-            GROUP BY cohort_week
-            ORDER BY cohort_week DESC
-            LIMIT 12
-        """).fetchall()
-        
-        # Среднее active_days
-        avg_active_days = cur.execute("""
-            SELECT AVG(active_days_count) FROM users WHERE active_days_count > 0
-        """).fetchone()[0] or 0
-        
-        return {
-            'cohorts': [
-                {
-                    'week': r[0], 'users': r[1],
-                    'd1': r[2], 'd1_pct': round(r[2] / r[1] * 100, 1) if r[1] else 0,
-                    'd7': r[3], 'd7_pct': round(r[3] / r[1] * 100, 1) if r[1] else 0,
-                    'd30': r[4], 'd30_pct': round(r[4] / r[1] * 100, 1) if r[1] else 0
-                } for r in cohorts
-            ],
-            'avg_active_days': round(avg_active_days, 1)
-        }
+        """Аналитика retention: когорты по неделе первой активности и кривая по дням"""
+        with METRICS.timer('retention', 'cohorts'):
+            return retention(self.conn, self._window['as_of_day'])
+    
+    def get_section(self, name: str) -> tuple[dict, float]:
+        """Один раздел аналитики и время его расчета в секундах"""
+        started = time.perf_counter()
+        result = getattr(self, SECTIONS[name])()
+        seconds = time.perf_counter() - started
+        METRICS.observe_section(name, seconds)
+        return result, round(seconds, 4)
     
     def get_all_analytics(self) -> dict:
-        """Получить всю аналитику"""
-        return {
-            'overview': self.get_overview(),
-            'users': self.get_user_analytics(),
-            'messages': self.get_message_analytics(),
-            'characters': self.get_character_analytics(),
-            'financial': self.get_financial_analytics(),
-            'referrals': self.get_referral_analytics(),
-            'retention': self.get_retention_analytics()
-        }
+        """Получить всю аналитику (разделы по очереди на одном соединении)"""
+        started = time.perf_counter()
+        sections = {name: self.get_section(name)[0] for name in SECTIONS}
+        METRICS.observe_section('all', time.perf_counter() - started)
+        return assemble_analytics(self.as_of, self.window_days, sections)
+
+
+# Разделы полной аналитики: {ключ в ответе: метод Analytics}.
+# Разделы независимы друг от друга и могут считаться параллельно.
+SECTIONS = {
+    'overview': 'get_overview',
+    'users': 'get_user_analytics',
+    'messages': 'get_message_analytics',
+    'characters': 'get_character_analytics',
+    'financial': 'get_financial_analytics',
+    'referrals': 'get_referral_analytics',
+    'retention': 'get_retention_analytics',
+}
+
+
+def assemble_analytics(as_of: str, window_days: int, sections: dict) -> dict:
+    """Собирает ответ get_all_analytics из {раздел: результат}.
+
+    Времена расчета в ответ не входят (он кешируется и сравнивается) -
+    они в METRICS: по разделам и 'all' для всей аналитики.
+    """
+    return {'as_of': as_of, 'window_days': window_days, **sections}
@@ -2,25 +2,76 @@
 Jani Analytics - FastAPI Server
 """
 import os
+import re
+import glob
+import gzip
 import json
+import time
+import uuid
+import hashlib
+import threading
+from contextlib import asynccontextmanager
+from datetime import date, datetime
 from pathlib import Path
-from datetime import datetime
+from typing import AsyncIterator, Callable, Optional
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
 import aiofiles
 
-from analytics import load_backup_to_sqlite, Analytics, UPLOADS_DIR
+from analytics import ANALYTICS_VERSION, SECTIONS, Analytics, SCHEMA_VERSION, UPLOADS_DIR
+from catalog import CATALOG
+from db import close_pool, get_pool, run_query, upgrade_db
+from diff import DIFF_LIMIT, diff_backups
+from jobs import claim_ingest, find_active_job, get_job as get_ingest_job, release_ingest, submit_ingest
+from metrics import METRICS
+from snapshots import CACHE as SNAPSHOT_CACHE, get_section_snapshot, get_snapshot
+from warehouse import TOP_CHARACTERS, WAREHOUSE
 
-app = FastAPI(title="Jani Analytics")
+
+def _prepare_backups():
+    """Обновляет БД бэкапов, загруженных старой версией, и дописывает их в хранилище трендов"""
+    backups = CATALOG.list_backups()
+    for backup in backups:
+        if Path(backup['db_path']).exists():
+            upgrade_db(Path(backup['db_path']))
+    WAREHOUSE.backfill(backups)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Старые БД обновляются в фоне: сервер отвечает сразу, а get_pool
+    обновит БД сам, если запрос придет раньше.
+
+    Побочные эффекты запуска - только здесь, а не на уровне модуля: процессы
+    разбора дампа (forkserver/spawn) заново импортируют app.py как __mp_main__.
+    """
+    CATALOG.import_legacy()
+    threading.Thread(target=_prepare_backups, name="prepare-backups", daemon=True).start()
+    yield
+
+
+app = FastAPI(title="Jani Analytics", lifespan=lifespan)
 
 # Статические файлы
 STATIC_DIR = Path(__file__).parent / "static"
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
-# Хранилище загруженных бэкапов
-BACKUPS: dict = {}  # {backup_id: {'name': str, 'path': Path, 'db_path': Path, 'uploaded_at': str}}
+# Процессов для разбора дампа при загрузке
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', os.cpu_count() or 1))
+
+# Загружать новый бэкап инкрементально поверх БД последнего загруженного
+INCREMENTAL_INGEST = os.getenv('INCREMENTAL_INGEST', '1') == '1'
+
+# Размер куска при записи загружаемого файла на диск
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Длина ID бэкапа - префикс sha256 содержимого
+BACKUP_ID_LENGTH = 16
+
+# Ответы аналитики меньше этого не сжимаются: gzip не окупается
+GZIP_MIN_BYTES = 1024
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -33,108 +84,246 @@ async def root():
     return "<h1>Jani Analytics</h1><p>Static files not found</p>"
 
 
+async def _save_upload(chunks: AsyncIterator[bytes], file_path: Path) -> tuple[str, int]:
+    """Пишет загрузку на диск кусками, возвращает (sha256, размер)"""
+    hasher = hashlib.sha256()
+    size = 0
+    async with aiofiles.open(file_path, 'wb') as f:
+        async for chunk in chunks:
+            hasher.update(chunk)
+            size += len(chunk)
+            await f.write(chunk)
+    return hasher.hexdigest(), size
+
+
+def _backup_files(backup_id: str) -> list[Path]:
+    """Все файлы бэкапа: дамп, .db и производные (backup_id - ID из каталога, в т.ч. legacy)"""
+    pattern = glob.escape(backup_id)
+    return list(UPLOADS_DIR.glob(f"{pattern}_*")) + list(UPLOADS_DIR.glob(f"{pattern}.*"))
+
+
+def _backup_info(backup: dict) -> dict:
+    """Запись каталога в ответе API"""
+    return {
+        'id': backup['id'],
+        'name': backup['name'],
+        'uploaded_at': backup['uploaded_at'],
+        'size': (backup['size'] or 0) + (backup['db_size'] or 0),
+        'row_counts': backup['row_counts'],
+        'ingest_seconds': backup['ingest_seconds'],
+        'schema_version': backup['schema_version'],
+        'base_id': backup['base_id']
+    }
+
+
+async def _ingest_upload(filename: str, chunks: AsyncIterator[bytes]) -> dict:
+    """Сохраняет загрузку и ставит ее разбор в очередь.
+
+    ID бэкапа - хеш содержимого: повторная загрузка того же дампа
+    не разбирается заново, а возвращает уже готовую БД.
+    """
+    # Сохраняем файл под временным именем, пока не знаем хеш
+    tmp_path = UPLOADS_DIR / f".upload_{uuid.uuid4().hex}.part"
+    try:
+        sha256, size = await _save_upload(chunks, tmp_path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    
+    backup_id = sha256[:BACKUP_ID_LENGTH]
+    db_path = UPLOADS_DIR / f"{backup_id}.db"
+    
+    # База инкрементальной загрузки - последний бэкап; не совпадет с дампом - загрузка пойдет целиком
+    base = CATALOG.latest() if INCREMENTAL_INGEST else None
+    base_db = Path(base['db_path']) if base and Path(base['db_path']).exists() else None
+    
+    # Такой дамп уже загружен или загружается (в любом воркере). Блокировка
+    # берется до проверки каталога: загрузка регистрирует бэкап до ее снятия
+    job = claim_ingest(backup_id, filename, base_db)
+    if job and CATALOG.get(backup_id):
+        release_ingest(job)
+        job = None
+    if job is None:
+        tmp_path.unlink(missing_ok=True)
+        existing = CATALOG.get(backup_id)
+        active_job = find_active_job(backup_id)
+        return {
+            "id": backup_id, "name": existing['name'] if existing else filename,
+            "job_id": active_job['id'] if active_job else None,
+            "sha256": sha256, "size": size, "deduplicated": True
+        }
+    
+    file_path = UPLOADS_DIR / f"{backup_id}_{filename}"
+    tmp_path.replace(file_path)
+    
+    # Парсим и загружаем в SQLite в фоне
+    def register(job):
+        # Сохраняем метаданные
+        CATALOG.add(
+            backup_id, job.name, db_path, sha256=sha256, dump_path=file_path, size=size,
+            row_counts=job.row_counts, ingest_seconds=round(time.time() - job.started_at, 2),
+            schema_version=SCHEMA_VERSION, base_id=base['id'] if job.base_db else None
+        )
+    
+    submit_ingest(job, file_path, db_path, workers=INGEST_WORKERS, on_success=register)
+    
+    return {
+        "id": backup_id, "name": filename, "job_id": job.id,
+        "sha256": sha256, "size": size, "deduplicated": False
+    }
+
+
 @app.post("/api/upload")
 async def upload_backup(file: UploadFile = File(...)):
-    """Загрузка бэкапа"""
+    """Загрузка бэкапа (multipart/form-data)"""
     if not file.filename:
         raise HTTPException(400, "No file provided")
     
-    # Генерируем ID
-    backup_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    async def chunks():
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
     
-    # Сохраняем файл
-    file_path = UPLOADS_DIR / f"{backup_id}_{file.filename}"
-    async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        await f.write(content)
-    
-    # Парсим и загружаем в SQLite
-    db_path = UPLOADS_DIR / f"{backup_id}.db"
-    try:
-        conn = load_backup_to_sqlite(file_path, db_path)
-        conn.close()
-    except Exception as e:
-        # Удаляем файлы при ошибке
-        file_path.unlink(missing_ok=True)
-        db_path.unlink(missing_ok=True)
-        raise HTTPException(400, f"Failed to parse backup: {str(e)}")
-    
-    # Сохраняем метаданные
-    BACKUPS[backup_id] = {
-        'name': file.filename,
-        'path': file_path,
-        'db_path': db_path,
-        'uploaded_at': datetime.now().isoformat()
-    }
+    return await _ingest_upload(Path(file.filename).name, chunks())
+
+
+@app.post("/api/upload/raw")
+async def upload_backup_raw(request: Request, filename: str):
+    """Загрузка бэкапа телом запроса.
+
+    В отличие от multipart, тело не буферизуется во временный файл
+    целиком: куски пишутся на диск по мере поступления.
+    """
+    filename = Path(filename).name
+    if not filename:
+        raise HTTPException(400, "No file provided")
     
-    return {"id": backup_id, "name": file.filename}
+    return await _ingest_upload(filename, request.stream())
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Статус фоновой загрузки бэкапа"""
+    job = get_ingest_job(job_id)
+    if not job:
+        raise HTTPException(404, "Job not found")
+    return job
 
 
 @app.get("/api/backups")
 async def list_backups():
     """Список загруженных бэкапов"""
-    # Также ищем существующие DB файлы
-    result = []
-    for db_file in UPLOADS_DIR.glob("*.db"):
-        backup_id = db_file.stem
-        if backup_id in BACKUPS:
-            result.append({
-                'id': backup_id,
-                'name': BACKUPS[backup_id]['name'],
-                'uploaded_at': BACKUPS[backup_id]['uploaded_at']
-            })
-        else:
-            result.append({
-                'id': backup_id,
-                'name': backup_id,
-                'uploaded_at': datetime.fromtimestamp(db_file.stat().st_mtime).isoformat()
-            })
-    
-    return sorted(result, key=lambda x: x['uploaded_at'], reverse=True)
+    return [_backup_info(b) for b in CATALOG.list_backups()]
+
+
+@app.get("/api/storage")
+async def storage_usage():
+    """Место на диске: по бэкапам и всего в UPLOADS_DIR"""
+    backups = {b['id']: _backup_info(b)['size'] for b in CATALOG.list_backups()}
+    total = sum(f.stat().st_size for f in UPLOADS_DIR.iterdir() if f.is_file())
+    return {'backups': backups, 'total': total}
+
+
+def _parse_as_of(as_of: Optional[str]) -> Optional[str]:
+    """Проверяет as_of из запроса и приводит к 'YYYY-MM-DD HH:MM:SS'"""
+    if not as_of:
+        return None
+    try:
+        return datetime.fromisoformat(as_of).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise HTTPException(400, "as_of must be an ISO date or datetime")
+
+
+def _analytics_etag(backup_id: str, as_of: Optional[str], section: str = 'all') -> str:
+    """Сильный ETag ответа аналитики.
+
+    ID бэкапа - хеш дампа, а БД бэкапа не меняется, поэтому ответ
+    определяется ID, версией кода аналитики, разделом и as_of.
+    """
+    as_of_tag = re.sub(r'\D', '', as_of) if as_of else 'dump'
+    return f'"{backup_id}.v{ANALYTICS_VERSION}.{section}.{as_of_tag}"'
+
+
+async def _analytics_response(request: Request, etag: str, compute: Callable[[], bytes]) -> Response:
+    """Ответ с JSON аналитики: 304 по If-None-Match, gzip для больших ответов.
+
+    Сжатое представление отличается от несжатого, поэтому у него свой
+    сильный ETag (с суффиксом -gzip). compute выполняется в пуле запросов,
+    его время - в заголовке Server-Timing.
+    """
+    gzip_etag = etag[:-1] + '-gzip"'
+    headers = {'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+    # If-None-Match сравнивается слабо: префикс W/ не учитывается
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        for tag in (etag, gzip_etag):
+            if tag in tags or '*' in tags:
+                return Response(status_code=304, headers={**headers, 'ETag': tag})
+
+    started = time.perf_counter()
+    data = await run_query(compute)
+    headers['Server-Timing'] = f'analytics;dur={(time.perf_counter() - started) * 1000:.1f}'
+    if len(data) >= GZIP_MIN_BYTES and 'gzip' in request.headers.get('accept-encoding', ''):
+        data = await run_query(gzip.compress, data, 6)
+        headers.update({'ETag': gzip_etag, 'Content-Encoding': 'gzip'})
+    else:
+        headers['ETag'] = etag
+    return Response(data, media_type="application/json", headers=headers)
 
 
 @app.get("/api/analytics/{backup_id}")
-async def get_analytics(backup_id: str):
-    """Получить аналитику по бэкапу"""
+async def get_analytics(request: Request, backup_id: str, as_of: Optional[str] = None):
+    """Получить аналитику по бэкапу (из сохраненного снимка).
+
+    as_of - момент, от которого считаются окна DAU/WAU/MAU и графики
+    по дням; по умолчанию - время снятия дампа.
+    """
     db_path = UPLOADS_DIR / f"{backup_id}.db"
     if not db_path.exists():
         raise HTTPException(404, "Backup not found")
     
-    import sqlite3
-    conn = sqlite3.connect(str(db_path))
-    conn.row_factory = sqlite3.Row
-    
-    analytics = Analytics(conn)
-    result = analytics.get_all_analytics()
-    conn.close()
+    as_of = _parse_as_of(as_of)
+    return await _analytics_response(
+        request, _analytics_etag(backup_id, as_of), lambda: get_snapshot(backup_id, db_path, as_of)
+    )
+
+
+@app.get("/api/analytics/{backup_id}/{section}")
+async def get_analytics_section(request: Request, backup_id: str, section: str, as_of: Optional[str] = None):
+    """Один раздел аналитики (overview, users, ...): считается только он.
+
+    Дашборд загружает разделы по мере открытия вкладок.
+    """
+    if section not in SECTIONS:
+        raise HTTPException(404, f"Unknown section, expected one of: {', '.join(SECTIONS)}")
+    db_path = UPLOADS_DIR / f"{backup_id}.db"
+    if not db_path.exists():
+        raise HTTPException(404, "Backup not found")
     
-    return result
+    as_of = _parse_as_of(as_of)
+    return await _analytics_response(
+        request, _analytics_etag(backup_id, as_of, section),
+        lambda: get_section_snapshot(backup_id, db_path, section, as_of)
+    )
+
+
+def _compare_overviews(db_path1: Path, db_path2: Path) -> tuple[dict, dict]:
+    """Обзоры двух бэкапов (выполняется в пуле потоков запросов)"""
+    with get_pool(db_path1).connection() as conn1, get_pool(db_path2).connection() as conn2:
+        return Analytics(conn1).get_overview(), Analytics(conn2).get_overview()
 
 
 @app.get("/api/compare/{backup_id1}/{backup_id2}")
 async def compare_backups(backup_id1: str, backup_id2: str):
     """Сравнить два бэкапа"""
-    import sqlite3
-    
     db_path1 = UPLOADS_DIR / f"{backup_id1}.db"
     db_path2 = UPLOADS_DIR / f"{backup_id2}.db"
     
     if not db_path1.exists() or not db_path2.exists():
         raise HTTPException(404, "One or both backups not found")
     
-    conn1 = sqlite3.connect(str(db_path1))
-    conn2 = sqlite3.connect(str(db_path2))
-    conn1.row_factory = sqlite3.Row
-    conn2.row_factory = sqlite3.Row
-    
-    a1 = Analytics(conn1)
-    a2 = Analytics(conn2)
-    
-    ov1 = a1.get_overview()
-    ov2 = a2.get_overview()
-    
-    conn1.close()
-    conn2.close()
+    ov1, ov2 = await run_query(_compare_overviews, db_path1, db_path2)
     
     return {
         'backup1': {'id': backup_id1, **ov1},
@@ -149,17 +338,81 @@ async def compare_backups(backup_id1: str, backup_id2: str):
     }
 
 
+def _parse_date(value: Optional[str], name: str) -> Optional[str]:
+    """Проверяет дату из запроса и приводит к 'YYYY-MM-DD'"""
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value[:10]).isoformat()
+    except ValueError:
+        raise HTTPException(400, f"{name} must be an ISO date")
+
+
+@app.get("/api/trends")
+async def get_trends(date_from: Optional[str] = Query(None, alias='from'),
+                     date_to: Optional[str] = Query(None, alias='to'),
+                     backups: Optional[str] = None, characters: int = TOP_CHARACTERS):
+    """Тренды по всем загруженным бэкапам из хранилища (БД бэкапов не открываются).
+
+    from/to - диапазон дат: бэкапы, снятые в нем, и дневной ряд;
+    backups - ID через запятую для сравнения N бэкапов (вместо выборки по дате снятия).
+    """
+    backup_ids = [b for b in (backups or '').split(',') if b]
+    return await run_query(
+        WAREHOUSE.trends, _parse_date(date_from, 'from'), _parse_date(date_to, 'to'),
+        backup_ids, max(0, characters)
+    )
+
+
+@app.get("/api/diff/{backup_id1}/{backup_id2}")
+async def get_backup_diff(request: Request, backup_id1: str, backup_id2: str, limit: int = DIFF_LIMIT):
+    """Полное сравнение бэкапов: все метрики аналитики и изменения сущностей
+    (новые и ушедшие пользователи, персонажи, платежи, тарифы). backup_id2 - более поздний.
+    """
+    db_path1 = UPLOADS_DIR / f"{backup_id1}.db"
+    db_path2 = UPLOADS_DIR / f"{backup_id2}.db"
+    
+    if not db_path1.exists() or not db_path2.exists():
+        raise HTTPException(404, "One or both backups not found")
+    
+    limit = max(0, limit)
+    etag = f'"{backup_id1}-{backup_id2}.v{ANALYTICS_VERSION}.diff.{limit}"'
+    return await _analytics_response(request, etag, lambda: json.dumps(
+        diff_backups(backup_id1, db_path1, backup_id2, db_path2, limit), ensure_ascii=False
+    ).encode('utf-8'))
+
+
+@app.get("/api/debug/metrics")
+async def debug_metrics(format: str = 'json'):
+    """Метрики процесса: время запросов и разделов аналитики, фазы загрузки,
+    журнал медленных запросов с планами. format=prometheus - текстовый формат Prometheus
+    """
+    if format == 'prometheus':
+        return PlainTextResponse(METRICS.prometheus(), media_type="text/plain; version=0.0.4")
+    if format != 'json':
+        raise HTTPException(400, "format must be 'json' or 'prometheus'")
+    return METRICS.to_dict()
+
+
 @app.delete("/api/backups/{backup_id}")
-async def delete_backup(backup_id: str):
-    """Удалить бэкап"""
-    db_path = UPLOADS_DIR / f"{backup_id}.db"
+async def delete_backup(backup_id: str, keep_trends: bool = True):
+    """Удалить бэкап.
+
+    Выжимка бэкапа в хранилище трендов по умолчанию остается: история не теряется.
+    """
+    # Удаляются только бэкапы из каталога - и загруженные, и legacy (ID по имени .db)
+    if not CATALOG.get(backup_id):
+        raise HTTPException(404, "Backup not found")
     
-    # Удаляем все файлы с этим ID
-    for f in UPLOADS_DIR.glob(f"{backup_id}*"):
+    # Закрываем соединения к БД и удаляем все файлы с этим ID
+    close_pool(UPLOADS_DIR / f"{backup_id}.db")
+    for f in _backup_files(backup_id):
         f.unlink()
     
-    if backup_id in BACKUPS:
-        del BACKUPS[backup_id]
+    CATALOG.delete(backup_id)
+    SNAPSHOT_CACHE.evict(backup_id)
+    if not keep_trends:
+        WAREHOUSE.delete(backup_id)
     
     return {"status": "deleted"}
 
@@ -0,0 +1,437 @@
+"""
+Jani Analytics - бенчмарки загрузки дампов и запросов
+
+Дампы генерирует synthetic.py. suite - сводный прогон по масштабам с
+результатом в JSON, compare - сравнение двух таких JSON (например, до и
+после коммита) с ненулевым кодом выхода при регрессии.
+
+Примеры:
+    python bench.py suite --scales 10k,1m --output bench-results/new.json
+    python bench.py compare bench-results/old.json bench-results/new.json
+    python bench.py parallel --messages 500000 --max-workers 8
+    python bench.py tokenizer --messages 100000
+    python bench.py plans
+    python bench.py engines --messages 1000000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import analytics
+from analytics import (
+    INSERT_PATTERN, ROLLUPS, SECTIONS, Analytics, _open_dump, _split_values, get_ingest_phases, get_ingest_stats,
+    iter_dump_rows, iter_sql_statements, load_backup_to_sqlite, parse_value
+)
+from engines import DuckDBEngine, duckdb_path, export_to_duckdb
+from metrics import METRICS, explain
+from synthetic import write_dump
+
+# Масштабы suite: параметры synthetic.write_dump
+SCALES = {
+    '10k': {'users': 1_000, 'characters': 50, 'messages': 10_000},
+    '1m': {'users': 20_000, 'characters': 200, 'messages': 1_000_000},
+    '20m': {'users': 200_000, 'characters': 1_000, 'messages': 20_000_000},
+}
+
+# Метрики compare: (путь в результате масштаба, больше - лучше)
+COMPARED_METRICS = [
+    (('parse', 'mb_per_s'), True),
+    (('load', 'mb_per_s'), True),
+    (('load', 'rows_per_s'), True),
+    (('peak_rss_mb', 'parse'), False),
+    (('peak_rss_mb', 'load'), False),
+    (('queries', 'all_ms'), False),
+    *((('queries', f'{section}_ms'), False) for section in SECTIONS),
+]
+
+
+def _legacy_split_values(values_str: str) -> list:
+    """Посимвольный разборщик VALUES из первой версии analytics.py - эталон для сравнения"""
+    rows = []
+    for value_match in re.finditer(r"\(([^)]+)\)", values_str):
+        values = []
+        current = ""
+        in_quotes = False
+        for char in value_match.group(1):
+            if char == "'" and (not current or current[-1] != '\\'):
+                in_quotes = not in_quotes
+                current += char
+            elif char == ',' and not in_quotes:
+                values.append(parse_value(current))
+                current = ""
+            else:
+                current += char
+        if current:
+            values.append(parse_value(current))
+        rows.append(values)
+    return rows
+
+
+def bench_tokenizer(args):
+    """Пропускная способность разбора VALUES: токенизатор против старого посимвольного цикла"""
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = Path(tmp) / 'dump.insert.sql'
+        write_dump(dump, users=args.users, messages=args.messages, fmt='insert')
+        with open(dump, encoding='utf-8') as f:
+            values = [m.group(3) for m in map(INSERT_PATTERN.match, iter_sql_statements(f)) if m]
+    size_mb = sum(len(v.encode('utf-8')) for v in values) / 1024 / 1024
+    print(f"VALUES: {size_mb:.1f} MB in {len(values)} statements")
+
+    for name, split in (('legacy', _legacy_split_values), ('tokenizer', lambda v: list(_split_values(v)))):
+        started = time.perf_counter()
+        rows = sum(len(split(v)) for v in values)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<10} {elapsed:7.2f}s  {size_mb / elapsed:7.1f} MB/s  rows={rows}")
+
+
+def bench_parallel(args):
+    """Масштабирование load_backup_to_sqlite по числу процессов"""
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = Path(tmp) / f'dump.{args.format}.sql'
+        write_dump(dump, users=args.users, messages=args.messages, fmt=args.format)
+        size_mb = dump.stat().st_size / 1024 / 1024
+        print(f"dump: {size_mb:.1f} MB, {args.messages} messages, format={args.format}, cpus={os.cpu_count()}")
+
+        baseline = None
+        workers = 1
+        while workers <= args.max_workers:
+            started = time.perf_counter()
+            conn = load_backup_to_sqlite(dump, Path(tmp) / 'bench.db', workers=workers)
+            conn.close()
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            print(f"workers={workers:<3} {elapsed:7.2f}s  {size_mb / elapsed:7.1f} MB/s  "
+                  f"speedup x{baseline / elapsed:.2f}")
+            workers *= 2
+
+
+# Фрагмент, который должен быть в плане запроса: раздел.метрика Analytics или rollups.таблица build_rollups
+PLAN_CHECKS = {
+    'users.activity_today': 'INTEGER PRIMARY KEY',
+    'users.activity_by_day': 'INTEGER PRIMARY KEY',
+    'financial.active_subscriptions': 'COVERING INDEX idx_subscriptions_status_user',
+    'referrals.total_referred': 'COVERING INDEX idx_users_referred',
+    'referrals.active_referrers': 'COVERING INDEX idx_users_referred',
+    'referrals.top_referrers': 'COVERING INDEX idx_users_referred',
+    # При загрузке агрегаты строятся до индексов: один проход по payments без индекса
+    'rollups.user_revenue': 'SCAN payments',
+}
+
+# Таблицы истории: запросы Analytics их не читают, а из агрегатов dialogs читает только dialog_grain
+HISTORY_TABLE_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+(dialogs|payments)\b', re.IGNORECASE)
+
+# CREATE [TEMP] TABLE имя AS SELECT ... в build_rollups
+CREATE_AS_PATTERN = re.compile(r'\s*CREATE (?:TEMP )?TABLE (\w+) AS\s+(.*)', re.DOTALL)
+
+
+class _RollupPlanRecorder:
+    """Соединение для build_rollups: перед каждым CREATE TABLE ... AS снимает план его SELECT"""
+
+    def __init__(self, conn: sqlite3.Connection, plans: dict):
+        self.conn = conn
+        self.plans = plans
+
+    def execute(self, sql: str, *args):
+        match = CREATE_AS_PATTERN.match(sql)
+        if match:
+            self.plans[f'rollups.{match.group(1)}'] = (match.group(2), ' | '.join(explain(self.conn, match.group(2))))
+        return self.conn.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def load_with_rollup_plans(dump: Path, db_path: Path) -> tuple[sqlite3.Connection, dict]:
+    """Загрузка дампа с планами запросов build_rollups на момент их выполнения: {rollups.таблица: (sql, план)}"""
+    plans = {}
+    build_rollups = analytics.build_rollups
+    analytics.build_rollups = lambda conn: build_rollups(_RollupPlanRecorder(conn, plans))
+    try:
+        return load_backup_to_sqlite(dump, db_path), plans
+    finally:
+        analytics.build_rollups = build_rollups
+
+
+def analytics_plans(conn: sqlite3.Connection) -> dict:
+    """Планы всех запросов полной аналитики с SQL и параметрами Analytics: {раздел.метрика: (sql, план)}"""
+    plans = {}
+    observe_query = METRICS.observe_query
+
+    def observe_with_plan(section, metric, seconds, conn=None, sql=None, params=()):
+        observe_query(section, metric, seconds, conn, sql, params)
+        if sql is not None:
+            plans[f'{section}.{metric}'] = (sql, ' | '.join(explain(conn, sql, params)))
+
+    METRICS.observe_query = observe_with_plan
+    try:
+        Analytics(conn).get_all_analytics()
+    finally:
+        del METRICS.observe_query
+    return plans
+
+
+def plan_ok(name: str, sql: str, plan: str) -> bool:
+    """План есть в PLAN_CHECKS и содержит ожидаемое; иначе запрос не читает лишних таблиц истории"""
+    if name in PLAN_CHECKS:
+        return PLAN_CHECKS[name] in plan
+    history = set(HISTORY_TABLE_PATTERN.findall(sql))
+    if name.startswith('rollups.'):
+        return name == 'rollups.dialog_grain' or 'dialogs' not in history
+    return not history
+
+
+def bench_plans(args):
+    """Проверка EXPLAIN QUERY PLAN: запросы аналитики и агрегатов используют свои индексы"""
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = Path(tmp) / 'dump.copy.sql'
+        write_dump(dump, users=args.users, messages=args.messages)
+        conn, plans = load_with_rollup_plans(dump, Path(tmp) / 'plans.db')
+        plans.update(analytics_plans(conn))
+        conn.close()
+    for name, (sql, plan) in sorted(plans.items()):
+        ok = plan_ok(name, sql, plan)
+        failed += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {name:<32} {plan}")
+    if failed:
+        sys.exit(f"{failed} plan(s) without expected index or reading history tables")
+
+
+def bench_engines(args):
+    """Паритет и задержка разделов Analytics: SQLite против DuckDB"""
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = Path(tmp) / 'dump.copy.sql'
+        write_dump(dump, users=args.users, messages=args.messages)
+        db_path = Path(tmp) / 'engines.db'
+        load_backup_to_sqlite(dump, db_path).close()
+
+        sqlite_conn = sqlite3.connect(str(db_path))
+        started = time.perf_counter()
+        # Выгрузка сама сверяет полную аналитику с SQLite (parity_mismatches)
+        try:
+            export_to_duckdb(sqlite_conn, duckdb_path(db_path))
+        except ValueError as e:
+            sys.exit(f"engines returned different results: {e}")
+        print(f"messages={args.messages}  duckdb export with parity check {time.perf_counter() - started:.2f}s")
+        print("parity: OK")
+        engines = {'sqlite': sqlite_conn, 'duckdb': DuckDBEngine(duckdb_path(db_path))}
+
+        # Медиана времени раздела по повторам
+        print(f"{'section':<12} {'sqlite ms':>10} {'duckdb ms':>10}")
+        for section in SECTIONS:
+            timings = {
+                name: statistics.median(Analytics(conn).get_section(section)[1] for _ in range(args.repeat))
+                for name, conn in engines.items()
+            }
+            print(f"{section:<12} {timings['sqlite'] * 1000:10.1f} {timings['duckdb'] * 1000:10.1f}")
+
+        for conn in engines.values():
+            conn.close()
+
+
+def _peak_rss_mb() -> float:
+    """Пиковый RSS процесса и его дочерних (процессы разбора) в МБ"""
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    return round(peak_kb / 1024, 1)
+
+
+def _measure_scale(dump: Path, db_path: Path, workers: int, repeat: int) -> dict:
+    """Разбор, загрузка и запросы одного дампа (в отдельном процессе - ради честного пикового RSS)"""
+    size_mb = dump.stat().st_size / 1024 / 1024
+
+    # Потоковый разбор без записи (то же, что parse_sql_dump, но без дампа в памяти)
+    started = time.perf_counter()
+    with _open_dump(dump) as f:
+        parsed = sum(1 for _ in iter_dump_rows(f))
+    parse_seconds = time.perf_counter() - started
+    rss_parse = _peak_rss_mb()
+
+    started = time.perf_counter()
+    conn = load_backup_to_sqlite(dump, db_path, workers=workers)
+    load_seconds = time.perf_counter() - started
+    inserted = sum(stats['inserted'] for stats in get_ingest_stats(conn).values())
+    phases = get_ingest_phases(conn)
+    rss_load = _peak_rss_mb()
+    conn.close()
+
+    # Запросы - как в API: на соединении только для чтения
+    conn = sqlite3.connect(f"file:{db_path.resolve()}?mode=ro", uri=True)
+    queries = {
+        f'{section}_ms': round(statistics.median(
+            Analytics(conn).get_section(section)[1] for _ in range(repeat)
+        ) * 1000, 2)
+        for section in SECTIONS
+    }
+    all_seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        Analytics(conn).get_all_analytics()
+        all_seconds.append(time.perf_counter() - started)
+    queries['all_ms'] = round(statistics.median(all_seconds) * 1000, 2)
+    conn.close()
+
+    return {
+        'parse': {'seconds': round(parse_seconds, 3), 'mb_per_s': round(size_mb / parse_seconds, 2),
+                  'rows': parsed, 'rows_per_s': round(parsed / parse_seconds)},
+        'load': {'seconds': round(load_seconds, 3), 'mb_per_s': round(size_mb / load_seconds, 2),
+                 'rows': inserted, 'rows_per_s': round(inserted / load_seconds), 'workers': workers,
+                 'phases': phases},
+        'queries': queries,
+        'peak_rss_mb': {'parse': rss_parse, 'load': rss_load, 'queries': _peak_rss_mb()},
+    }
+
+
+def _measure_scale_worker(queue, *args):
+    queue.put(_measure_scale(*args))
+
+
+def _git_revision() -> dict:
+    """Коммит, на котором снят результат (если запущено из git)"""
+    def git(*args) -> str:
+        return subprocess.run(
+            ['git', *args], cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    try:
+        return {'commit': git('rev-parse', '--short', 'HEAD'), 'dirty': bool(git('status', '--porcelain'))}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def bench_suite(args):
+    """Сводный прогон по масштабам: MB/s разбора, rows/s загрузки, пиковый RSS, задержка разделов -> JSON"""
+    result = {
+        **_git_revision(),
+        'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'cpus': os.cpu_count(),
+        'format': args.format,
+        'scales': {},
+    }
+    # spawn: дочерний процесс не наследует память родителя и генератора
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp:
+        for scale in args.scales:
+            params = SCALES[scale]
+            dump = Path(tmp) / f'{scale}.{args.format}.sql'
+            started = time.perf_counter()
+            rows = write_dump(dump, fmt=args.format, **params)
+            generate_seconds = time.perf_counter() - started
+            dump_bytes = dump.stat().st_size
+            print(f"[{scale}] dump {dump_bytes / 1024 / 1024:.1f} MB, generated in {generate_seconds:.1f}s")
+
+            queue = ctx.Queue()
+            process = ctx.Process(
+                target=_measure_scale_worker, args=(queue, dump, Path(tmp) / f'{scale}.db', args.workers, args.repeat)
+            )
+            process.start()
+            measured = queue.get()
+            process.join()
+            dump.unlink()
+            Path(tmp, f'{scale}.db').unlink(missing_ok=True)
+
+            result['scales'][scale] = {
+                'params': params, 'dump': {'bytes': dump_bytes, 'rows': rows}, **measured
+            }
+            parse, load, rss = measured['parse'], measured['load'], measured['peak_rss_mb']
+            print(f"[{scale}] parse {parse['mb_per_s']:.1f} MB/s  load {load['rows_per_s']:,} rows/s "
+                  f"({load['seconds']:.1f}s)  peak RSS {rss['load']:.0f} MB  all sections "
+                  f"{measured['queries']['all_ms']:.0f} ms")
+
+    output = Path(args.output or Path(__file__).parent / 'bench-results' / f"{result['commit'] or 'local'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2, ensure_ascii=False))
+    print(f"saved {output}")
+
+
+def bench_compare(args):
+    """Сравнение двух результатов suite: изменение метрик и регрессии сверх порога"""
+    base, new = (json.loads(Path(p).read_text()) for p in (args.base, args.new))
+    print(f"base {base.get('commit')} ({base.get('created_at')})  ->  "
+          f"new {new.get('commit')} ({new.get('created_at')})")
+    regressions = 0
+    for scale in new['scales']:
+        if scale not in base['scales']:
+            continue
+        print(f"\n[{scale}]")
+        for path, higher_is_better in COMPARED_METRICS:
+            old_value, new_value = base['scales'][scale], new['scales'][scale]
+            for key in path:
+                old_value, new_value = (old_value or {}).get(key), (new_value or {}).get(key)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = -change if higher_is_better else change
+            regressed = worse > args.threshold
+            regressions += regressed
+            print(f"{'REGRESSION' if regressed else '':<10} {'.'.join(path):<24} "
+                  f"{old_value:>12,.2f} {new_value:>12,.2f} {change * 100:+7.1f}%")
+    if regressions:
+        sys.exit(f"{regressions} metric(s) regressed by more than {args.threshold:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('parallel', help=bench_parallel.__doc__)
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--messages', type=int, default=200_000)
+    p.add_argument('--format', choices=['copy', 'insert'], default='insert')
+    p.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    p.set_defaults(func=bench_parallel)
+
+    p = sub.add_parser('tokenizer', help=bench_tokenizer.__doc__)
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--messages', type=int, default=100_000)
+    p.set_defaults(func=bench_tokenizer)
+
+    p = sub.add_parser('plans', help=bench_plans.__doc__)
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--messages', type=int, default=20_000)
+    p.set_defaults(func=bench_plans)
+
+    p = sub.add_parser('engines', help=bench_engines.__doc__)
+    p.add_argument('--users', type=int, default=10_000)
+    p.add_argument('--messages', type=int, default=200_000)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_engines)
+
+    p = sub.add_parser('suite', help=bench_suite.__doc__)
+    p.add_argument('--scales', type=lambda v: v.split(','), default=['10k', '1m'],
+                   help=f"через запятую из {', '.join(SCALES)}")
+    p.add_argument('--format', choices=['copy', 'insert'], default='copy')
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--tmp-dir', help="где держать дамп и БД (20m - десятки ГБ)")
+    p.add_argument('--output', help="JSON результата (по умолчанию bench-results/<commit>.json)")
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser('compare', help=bench_compare.__doc__)
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.2, help="допустимое ухудшение (доля)")
+    p.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    if args.command == 'suite' and set(args.scales) - set(SCALES):
+        parser.error(f"unknown scales: {', '.join(sorted(set(args.scales) - set(SCALES)))}")
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
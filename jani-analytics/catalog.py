@@ -0,0 +1,188 @@
+"""
+Jani Analytics - каталог загруженных бэкапов
+
+Метаданные бэкапов хранятся в SQLite рядом с загрузками, поэтому
+переживают рестарт и общие для всех воркеров uvicorn. Там же - состояние
+фоновых задач загрузки (см. jobs.py).
+"""
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional
+
+from analytics import UPLOADS_DIR
+
+# Не .db, чтобы не путать с БД бэкапов
+CATALOG_PATH = UPLOADS_DIR / "catalog.sqlite"
+
+# Незавершенные статусы задачи загрузки
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+
+class Catalog:
+    """Каталог бэкапов: одна строка на бэкап"""
+
+    def __init__(self, path: Path = CATALOG_PATH):
+        self.path = path
+        with self._connect() as conn:
+            # WAL: читатели из разных процессов не блокируют запись
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS backups (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    sha256 TEXT,
+                    dump_path TEXT,
+                    db_path TEXT NOT NULL,
+                    size INTEGER,
+                    db_size INTEGER,
+                    row_counts TEXT,
+                    ingest_seconds REAL,
+                    schema_version INTEGER,
+                    base_id TEXT,
+                    uploaded_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_backups_uploaded ON backups(uploaded_at);
+
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    backup_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    state TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                -- Блокировка загрузки: не больше одной незавершенной задачи на бэкап во всех воркерах
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active ON jobs(backup_id)
+                    WHERE status IN ('queued', 'running');
+                CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs(updated_at);
+            """)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        result = dict(row)
+        result['row_counts'] = json.loads(result['row_counts']) if result['row_counts'] else {}
+        return result
+
+    def add(self, backup_id: str, name: str, db_path: Path, sha256: Optional[str] = None,
+            dump_path: Optional[Path] = None, size: Optional[int] = None, row_counts: Optional[dict] = None,
+            ingest_seconds: Optional[float] = None, schema_version: Optional[int] = None,
+            base_id: Optional[str] = None, uploaded_at: Optional[str] = None):
+        """Регистрирует (или перезаписывает) бэкап"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    backup_id, name, sha256, str(dump_path) if dump_path else None, str(db_path),
+                    size, db_path.stat().st_size if db_path.exists() else None,
+                    json.dumps(row_counts or {}), ingest_seconds, schema_version, base_id,
+                    uploaded_at or datetime.now().isoformat()
+                )
+            )
+
+    def get(self, backup_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM backups WHERE id = ?", (backup_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list_backups(self) -> list[dict]:
+        """Бэкапы от новых к старым"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM backups ORDER BY uploaded_at DESC").fetchall()
+        return [self._to_dict(r) for r in rows]
+
+    def latest(self) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM backups ORDER BY uploaded_at DESC LIMIT 1").fetchone()
+        return self._to_dict(row) if row else None
+
+    def delete(self, backup_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM backups WHERE id = ?", (backup_id,))
+
+    def import_legacy(self, uploads_dir: Path = UPLOADS_DIR):
+        """Регистрирует .db, загруженные до появления каталога"""
+        known = {b["id"] for b in self.list_backups()}
+        for db_file in uploads_dir.glob("*.db"):
+            if db_file.stem in known:
+                continue
+            self.add(
+                db_file.stem, db_file.stem, db_file,
+                uploaded_at=datetime.fromtimestamp(db_file.stat().st_mtime).isoformat()
+            )
+
+    @staticmethod
+    def _job_to_dict(row: sqlite3.Row) -> dict:
+        return {**json.loads(row['state']), 'status': row['status'], 'error': row['error']}
+
+    @staticmethod
+    def _expire_jobs(conn: sqlite3.Connection, stale_seconds: float, ttl_seconds: float):
+        """Задачи без обновлений дольше stale_seconds - ошибка (воркер умер), завершенные старше TTL - удаляются"""
+        now = time.time()
+        conn.execute(
+            f"UPDATE jobs SET status = 'error', error = 'Ingest worker exited' "
+            f"WHERE status IN {ACTIVE_JOB_STATUSES} AND updated_at < ?",
+            (now - stale_seconds,)
+        )
+        conn.execute(
+            f"DELETE FROM jobs WHERE status NOT IN {ACTIVE_JOB_STATUSES} AND updated_at < ?",
+            (now - ttl_seconds,)
+        )
+
+    def claim_job(self, job_id: str, backup_id: str, state: dict,
+                  stale_seconds: float, ttl_seconds: float) -> bool:
+        """Регистрирует задачу загрузки; False, если бэкап уже загружается другой задачей"""
+        with self._connect() as conn:
+            self._expire_jobs(conn, stale_seconds, ttl_seconds)
+            try:
+                conn.execute(
+                    "INSERT INTO jobs VALUES (?, ?, 'queued', NULL, ?, ?)",
+                    (job_id, backup_id, json.dumps(state), time.time())
+                )
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def save_job(self, job_id: str, status: str, error: Optional[str], state: dict):
+        """Обновляет состояние задачи; updated_at - заодно отметка, что воркер жив"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, state = ?, updated_at = ? WHERE id = ?",
+                (status, error, json.dumps(state), time.time(), job_id)
+            )
+
+    def get_job(self, job_id: str, stale_seconds: float, ttl_seconds: float) -> Optional[dict]:
+        with self._connect() as conn:
+            self._expire_jobs(conn, stale_seconds, ttl_seconds)
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_to_dict(row) if row else None
+
+    def active_job(self, backup_id: str, stale_seconds: float, ttl_seconds: float) -> Optional[dict]:
+        """Незавершенная задача загрузки бэкапа (из любого воркера), если есть"""
+        with self._connect() as conn:
+            self._expire_jobs(conn, stale_seconds, ttl_seconds)
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE backup_id = ? AND status IN {ACTIVE_JOB_STATUSES}", (backup_id,)
+            ).fetchone()
+        return self._job_to_dict(row) if row else None
+
+    def delete_job(self, job_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+# Каталог загруженных бэкапов (общий для всех воркеров)
+CATALOG = Catalog()
@@ -0,0 +1,187 @@
+"""
+Jani Analytics - доступ к БД бэкапов на чтение
+
+БД загруженного бэкапа после загрузки не меняется, поэтому открывается
+только на чтение с immutable=1 (SQLite не берет блокировки и не
+проверяет изменения файла) и с mmap. Соединения переиспользуются через
+пул на каждый бэкап, а запросы выполняются в ограниченном пуле потоков,
+чтобы синхронный sqlite3 не блокировал event loop uvicorn.
+Разделы полной аналитики считаются параллельно, каждый на своем
+соединении: на время выполнения запроса sqlite3 отпускает GIL.
+Движок запросов (SQLite или DuckDB) выбирается ANALYTICS_ENGINE, см. engines.py.
+БД, загруженная старой версией, обновляется на копии, которая затем подменяет
+файл: другие процессы могут держать ее открытой с immutable=1.
+"""
+import asyncio
+import functools
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from analytics import Analytics, SECTIONS, assemble_analytics, backup_db_outdated, upgrade_backup_db
+from engines import ANALYTICS_ENGINE, DuckDBEngine, duckdb_path, export_to_duckdb
+from metrics import METRICS
+
+# Потоков для запросов к БД бэкапов (одновременно выполняемых запросов)
+QUERY_THREADS = int(os.getenv('QUERY_THREADS', 4))
+
+# Потоков для параллельного расчета разделов аналитики
+SECTION_THREADS = int(os.getenv('SECTION_THREADS', len(SECTIONS)))
+
+# Размер отображения БД в память на соединение
+MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=QUERY_THREADS, thread_name_prefix="query")
+# Отдельный пул: задачи QUERY_EXECUTOR ждут разделы, и общий пул мог бы заблокироваться
+SECTION_EXECUTOR = ThreadPoolExecutor(max_workers=SECTION_THREADS, thread_name_prefix="section")
+
+
+def open_readonly(db_path: Path) -> sqlite3.Connection:
+    """Открывает БД бэкапа только на чтение"""
+    conn = sqlite3.connect(
+        f"file:{db_path.resolve()}?mode=ro&immutable=1", uri=True, check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    return conn
+
+
+class ConnectionPool:
+    """Пул соединений на чтение к одной БД бэкапа.
+
+    Соединение не создается заранее: берется свободное или открывается новое.
+    Свободных держится не больше max_idle, лишние закрываются.
+    """
+
+    def __init__(self, db_path: Path, max_idle: int = QUERY_THREADS + SECTION_THREADS,
+                 opener: Callable = open_readonly):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.opener = opener
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self.opener(self.db_path)
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_POOLS: dict = {}  # {(путь к БД, движок): ConnectionPool}
+_POOLS_LOCK = threading.Lock()
+_UPGRADE_LOCKS: dict = {}  # {путь к БД: threading.Lock} - одно обновление БД за раз
+
+
+def upgrade_db(db_path: Path, engine: str = ANALYTICS_ENGINE):
+    """Обновляет БД, загруженную старой версией, и для DuckDB выгружает
+    недостающую или устаревшую копию таблиц.
+
+    Файл не меняется на месте: обновляется копия и атомарно подменяет его,
+    уже открытые соединения (в том числе других процессов) дочитывают старый.
+    """
+    with _POOLS_LOCK:
+        lock = _UPGRADE_LOCKS.setdefault(str(db_path), threading.Lock())
+    with lock:
+        conn = open_readonly(db_path)
+        try:
+            outdated = backup_db_outdated(conn)
+        finally:
+            conn.close()
+        if outdated:
+            tmp_path = db_path.with_name(f"{db_path.name}.upgrade-{os.getpid()}")
+            try:
+                shutil.copyfile(db_path, tmp_path)
+                conn = sqlite3.connect(str(tmp_path))
+                try:
+                    upgrade_backup_db(conn)
+                finally:
+                    conn.close()
+                tmp_path.replace(db_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+        if engine == 'duckdb' and (outdated or not duckdb_path(db_path).exists()):
+            conn = open_readonly(db_path)
+            try:
+                export_to_duckdb(conn, duckdb_path(db_path))
+            finally:
+                conn.close()
+
+
+def get_pool(db_path: Path, engine: str = ANALYTICS_ENGINE) -> ConnectionPool:
+    """Пул соединений к БД бэкапа (создается при первом обращении)"""
+    key = (str(db_path), engine)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+    if pool is not None:
+        return pool
+    # Обновление - под блокировкой своей БД, пулы остальных бэкапов не ждут
+    upgrade_db(db_path, engine)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            if engine == 'duckdb':
+                pool = ConnectionPool(duckdb_path(db_path), opener=DuckDBEngine)
+            else:
+                pool = ConnectionPool(db_path)
+            _POOLS[key] = pool
+        return pool
+
+
+def close_pool(db_path: Path):
+    """Закрывает соединения к БД бэкапа всех движков (перед удалением файлов)"""
+    with _POOLS_LOCK:
+        pools = [_POOLS.pop(key) for key in list(_POOLS) if key[0] == str(db_path)]
+    for pool in pools:
+        pool.close()
+
+
+def get_all_analytics_concurrent(db_path: Path, as_of: Optional[str] = None,
+                                 engine: str = ANALYTICS_ENGINE) -> dict:
+    """Полная аналитика бэкапа: разделы параллельно, каждый на своем соединении.
+
+    Время до готовности ответа - примерно время самого медленного раздела,
+    а не сумма; это время пишется в METRICS как раздел 'all'.
+    """
+    pool = get_pool(db_path, engine)
+
+    def run_section(name: str) -> tuple[dict, float]:
+        with pool.connection() as conn:
+            return Analytics(conn, as_of=as_of).get_section(name)
+
+    started = time.perf_counter()
+    futures = {name: SECTION_EXECUTOR.submit(run_section, name) for name in SECTIONS}
+    sections = {name: future.result()[0] for name, future in futures.items()}
+    METRICS.observe_section('all', time.perf_counter() - started)
+
+    with pool.connection() as conn:
+        analytics = Analytics(conn, as_of=as_of)
+    return assemble_analytics(analytics.as_of, analytics.window_days, sections)
+
+
+async def run_query(fn: Callable, *args):
+    """Выполняет синхронную fn(*args) в пуле потоков запросов"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(QUERY_EXECUTOR, functools.partial(fn, *args))
@@ -0,0 +1,244 @@
+"""
+Jani Analytics - сравнение двух бэкапов
+
+Метрики сравниваются по сохраненным снимкам аналитики (все числа,
+которые выдает Analytics), сущности - слиянием потоков, отсортированных
+по первичному ключу: users, payments и subscriptions читаются по rowid,
+активность - по user_activity (user_id - PRIMARY KEY), персонажи - по
+агрегату character_daily_stats. Dialogs не читаются, каждая БД
+просматривается один раз на своем соединении, без запросов между БД.
+"""
+import json
+from collections import Counter
+from datetime import date
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from db import get_pool
+from retention import MAU_DAYS
+from snapshots import get_snapshot
+
+# Сколько сущностей показывать в каждом списке (новые пользователи, персонажи и т.д.)
+DIFF_LIMIT = 20
+
+# Ключ элемента списка в снимке - его первое поле, кроме перечисленных здесь
+ITEM_KEYS = {
+    'messages.by_segment': ('language', 'premium'),
+}
+
+# Поля снимка, которые не метрики
+SKIPPED_FIELDS = ('as_of', 'window_days')
+
+
+def merge_join(left: Iterable[tuple], right: Iterable[tuple]) -> Iterator[tuple]:
+    """Слияние двух потоков строк, отсортированных по первому полю без повторов.
+
+    Выдает (ключ, строка слева или None, строка справа или None).
+    """
+    left, right = iter(left), iter(right)
+    a, b = next(left, None), next(right, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a[0], a, None
+            a = next(left, None)
+        elif a is None or b[0] < a[0]:
+            yield b[0], None, b
+            b = next(right, None)
+        else:
+            yield a[0], a, b
+            a, b = next(left, None), next(right, None)
+
+
+def _flatten(value, path: str, out: dict, items: set):
+    """Числовые листья снимка -> {путь: число}; ключи элементов списков -> items"""
+    if isinstance(value, dict):
+        for key, v in value.items():
+            _flatten(v, f'{path}.{key}' if path else key, out, items)
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            if not isinstance(item, dict):
+                _flatten(item, f'{path}[{i}]', out, items)
+                continue
+            fields = ITEM_KEYS.get(path, tuple(item)[:1])
+            item_path = f"{path}[{','.join(str(item.get(f)) for f in fields)}]"
+            items.add(item_path)
+            _flatten({k: v for k, v in item.items() if k not in fields}, item_path, out, items)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[path] = value
+
+
+def diff_metrics(a: dict, b: dict) -> dict:
+    """Разница всех числовых метрик двух снимков аналитики.
+
+    Элементы списков сопоставляются по ключу (дата, имя, версия...);
+    элементы, которые есть только в одном снимке, - в added/removed.
+    """
+    flat_a, flat_b, items_a, items_b = {}, {}, set(), set()
+    for name in a.keys() - set(SKIPPED_FIELDS):
+        _flatten(a[name], name, flat_a, items_a)
+    for name in b.keys() - set(SKIPPED_FIELDS):
+        _flatten(b[name], name, flat_b, items_b)
+
+    metrics = {}
+    for path in sorted(flat_a.keys() & flat_b.keys()):
+        va, vb = flat_a[path], flat_b[path]
+        metrics[path] = {
+            'a': va, 'b': vb, 'delta': round(vb - va, 4),
+            'pct': round((vb - va) / va * 100, 1) if va else None,
+        }
+    return {
+        'metrics': metrics,
+        'changed': sum(1 for m in metrics.values() if m['delta']),
+        'added': sorted(items_b - items_a),
+        'removed': sorted(items_a - items_b),
+    }
+
+
+def _users_diff(conn_a, conn_b, limit: int) -> dict:
+    """Новые и удаленные пользователи: слияние users по id"""
+    new, new_count, removed = [], 0, 0
+    for user_id, a, b in merge_join(
+        conn_a.execute("SELECT id FROM users ORDER BY id"),
+        conn_b.execute("SELECT id, username, created_at FROM users ORDER BY id"),
+    ):
+        if a is None:
+            new_count += 1
+            if len(new) < limit:
+                new.append({'id': user_id, 'username': b[1], 'created_at': b[2]})
+        elif b is None:
+            removed += 1
+    return {'new': new_count, 'removed': removed, 'new_sample': new}
+
+
+def _activity_diff(conn_a, conn_b, a_day: int, limit: int) -> dict:
+    """Ушедшие и вернувшиеся пользователи: слияние user_activity по user_id.
+
+    Ушедший - активен в последние MAU_DAYS дней бэкапа A и без активности
+    в B после дня A; вернувшийся - наоборот, неактивен в этом окне A,
+    но активен в B после дня A.
+    """
+    window_start = a_day - MAU_DAYS + 1
+    churned, churned_count, returned = [], 0, 0
+    for user_id, a, b in merge_join(
+        conn_a.execute("SELECT user_id, last_day FROM user_activity ORDER BY user_id"),
+        conn_b.execute("SELECT user_id, last_day FROM user_activity ORDER BY user_id"),
+    ):
+        active_in_a = a is not None and a[1] >= window_start
+        active_after_a = b is not None and b[1] > a_day
+        if active_in_a and not active_after_a:
+            churned_count += 1
+            if len(churned) < limit:
+                churned.append(user_id)
+        elif not active_in_a and active_after_a and a is not None:
+            returned += 1
+    return {'churned': churned_count, 'returned': returned, 'churned_sample': churned}
+
+
+def _characters_diff(conn_a, conn_b, limit: int) -> dict:
+    """Персонажи, больше всего набравшие и потерявшие сообщений: слияние агрегатов по character_id"""
+    query = """
+        SELECT character_id, SUM(messages) FROM character_daily_stats
+        WHERE character_id IS NOT NULL GROUP BY character_id ORDER BY character_id
+    """
+    deltas, new, removed = [], 0, 0
+    for character_id, a, b in merge_join(conn_a.execute(query), conn_b.execute(query)):
+        new += a is None
+        removed += b is None
+        deltas.append((character_id, a[1] if a else 0, b[1] if b else 0))
+    deltas.sort(key=lambda d: (d[2] - d[1], -d[0]))
+
+    gained = [d for d in reversed(deltas[-limit:]) if d[2] > d[1]]
+    lost = [d for d in deltas[:limit] if d[2] < d[1]]
+    ids = [d[0] for d in gained + lost]
+    names = dict(conn_b.execute(
+        f"SELECT id, name FROM characters WHERE id IN ({', '.join('?' * len(ids))})", ids
+    ).fetchall()) if ids else {}
+
+    def entry(d: tuple) -> dict:
+        return {'id': d[0], 'name': names.get(d[0]), 'messages_a': d[1], 'messages_b': d[2], 'delta': d[2] - d[1]}
+
+    return {'new': new, 'removed': removed, 'gained': [entry(d) for d in gained], 'lost': [entry(d) for d in lost]}
+
+
+def _payments_diff(conn_a, conn_b, limit: int) -> dict:
+    """Новые платежи и смены статуса: слияние payments по id"""
+    new, new_count, new_revenue, removed = [], 0, 0, 0
+    new_by_tier, transitions = Counter(), Counter()
+    for payment_id, a, b in merge_join(
+        conn_a.execute("SELECT id, status FROM payments ORDER BY id"),
+        conn_b.execute("SELECT id, status, user_id, amount_stars, tier, created_at FROM payments ORDER BY id"),
+    ):
+        if a is None:
+            new_count += 1
+            new_by_tier[b[4] or 'unknown'] += 1
+            if b[1] == 'success':
+                new_revenue += b[3] or 0
+            if len(new) < limit:
+                new.append({'id': payment_id, 'status': b[1], 'user_id': b[2], 'amount_stars': b[3],
+                            'tier': b[4], 'created_at': b[5]})
+        elif b is None:
+            removed += 1
+        elif a[1] != b[1]:
+            transitions[f'{a[1]} -> {b[1]}'] += 1
+    return {
+        'new': new_count, 'new_revenue': new_revenue, 'removed': removed,
+        'new_by_tier': dict(sorted(new_by_tier.items())),
+        'status_changes': dict(transitions.most_common()), 'new_sample': new,
+    }
+
+
+def _tiers_diff(conn_a, conn_b) -> dict:
+    """Смены по тарифам: успешные платежи и доход по тарифу, переходы статусов подписок"""
+    query = """
+        SELECT COALESCE(tier, 'unknown') AS tier, SUM(payments), SUM(revenue)
+        FROM daily_revenue WHERE status = 'success' GROUP BY 1 ORDER BY 1
+    """
+    tiers = []
+    for tier, a, b in merge_join(conn_a.execute(query), conn_b.execute(query)):
+        pa, ra = (a[1], a[2]) if a else (0, 0)
+        pb, rb = (b[1], b[2]) if b else (0, 0)
+        tiers.append({'tier': tier, 'payments_a': pa, 'payments_b': pb, 'payments_delta': pb - pa,
+                      'revenue_a': ra, 'revenue_b': rb, 'revenue_delta': rb - ra})
+
+    new, transitions = 0, Counter()
+    for _, a, b in merge_join(
+        conn_a.execute("SELECT id, status FROM subscriptions ORDER BY id"),
+        conn_b.execute("SELECT id, status FROM subscriptions ORDER BY id"),
+    ):
+        if a is None:
+            new += 1
+        elif b is not None and a[1] != b[1]:
+            transitions[f'{a[1]} -> {b[1]}'] += 1
+    return {
+        'by_tier': tiers,
+        'subscriptions': {'new': new, 'status_changes': dict(transitions.most_common())},
+    }
+
+
+def diff_backups(backup_a: str, db_path_a: Path, backup_b: str, db_path_b: Path,
+                 limit: int = DIFF_LIMIT) -> dict:
+    """Полное сравнение бэкапа A с бэкапом B: все метрики аналитики и изменения сущностей.
+
+    Ожидается, что B снят позже A: "новые" - есть только в B, "ушедшие" - активные в A.
+    """
+    snapshot_a = json.loads(get_snapshot(backup_a, db_path_a))
+    snapshot_b = json.loads(get_snapshot(backup_b, db_path_b))
+    # День as_of бэкапа A (номер дня от 1970-01-01, как в user_activity)
+    a_day = (date.fromisoformat(snapshot_a['as_of'][:10]) - date(1970, 1, 1)).days
+
+    # Сущности читаются из SQLite (PK-порядок по rowid) независимо от ANALYTICS_ENGINE
+    with get_pool(db_path_a, engine='sqlite').connection() as conn_a, \
+            get_pool(db_path_b, engine='sqlite').connection() as conn_b:
+        entities = {
+            'users': {**_users_diff(conn_a, conn_b, limit), **_activity_diff(conn_a, conn_b, a_day, limit)},
+            'characters': _characters_diff(conn_a, conn_b, limit),
+            'payments': _payments_diff(conn_a, conn_b, limit),
+            'tiers': _tiers_diff(conn_a, conn_b),
+        }
+
+    return {
+        'backup1': {'id': backup_a, 'as_of': snapshot_a['as_of']},
+        'backup2': {'id': backup_b, 'as_of': snapshot_b['as_of']},
+        **diff_metrics(snapshot_a, snapshot_b),
+        'entities': entities,
+    }
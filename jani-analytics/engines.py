@@ -0,0 +1,195 @@
+"""
+Jani Analytics - движки выполнения запросов Analytics
+
+Analytics работает с любым соединением, у которого есть
+cursor()/execute(sql, params) -> fetchone()/fetchall() как в sqlite3.
+По умолчанию это SQLite-БД бэкапа. Колоночный движок DuckDB
+(необязательная зависимость: pip install duckdb) читает копию таблиц,
+которые нужны Analytics, выгруженную при загрузке в {id}.duckdb.
+Запросы Analytics написаны на общем для обоих движков подмножестве SQL;
+каждая выгрузка сверяется с SQLite по полной аналитике (parity_mismatches).
+"""
+import csv
+import json
+import os
+import re
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from analytics import ACTIVITY_TABLES, ROLLUPS, SECTIONS, Analytics
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+ENGINES = ('sqlite', 'duckdb')
+
+# Движок для запросов Analytics в API
+ANALYTICS_ENGINE = os.getenv('ANALYTICS_ENGINE', 'sqlite')
+if ANALYTICS_ENGINE not in ENGINES:
+    raise ValueError(f"ANALYTICS_ENGINE must be one of {ENGINES}, got {ANALYTICS_ENGINE!r}")
+
+# Таблицы, которые читает Analytics: только они переносятся в DuckDB
+ENGINE_TABLES = (
+    'users', 'characters', 'subscriptions', 'character_ratings', 'user_character_state',
+    'referral_rewards', 'backup_meta', *ROLLUPS, *ACTIVITY_TABLES,
+)
+
+# :name (sqlite3) -> $name (DuckDB)
+NAMED_PARAM_PATTERN = re.compile(r'(?<![:\w]):(\w+)')
+
+# typeof() SQLite -> тип DuckDB (для колонок без объявленного типа, как в CREATE TABLE AS, и NUMERIC)
+SQLITE_TO_DUCKDB_TYPES = {'integer': 'BIGINT', 'real': 'DOUBLE', 'text': 'VARCHAR', 'blob': 'BLOB'}
+
+# Колонки без объявленного типа в пустых таблицах: агрегаты - BIGINT, кроме этих текстовых
+UNTYPED_TEXT_COLUMNS = ('day', 'language')
+
+# NULL в CSV выгрузки. Обратные слэши в тексте удваиваются: текст \N не совпадает с маркером
+NULL_MARKER = '\\N'
+
+
+def duckdb_path(db_path: Path) -> Path:
+    return db_path.with_suffix('.duckdb')
+
+
+def _require_duckdb():
+    if duckdb is None:
+        raise RuntimeError("DuckDB engine requires the duckdb package (pip install duckdb)")
+
+
+class DuckDBEngine:
+    """Соединение DuckDB с интерфейсом sqlite3, достаточным для Analytics"""
+
+    def __init__(self, path: Path):
+        _require_duckdb()
+        self.conn = duckdb.connect(str(path), read_only=True)
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql: str, params=()):
+        if isinstance(params, dict):
+            # DuckDB не принимает лишние именованные параметры
+            names = set(NAMED_PARAM_PATTERN.findall(sql))
+            sql = NAMED_PARAM_PATTERN.sub(r'$\1', sql)
+            params = {k: v for k, v in params.items() if k in names}
+        return self.conn.execute(sql, params)
+
+    def close(self):
+        self.conn.close()
+
+
+def _column_types(conn: sqlite3.Connection, table_name: str) -> list[tuple[str, str]]:
+    """[(колонка, тип DuckDB)]: по affinity объявленного типа, а без типа и для NUMERIC - по typeof() данных"""
+    columns = []
+    for _, name, declared, *_ in conn.execute(f"PRAGMA table_info({table_name})"):
+        # Порядок проверок - правила affinity SQLite
+        declared = declared.upper()
+        if 'INT' in declared:
+            duck_type = 'BIGINT'
+        elif any(t in declared for t in ('CHAR', 'CLOB', 'TEXT')):
+            duck_type = 'VARCHAR'
+        elif 'BLOB' in declared:
+            duck_type = 'BLOB'
+        elif any(t in declared for t in ('REAL', 'FLOA', 'DOUB')):
+            duck_type = 'DOUBLE'
+        else:
+            # NUMERIC (колонки дампа без CREATE TABLE) и без типа: целые и дробные могут смешиваться
+            types = {r[0] for r in conn.execute(
+                f"SELECT DISTINCT typeof({name}) FROM {table_name} WHERE {name} IS NOT NULL"
+            )}
+            if not types:
+                duck_type = 'VARCHAR' if name in UNTYPED_TEXT_COLUMNS else 'BIGINT'
+            elif len(types) == 1:
+                duck_type = SQLITE_TO_DUCKDB_TYPES.get(types.pop(), 'VARCHAR')
+            else:
+                duck_type = 'DOUBLE' if types == {'integer', 'real'} else 'VARCHAR'
+        columns.append((name, duck_type))
+    return columns
+
+
+def _write_csv(conn: sqlite3.Connection, table_name: str, columns: list, path: Path):
+    blobs = [i for i, (_, duck_type) in enumerate(columns) if duck_type == 'BLOB']
+    names = ', '.join(name for name, _ in columns)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([name for name, _ in columns])
+        for row in conn.execute(f"SELECT {names} FROM {table_name}"):
+            row = [NULL_MARKER if v is None else v.replace('\\', '\\\\') if isinstance(v, str) else v for v in row]
+            for i in blobs:
+                if row[i] is not NULL_MARKER:
+                    row[i] = bytes(row[i]).hex()
+            writer.writerow(row)
+
+
+def _csv_column(name: str, duck_type: str) -> str:
+    """Выражение DuckDB, восстанавливающее значение колонки из CSV _write_csv"""
+    if duck_type == 'BLOB':
+        return f"unhex({name})"
+    if duck_type == 'VARCHAR':
+        return f"replace({name}, '\\\\', '\\')"
+    return f"CAST({name} AS {duck_type})"
+
+
+def parity_mismatches(conn: sqlite3.Connection, duck) -> list[str]:
+    """Разделы полной аналитики, в которых SQLite и DuckDB дают разный результат"""
+    as_of = Analytics(conn).as_of
+    results = [
+        json.loads(json.dumps(Analytics(c, as_of=as_of).get_all_analytics(), default=str))
+        for c in (conn, duck)
+    ]
+    return [section for section in SECTIONS if results[0][section] != results[1][section]]
+
+
+def _export_tables(conn: sqlite3.Connection, path: Path):
+    """Переносит ENGINE_TABLES в новый файл DuckDB через CSV"""
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    duck = duckdb.connect(str(path))
+    try:
+        with tempfile.TemporaryDirectory(dir=path.parent) as tmp:
+            for table_name in ENGINE_TABLES:
+                if table_name not in existing:
+                    continue
+                columns = _column_types(conn, table_name)
+                csv_path = Path(tmp) / f"{table_name}.csv"
+                _write_csv(conn, table_name, columns, csv_path)
+                select = ', '.join(f"{_csv_column(name, duck_type)} AS {name}" for name, duck_type in columns)
+                try:
+                    duck.execute(f"""
+                        CREATE TABLE {table_name} AS SELECT {select}
+                        FROM read_csv('{csv_path}', header = true, all_varchar = true,
+                                      nullstr = '{NULL_MARKER}', quote = '"', escape = '"')
+                    """)
+                except duckdb.ConversionException as e:
+                    raise ValueError(f"DuckDB export of {table_name} failed: {e}") from e
+        duck.execute("CHECKPOINT")
+    finally:
+        duck.close()
+
+
+def export_to_duckdb(conn: sqlite3.Connection, path: Path):
+    """Выгружает ENGINE_TABLES из БД бэкапа в файл DuckDB.
+
+    Перенос через CSV: DuckDB читает его сам, без расширений и pandas.
+    Значения приводятся строгим CAST: значение, которое не приводится к типу
+    колонки, - ошибка выгрузки, а не NULL. Файл появляется по path, только
+    если полная аналитика по нему совпала с SQLite, иначе - ValueError.
+    """
+    _require_duckdb()
+    tmp_path = path.with_suffix('.duckdb.part')
+    tmp_path.unlink(missing_ok=True)
+    try:
+        _export_tables(conn, tmp_path)
+        engine = DuckDBEngine(tmp_path)
+        try:
+            mismatched = parity_mismatches(conn, engine)
+        finally:
+            engine.close()
+        if mismatched:
+            raise ValueError(f"DuckDB export differs from SQLite in sections: {', '.join(mismatched)}")
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    tmp_path.replace(path)
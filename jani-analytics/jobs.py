@@ -0,0 +1,215 @@
+"""
+Jani Analytics - фоновые задачи загрузки бэкапов
+
+Разбор дампа выполняется в пуле потоков (а при workers > 1 - еще и
+в пуле процессов внутри load_backup_to_sqlite), чтобы не блокировать
+event loop uvicorn. Прогресс задачи доступен через /api/jobs/{id}.
+
+Состояние задач хранится в каталоге (catalog.sqlite), поэтому видно из
+любого воркера uvicorn; там же блокировка "бэкап уже загружается".
+Живые задачи процесса раз в JOB_HEARTBEAT_SECONDS сохраняются фоновым
+потоком: задача без обновлений дольше JOB_STALE_SECONDS считается
+упавшей вместе со своим воркером и освобождает блокировку.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+from analytics import load_backup_to_sqlite, get_ingest_base, get_ingest_phases, get_ingest_stats, table_row_counts
+from catalog import CATALOG
+from engines import ANALYTICS_ENGINE, duckdb_path, export_to_duckdb
+from metrics import METRICS
+from snapshots import write_snapshot
+from warehouse import WAREHOUSE
+
+# Одновременно загружаемых бэкапов
+INGEST_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingest")
+
+# Как часто сохранять состояние живых задач процесса, секунд
+JOB_HEARTBEAT_SECONDS = 5
+
+# Незавершенная задача без обновлений дольше этого считается упавшей
+JOB_STALE_SECONDS = 60
+
+# Сколько хранить завершенные задачи
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', 24 * 3600))
+
+# Не чаще чем раз в столько секунд прогресс пишется в каталог
+JOB_SAVE_INTERVAL = 1.0
+
+_LOCAL_JOBS: dict = {}  # {job_id: IngestJob} - незавершенные задачи этого процесса
+_LOCAL_JOBS_LOCK = threading.Lock()
+_heartbeat_thread: Optional[threading.Thread] = None
+
+
+class IngestJob:
+    """Задача загрузки одного бэкапа в SQLite"""
+
+    def __init__(self, backup_id: str, name: str, base_db: Optional[Path] = None):
+        self.id = uuid.uuid4().hex
+        self.backup_id = backup_id
+        self.name = name
+        self.base_db = base_db
+        self.status = 'queued'  # queued -> running -> done | error
+        self.phase = None
+        self.error = None
+        self.bytes_read = 0
+        self.bytes_total = 0
+        self.rows = {}
+        self.ingest_stats = {}
+        self.phase_seconds = {}
+        self.row_counts = {}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.saved_at = 0.0
+
+    def save(self, force: bool = True):
+        """Пишет состояние в каталог; без force - не чаще JOB_SAVE_INTERVAL"""
+        now = time.time()
+        if not force and now - self.saved_at < JOB_SAVE_INTERVAL:
+            return
+        self.saved_at = now
+        CATALOG.save_job(self.id, self.status, self.error, self.to_dict())
+
+    def update(self, progress: dict):
+        """Колбэк прогресса для load_backup_to_sqlite"""
+        self.phase = progress['phase']
+        self.bytes_read = progress['bytes_read']
+        self.bytes_total = progress['bytes_total']
+        self.rows = progress['rows']
+        self.save(force=False)
+
+    def eta_seconds(self) -> Optional[float]:
+        """Оценка оставшегося времени по скорости чтения дампа"""
+        if self.status != 'running' or not self.bytes_read or not self.bytes_total:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed * (self.bytes_total - self.bytes_read) / self.bytes_read, 1)
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'backup_id': self.backup_id,
+            'name': self.name,
+            'status': self.status,
+            'incremental_from': self.base_db.stem if self.base_db else None,
+            'phase': self.phase,
+            'error': self.error,
+            'bytes_read': self.bytes_read,
+            'bytes_total': self.bytes_total,
+            'progress_pct': round(self.bytes_read / self.bytes_total * 100, 1) if self.bytes_total else 0,
+            'rows': self.rows,
+            'ingest_stats': self.ingest_stats,
+            'phase_seconds': self.phase_seconds,
+            'eta_seconds': self.eta_seconds(),
+            'elapsed_seconds': round((self.finished_at or time.time()) - self.started_at, 1) if self.started_at else 0,
+        }
+
+
+def _run_phase(job: IngestJob, phase: str, fn: Callable, *args):
+    """Фаза задачи после load_backup_to_sqlite: время пишется в job и METRICS"""
+    job.phase = phase
+    job.save()
+    started = time.perf_counter()
+    fn(*args)
+    job.phase_seconds[phase] = round(time.perf_counter() - started, 4)
+    METRICS.observe_ingest({phase: job.phase_seconds[phase]})
+
+
+def _run_ingest(job: IngestJob, file_path: Path, db_path: Path, workers: int, base_db: Optional[Path],
+                on_success: Optional[Callable[[IngestJob], None]]):
+    job.status = 'running'
+    job.started_at = time.time()
+    job.save()
+    # Пишем во временный файл, чтобы недогруженная БД не попала в /api/backups
+    part_path = db_path.with_suffix('.db.part')
+    try:
+        conn = load_backup_to_sqlite(file_path, part_path, workers=workers, progress=job.update, base_db=base_db)
+        # База, не совпавшая с дампом, отброшена - бэкап загружен целиком
+        if not get_ingest_base(conn):
+            job.base_db = None
+        job.ingest_stats = get_ingest_stats(conn)
+        job.phase_seconds = get_ingest_phases(conn)
+        job.row_counts = table_row_counts(conn)
+        # Бэкап неизменяем - аналитику считаем сразу и сохраняем снимок
+        _run_phase(job, 'snapshot', write_snapshot, job.backup_id, conn)
+        # Выжимка для трендов по всем бэкапам (/api/trends)
+        _run_phase(job, 'warehouse', WAREHOUSE.record, job.backup_id, job.name, conn)
+        if ANALYTICS_ENGINE == 'duckdb':
+            # Копия таблиц Analytics для колоночного движка
+            _run_phase(job, 'columnar', export_to_duckdb, conn, duckdb_path(db_path))
+        conn.close()
+        part_path.replace(db_path)
+        if on_success:
+            on_success(job)
+        job.status = 'done'
+    except Exception as e:
+        # Удаляем файлы при ошибке
+        file_path.unlink(missing_ok=True)
+        part_path.unlink(missing_ok=True)
+        duckdb_path(db_path).unlink(missing_ok=True)
+        job.status = 'error'
+        job.error = f"Failed to parse backup: {str(e)}"
+    finally:
+        job.finished_at = time.time()
+        with _LOCAL_JOBS_LOCK:
+            _LOCAL_JOBS.pop(job.id, None)
+        job.save()
+
+
+def _heartbeat():
+    """Фоновый поток: сохраняет живые задачи процесса, продлевая их блокировку"""
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _LOCAL_JOBS_LOCK:
+            jobs = list(_LOCAL_JOBS.values())
+        for job in jobs:
+            try:
+                job.save()
+            except sqlite3.Error:
+                pass  # каталог занят - продлим на следующем шаге
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """Состояние задачи загрузки из любого воркера"""
+    return CATALOG.get_job(job_id, JOB_STALE_SECONDS, JOB_TTL_SECONDS)
+
+
+def find_active_job(backup_id: str) -> Optional[dict]:
+    """Незавершенная задача загрузки бэкапа (в любом воркере), если есть"""
+    return CATALOG.active_job(backup_id, JOB_STALE_SECONDS, JOB_TTL_SECONDS)
+
+
+def claim_ingest(backup_id: str, name: str, base_db: Optional[Path] = None) -> Optional[IngestJob]:
+    """Создает задачу загрузки и берет блокировку бэкапа.
+
+    None - бэкап уже загружается (в этом или другом воркере).
+    base_db - БД предыдущего бэкапа для инкрементальной загрузки.
+    """
+    job = IngestJob(backup_id, name, base_db)
+    if not CATALOG.claim_job(job.id, backup_id, job.to_dict(), JOB_STALE_SECONDS, JOB_TTL_SECONDS):
+        return None
+    return job
+
+
+def release_ingest(job: IngestJob):
+    """Отменяет задачу, взятую claim_ingest, но не запущенную"""
+    CATALOG.delete_job(job.id)
+
+
+def submit_ingest(job: IngestJob, file_path: Path, db_path: Path, workers: int = 1,
+                  on_success: Optional[Callable[[IngestJob], None]] = None):
+    """Ставит загрузку бэкапа (задача из claim_ingest) в очередь и сразу возвращает управление"""
+    global _heartbeat_thread
+    with _LOCAL_JOBS_LOCK:
+        _LOCAL_JOBS[job.id] = job
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat, name="ingest-heartbeat", daemon=True)
+            _heartbeat_thread.start()
+    INGEST_EXECUTOR.submit(_run_ingest, job, file_path, db_path, workers, job.base_db, on_success)
@@ -0,0 +1,220 @@
+"""
+Jani Analytics - метрики запросов аналитики и загрузки бэкапов
+
+Инструментация всегда включена и поэтому дешевая: на запрос - два
+perf_counter и обновление гистограммы под lock. EXPLAIN QUERY PLAN
+снимается только для запросов дольше SLOW_QUERY_SECONDS и только один
+раз на метрику: SQL метрики фиксирован, план от параметров не зависит.
+Метрики процесса отдает /api/debug/metrics (JSON или текстовый формат
+Prometheus). Каждый процесс uvicorn считает свои метрики.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator
+
+# Запросы дольше этого попадают в журнал медленных с планом выполнения
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', 0.2))
+
+# Сколько последних медленных запросов хранить
+SLOW_QUERY_LOG_SIZE = 100
+
+# Верхние границы корзин гистограмм времени, секунды
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    """Гистограмма времени: число, сумма, максимум и счетчики по LATENCY_BUCKETS"""
+
+    __slots__ = ('count', 'sum', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total_seconds': round(self.sum, 4),
+            'avg_ms': round(self.sum / self.count * 1000, 2) if self.count else 0,
+            'max_ms': round(self.max * 1000, 2),
+        }
+
+
+def explain(conn, sql: str, params=()) -> list:
+    """План запроса: EXPLAIN QUERY PLAN в SQLite, EXPLAIN в других движках"""
+    try:
+        if isinstance(conn, sqlite3.Connection):
+            return [r[3] for r in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+        return [str(r[-1]) for r in conn.execute(f"EXPLAIN {sql}", params).fetchall()]
+    except Exception as e:
+        # План - диагностика: его ошибка не должна ломать сам запрос
+        return [f"EXPLAIN failed: {e}"]
+
+
+class Metrics:
+    """Метрики процесса: время запросов и разделов аналитики, фазы загрузки, медленные запросы"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.queries = {}  # {(раздел, метрика): Histogram}
+        self.sections = {}  # {раздел: Histogram}
+        self.ingest_phases = {}  # {фаза: Histogram}
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self._plans = {}  # {(раздел, метрика): план}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _observe(histograms: dict, key, seconds: float):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_query(self, section: str, metric: str, seconds: float, conn=None, sql: str = None, params=()):
+        """Время запроса; медленный запрос с conn и sql попадает в журнал с планом"""
+        key = (section, metric)
+        with self._lock:
+            self._observe(self.queries, key, seconds)
+            plan = self._plans.get(key)
+        if seconds < SLOW_QUERY_SECONDS or conn is None:
+            return
+        if plan is None:
+            plan = explain(conn, sql, params)
+            with self._lock:
+                self._plans[key] = plan
+        entry = {
+            'section': section, 'metric': metric, 'ms': round(seconds * 1000, 2),
+            'at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            'sql': ' '.join(sql.split()), 'plan': plan,
+        }
+        with self._lock:
+            self.slow_queries.append(entry)
+
+    def observe_section(self, section: str, seconds: float):
+        with self._lock:
+            self._observe(self.sections, section, seconds)
+
+    def observe_ingest(self, phases: dict):
+        """Времена фаз одной загрузки бэкапа: {фаза: секунды}"""
+        with self._lock:
+            for phase, seconds in phases.items():
+                self._observe(self.ingest_phases, phase, seconds)
+
+    @contextmanager
+    def timer(self, section: str, metric: str) -> Iterator[None]:
+        """Замер блока кода как метрики запроса (без плана)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_query(section, metric, time.perf_counter() - started)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'uptime_seconds': round(time.time() - self.started_at, 1),
+                'slow_query_seconds': SLOW_QUERY_SECONDS,
+                'sections': {name: h.to_dict() for name, h in sorted(self.sections.items())},
+                'queries': {
+                    f'{section}.{metric}': h.to_dict() for (section, metric), h in sorted(self.queries.items())
+                },
+                'ingest_phases': {phase: h.to_dict() for phase, h in sorted(self.ingest_phases.items())},
+                'slow_queries': list(reversed(self.slow_queries)),
+            }
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus (exposition format 0.0.4)"""
+        lines = [
+            '# HELP jani_uptime_seconds Seconds since the process started.',
+            '# TYPE jani_uptime_seconds gauge',
+            f'jani_uptime_seconds {time.time() - self.started_at:.1f}',
+        ]
+        with self._lock:
+            for name, help_text, histograms, labels in (
+                ('jani_query_seconds', 'Analytics query latency by section and metric.', self.queries,
+                 lambda key: f'section="{key[0]}",metric="{key[1]}"'),
+                ('jani_section_seconds', 'Analytics section latency.', self.sections,
+                 lambda key: f'section="{key}"'),
+                ('jani_ingest_phase_seconds', 'Backup ingest phase duration.', self.ingest_phases,
+                 lambda key: f'phase="{key}"'),
+            ):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for key, h in sorted(histograms.items()):
+                    label = labels(key)
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, h.buckets):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {h.count}')
+                    lines.append(f'{name}_sum{{{label}}} {h.sum:.6f}')
+                    lines.append(f'{name}_count{{{label}}} {h.count}')
+            slow = len(self.slow_queries)
+        lines += [
+            '# HELP jani_slow_queries Slow queries currently in the log.',
+            '# TYPE jani_slow_queries gauge',
+            f'jani_slow_queries {slow}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class TimedCursor:
+    """Курсор Analytics: каждый запрос (выполнение и выборка) пишется в METRICS как раздел.метрика"""
+
+    def __init__(self, conn, section: str):
+        self.conn = conn
+        self.section = section
+        self.cursor = conn.cursor()
+
+    def execute(self, sql: str, params=(), metric: str = 'query') -> '_TimedResult':
+        started = time.perf_counter()
+        return _TimedResult(self, self.cursor.execute(sql, params), metric, sql, params, started)
+
+
+class _TimedResult:
+    """Результат запроса TimedCursor: замер заканчивается после fetchone/fetchall"""
+
+    __slots__ = ('owner', 'result', 'metric', 'sql', 'params', 'started')
+
+    def __init__(self, owner: TimedCursor, result, metric: str, sql: str, params, started: float):
+        self.owner = owner
+        self.result = result
+        self.metric = metric
+        self.sql = sql
+        self.params = params
+        self.started = started
+
+    def _done(self):
+        owner = self.owner
+        METRICS.observe_query(
+            owner.section, self.metric, time.perf_counter() - self.started, owner.conn, self.sql, self.params
+        )
+
+    def fetchone(self):
+        row = self.result.fetchone()
+        self._done()
+        return row
+
+    def fetchall(self) -> list:
+        rows = self.result.fetchall()
+        self._done()
+        return rows
@@ -0,0 +1,167 @@
+"""
+Jani Analytics - активность пользователей по дням и retention
+
+Из dialogs один раз строится битовая карта активности на пользователя:
+бит i - пользователь писал в день first_day + i. По картам считаются
+DAU/WAU/MAU за каждый день истории (разностными массивами, за
+O(активных дней)) и настоящий N-дневный retention когорт по дню первой
+активности - на любой момент as_of, обрезкой карт по дню as_of.
+"""
+import sqlite3
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional
+
+# Окна WAU и MAU в днях (включая текущий день)
+WAU_DAYS = 7
+MAU_DAYS = 30
+
+# Дни retention-кривой: 0..RETENTION_CURVE_DAYS
+RETENTION_CURVE_DAYS = 30
+
+# Дни retention в таблице когорт
+COHORT_DAYS = (1, 7, 30)
+
+# Сколько последних недельных когорт показывать
+COHORT_WEEKS = 12
+
+
+def day_to_date(day: int) -> str:
+    """Номер дня от 1970-01-01 -> 'YYYY-MM-DD'"""
+    return datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _iter_user_days(rows: Iterable[tuple]) -> Iterator[tuple[int, list]]:
+    """(user_id, day) по возрастанию user_id -> (user_id, [дни по возрастанию])"""
+    current, days = None, []
+    for user_id, day in rows:
+        if user_id != current:
+            if days:
+                yield current, days
+            current, days = user_id, []
+        days.append(day)
+    if days:
+        yield current, days
+
+
+def build_activity(conn: sqlite3.Connection, days_sql: str, first_day: Optional[int], last_day: Optional[int]):
+    """(Пере)строит user_activity и activity_daily.
+
+    days_sql - SELECT user_id, day без повторов, ORDER BY user_id, day;
+    все дни должны лежать в [first_day, last_day]. Ряд DAU/WAU/MAU строится
+    за каждый день этого отрезка (last_day может быть позже последней
+    активности, например день снятия дампа). first_day = None - активности нет.
+    """
+    conn.executescript("""
+        DROP TABLE IF EXISTS user_activity;
+        DROP TABLE IF EXISTS activity_daily;
+        CREATE TABLE user_activity (
+            user_id INTEGER PRIMARY KEY,
+            first_day INTEGER,
+            last_day INTEGER,
+            active_days INTEGER,
+            days BLOB
+        );
+        CREATE TABLE activity_daily (
+            day_num INTEGER PRIMARY KEY,
+            day TEXT,
+            dau INTEGER,
+            wau INTEGER,
+            mau INTEGER
+        );
+    """)
+
+    if first_day is None:
+        return
+    span = last_day - first_day + MAU_DAYS + 1
+
+    users = []
+    # Разностные массивы по дням от first_day: +-пользователей для окон WAU/MAU
+    deltas = {WAU_DAYS: [0] * span, MAU_DAYS: [0] * span}
+    dau = [0] * span
+    for user_id, days in _iter_user_days(conn.execute(days_sql)):
+        first = days[0]
+        bitmap = 0
+        for day in days:
+            bitmap |= 1 << (day - first)
+            dau[day - first_day] += 1
+        users.append((user_id, first, days[-1], len(days), bitmap.to_bytes((days[-1] - first) // 8 + 1, 'little')))
+
+        # Пользователь входит в окно длины w дня d, если активен в [d - w + 1, d]:
+        # объединение отрезков [day, day + w - 1] по его активным дням
+        for window, delta in deltas.items():
+            start = end = days[0] - first_day
+            for day in days:
+                day -= first_day
+                if day <= end:
+                    end = day + window - 1
+                    continue
+                delta[start] += 1
+                delta[end + 1] -= 1
+                start, end = day, day + window - 1
+            delta[start] += 1
+            delta[end + 1] -= 1
+
+    conn.executemany("INSERT INTO user_activity VALUES (?, ?, ?, ?, ?)", users)
+
+    running = {window: 0 for window in deltas}
+    series = []
+    for i in range(last_day - first_day + 1):
+        for window, delta in deltas.items():
+            running[window] += delta[i]
+        day = first_day + i
+        series.append((day, day_to_date(day), dau[i], running[WAU_DAYS], running[MAU_DAYS]))
+    conn.executemany("INSERT INTO activity_daily VALUES (?, ?, ?, ?, ?)", series)
+
+
+def retention(conn: sqlite3.Connection, as_of_day: int) -> dict:
+    """Retention по картам активности с учетом только дней <= as_of_day.
+
+    Когорта - неделя первой активности пользователя. dN - пользователи,
+    активные ровно на N-й день после первого; процент считается от тех,
+    у кого N-й день уже наступил к as_of (eligible).
+    """
+    curve_eligible = [0] * (RETENTION_CURVE_DAYS + 1)
+    curve_retained = [0] * (RETENTION_CURVE_DAYS + 1)
+    cohorts = {}
+    active_days_total = active_users = 0
+
+    rows = conn.execute("SELECT first_day, days FROM user_activity WHERE first_day <= ?", (as_of_day,)).fetchall()
+    for first, days in rows:
+        horizon = as_of_day - first
+        bitmap = int.from_bytes(days, 'little') & ((1 << (horizon + 1)) - 1)
+        active_users += 1
+        active_days_total += bitmap.bit_count()
+
+        for n in range(min(horizon, RETENTION_CURVE_DAYS) + 1):
+            curve_eligible[n] += 1
+            curve_retained[n] += bitmap >> n & 1
+
+        week = datetime.fromtimestamp(first * 86400, timezone.utc).strftime('%Y-%W')
+        cohort = cohorts.setdefault(week, {'users': 0, **{n: [0, 0] for n in COHORT_DAYS}})
+        cohort['users'] += 1
+        for n in COHORT_DAYS:
+            if n <= horizon:
+                cohort[n][0] += 1
+                cohort[n][1] += bitmap >> n & 1
+
+    def pct(retained: int, eligible: int) -> float:
+        return round(retained / eligible * 100, 1) if eligible else 0
+
+    return {
+        'cohorts': [
+            {
+                'week': week, 'users': c['users'],
+                **{
+                    key: value for n in COHORT_DAYS for key, value in (
+                        (f'd{n}', c[n][1]), (f'd{n}_eligible', c[n][0]), (f'd{n}_pct', pct(c[n][1], c[n][0]))
+                    )
+                }
+            } for week, c in sorted(cohorts.items(), reverse=True)[:COHORT_WEEKS]
+        ],
+        'curve': [
+            {'day': n, 'eligible': curve_eligible[n], 'retained': curve_retained[n],
+             'pct': pct(curve_retained[n], curve_eligible[n])}
+            for n in range(RETENTION_CURVE_DAYS + 1) if curve_eligible[n]
+        ],
+        'avg_active_days': round(active_days_total / active_users, 1) if active_users else 0,
+    }
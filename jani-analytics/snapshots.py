@@ -0,0 +1,144 @@
+"""
+Jani Analytics - сохраненные снимки аналитики
+
+Загруженный бэкап не меняется, поэтому полный ответ get_all_analytics
+считается один раз (в конце загрузки) и хранится рядом с БД в виде
+сжатого JSON. Горячие снимки дополнительно держатся в памяти (LRU).
+Аналитика на произвольный as_of на диск не пишется, только в LRU:
+результат зависит лишь от (бэкап, as_of). Отдельные разделы
+(/api/analytics/{id}/{раздел}) берутся из сохраненного снимка, а на
+произвольный as_of считаются по одному; и те и другие кешируются в LRU.
+Снимок привязан к ANALYTICS_VERSION: при изменении кода аналитики
+старые снимки просто перестают находиться и пересчитываются.
+"""
+import glob
+import gzip
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from analytics import ANALYTICS_VERSION, Analytics, UPLOADS_DIR
+from db import get_all_analytics_concurrent, get_pool
+
+# Лимит памяти под снимки в LRU (по размеру сериализованного JSON)
+SNAPSHOT_CACHE_BYTES = int(os.getenv('SNAPSHOT_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+def snapshot_path(backup_id: str) -> Path:
+    return UPLOADS_DIR / f"{backup_id}.analytics.v{ANALYTICS_VERSION}.json.gz"
+
+
+class SnapshotCache:
+    """LRU снимков {(backup_id, as_of, раздел): JSON bytes} с ограничением по суммарному размеру.
+
+    as_of = None - снимок на время снятия дампа, раздел None - вся аналитика.
+    """
+
+    def __init__(self, max_bytes: int = SNAPSHOT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, backup_id: str, as_of: Optional[str] = None, section: Optional[str] = None):
+        key = (backup_id, as_of, section)
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, backup_id: str, data: bytes, as_of: Optional[str] = None, section: Optional[str] = None):
+        if len(data) > self.max_bytes:
+            return
+        key = (backup_id, as_of, section)
+        with self._lock:
+            self._pop(key)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def evict(self, backup_id: str):
+        """Убирает все снимки бэкапа (на любой as_of и все разделы)"""
+        with self._lock:
+            for key in [k for k in self._items if k[0] == backup_id]:
+                self._pop(key)
+
+    def _pop(self, key: tuple):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+
+
+CACHE = SnapshotCache()
+
+
+def _serialize(result: dict) -> bytes:
+    return json.dumps(result, ensure_ascii=False).encode('utf-8')
+
+
+def write_snapshot(backup_id: str, conn: sqlite3.Connection) -> bytes:
+    """Считает всю аналитику по БД бэкапа и сохраняет снимок на диск"""
+    return _save_snapshot(backup_id, _serialize(Analytics(conn).get_all_analytics()))
+
+
+def _save_snapshot(backup_id: str, data: bytes) -> bytes:
+    path = snapshot_path(backup_id)
+    tmp_path = path.with_suffix('.part')
+    with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+        f.write(data)
+    tmp_path.replace(path)
+
+    # Снимки прошлых версий кода аналитики больше не нужны
+    for old in UPLOADS_DIR.glob(f"{glob.escape(backup_id)}.analytics.v*.json.gz"):
+        if old != path:
+            old.unlink(missing_ok=True)
+
+    CACHE.put(backup_id, data)
+    return data
+
+
+def get_snapshot(backup_id: str, db_path: Path, as_of: Optional[str] = None) -> bytes:
+    """JSON всей аналитики бэкапа: из памяти, с диска или посчитанный заново.
+
+    as_of - момент, от которого считаются окна; None - время снятия дампа.
+    """
+    data = CACHE.get(backup_id, as_of)
+    if data is not None:
+        return data
+
+    path = snapshot_path(backup_id)
+    if as_of is None and path.exists():
+        with gzip.open(path, 'rb') as f:
+            data = f.read()
+        CACHE.put(backup_id, data)
+        return data
+
+    data = _serialize(get_all_analytics_concurrent(db_path, as_of))
+    if as_of is None:
+        return _save_snapshot(backup_id, data)
+    CACHE.put(backup_id, data, as_of)
+    return data
+
+
+def get_section_snapshot(backup_id: str, db_path: Path, section: str, as_of: Optional[str] = None) -> bytes:
+    """JSON одного раздела аналитики: из памяти, из снимка всей аналитики (as_of = None)
+    или посчитанный заново только этот раздел (произвольный as_of)"""
+    data = CACHE.get(backup_id, as_of, section)
+    if data is not None:
+        return data
+
+    if as_of is None:
+        result = json.loads(get_snapshot(backup_id, db_path))[section]
+    else:
+        with get_pool(db_path).connection() as conn:
+            result, _ = Analytics(conn, as_of=as_of).get_section(section)
+    data = _serialize(result)
+    CACHE.put(backup_id, data, as_of, section)
+    return data
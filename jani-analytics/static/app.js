@@ -1,8 +1,21 @@
 // Jani Analytics - Dashboard JS
 
-let currentData = null;
 let charts = {};
 
+// Разделы API, нужные вкладке: загружаются при первом открытии вкладки
+const TAB_SECTIONS = {
+    users: ['users', 'retention'],
+    messages: ['messages'],
+    characters: ['characters'],
+    financial: ['financial'],
+    referrals: ['referrals']
+};
+
+let currentBackup = null;
+let currentTab = 'users';
+let sectionRequests = {};  // {раздел: Promise} для currentBackup
+let renderedTabs = new Set();
+
 // Chart.js defaults
 Chart.defaults.color = '#71717a';
 Chart.defaults.borderColor = '#27272a';
@@ -53,7 +66,7 @@ async function loadBackups() {
         compare2.innerHTML = '<option value="">Бэкап 2...</option>';
 
         backups.forEach(b => {
-            const opt = `<option value="${b.id}">${b.name} (${new Date(b.uploaded_at).toLocaleDateString()})</option>`;
+            const opt = `<option value="${b.id}">${b.name} (${new Date(b.uploaded_at).toLocaleDateString()}, ${formatSize(b.size)})</option>`;
             select.innerHTML += opt;
             compare1.innerHTML += opt;
             compare2.innerHTML += opt;
@@ -76,14 +89,18 @@ async function handleUpload(e) {
     const loading = document.getElementById('loading');
     loading.classList.remove('hidden');
 
-    const formData = new FormData();
-    formData.append('file', file);
-
     try {
-        const res = await fetch('/api/upload', { method: 'POST', body: formData });
+        // Сырое тело запроса: сервер пишет его на диск по мере поступления
+        const res = await fetch(`/api/upload/raw?filename=${encodeURIComponent(file.name)}`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/octet-stream' },
+            body: file
+        });
         if (!res.ok) throw new Error(await res.text());
 
         const result = await res.json();
+        // Повторная загрузка того же дампа возвращает готовый бэкап без задачи
+        if (result.job_id) await waitForJob(result.job_id);
         await loadBackups();
 
         document.getElementById('backupSelect').value = result.id;
@@ -92,10 +109,40 @@ async function handleUpload(e) {
         alert('Ошибка загрузки: ' + e.message);
     } finally {
         loading.classList.add('hidden');
+        loading.textContent = 'Загрузка...';
         e.target.value = '';
     }
 }
 
+async function waitForJob(jobId) {
+    const loading = document.getElementById('loading');
+
+    while (true) {
+        const res = await fetch(`/api/jobs/${jobId}`);
+        if (!res.ok) throw new Error(await res.text());
+
+        const job = await res.json();
+        if (job.status === 'done') return job;
+        if (job.status === 'error') throw new Error(job.error);
+
+        const rows = Object.values(job.rows || {}).reduce((a, b) => a + b, 0);
+        const eta = job.eta_seconds !== null ? `, осталось ~${Math.ceil(job.eta_seconds)} с` : '';
+        if (job.phase === 'rollups') {
+            loading.textContent = `Агрегация... ${formatNumber(rows)} строк`;
+        } else if (job.phase === 'indexing') {
+            loading.textContent = `Индексация... ${formatNumber(rows)} строк`;
+        } else if (job.phase === 'snapshot') {
+            loading.textContent = 'Расчет аналитики...';
+        } else if (job.phase === 'columnar') {
+            loading.textContent = 'Выгрузка в колоночный движок...';
+        } else {
+            loading.textContent = `Обработка: ${job.progress_pct}% (${formatNumber(rows)} строк${eta})`;
+        }
+
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 async function loadAnalytics(backupId) {
     const loading = document.getElementById('loading');
     const dashboard = document.getElementById('dashboard');
@@ -105,14 +152,17 @@ async function loadAnalytics(backupId) {
     dashboard.classList.add('hidden');
     noData.classList.add('hidden');
 
-    try {
-        const res = await fetch(`/api/analytics/${backupId}`);
-        if (!res.ok) throw new Error('Failed to load analytics');
+    currentBackup = backupId;
+    sectionRequests = {};
+    renderedTabs = new Set();
 
-        currentData = await res.json();
-        renderDashboard();
+    try {
+        const overview = await fetchSection('overview');
+        if (backupId !== currentBackup) return;
+        renderOverview(overview);
 
         dashboard.classList.remove('hidden');
+        await loadTab(currentTab);
     } catch (e) {
         console.error(e);
         noData.classList.remove('hidden');
@@ -121,19 +171,44 @@ async function loadAnalytics(backupId) {
     }
 }
 
-function renderDashboard() {
-    if (!currentData) return;
+function fetchSection(name) {
+    // Ответ кешируется и браузером: сервер отдает ETag, повторный запрос получает 304
+    if (!sectionRequests[name]) {
+        sectionRequests[name] = fetch(`/api/analytics/${currentBackup}/${name}`).then(res => {
+            if (!res.ok) throw new Error(`Failed to load ${name}`);
+            return res.json();
+        });
+        // Неудачный запрос не кешируем: повторное открытие вкладки попробует снова
+        sectionRequests[name].catch(() => delete sectionRequests[name]);
+    }
+    return sectionRequests[name];
+}
+
+async function loadTab(tabName) {
+    const render = TAB_RENDERERS[tabName];
+    if (!render || !currentBackup || renderedTabs.has(tabName)) return;
 
-    const { overview, users, messages, characters, financial, referrals, retention } = currentData;
+    const backupId = currentBackup;
+    try {
+        const sections = await Promise.all(TAB_SECTIONS[tabName].map(fetchSection));
+        // Пока грузились разделы, могли выбрать другой бэкап
+        if (backupId !== currentBackup || renderedTabs.has(tabName)) return;
+        render(...sections);
+        renderedTabs.add(tabName);
+    } catch (e) {
+        console.error(e);
+    }
+}
 
-    // Overview
+function renderOverview(overview) {
     document.getElementById('totalUsers').textContent = formatNumber(overview.total_users);
     document.getElementById('totalMessages').textContent = formatNumber(overview.total_messages);
     document.getElementById('totalCharacters').textContent = overview.total_characters;
     document.getElementById('totalRevenue').textContent = formatNumber(overview.total_revenue);
-    document.getElementById('conversionRate').textContent = financial.conversion_rate + '%';
+    document.getElementById('conversionRate').textContent = overview.conversion_rate + '%';
+}
 
-    // Users tab
+function renderUsers(users, retention) {
     document.getElementById('usersTotal').textContent = formatNumber(users.total);
     document.getElementById('usersPremium').textContent = formatNumber(users.premium);
     document.getElementById('usersFree').textContent = formatNumber(users.free);
@@ -142,6 +217,7 @@ function renderDashboard() {
     document.getElementById('dau').textContent = formatNumber(users.dau);
     document.getElementById('wau').textContent = formatNumber(users.wau);
     document.getElementById('mau').textContent = formatNumber(users.mau);
+    document.getElementById('stickiness').textContent = `${users.stickiness}%`;
 
     renderChart('languagesChart', 'doughnut', {
         labels: users.languages.slice(0, 5).map(l => l.name),
@@ -171,8 +247,9 @@ function renderDashboard() {
             <td>${c.d30} (${c.d30_pct}%)</td>
         </tr>
     `).join('');
+}
 
-    // Messages tab
+function renderMessages(messages) {
     document.getElementById('messagesTotal').textContent = formatNumber(messages.total);
     document.getElementById('messagesUser').textContent = formatNumber(messages.total_user_messages);
     document.getElementById('avgMsgsAll').textContent = messages.avg_per_user;
@@ -220,8 +297,10 @@ function renderDashboard() {
             tension: 0.3
         }]
     });
+}
 
-    // Characters tab - A/B Testing
+function renderCharacters(characters) {
+    // A/B Testing
     const abBody = document.querySelector('#abTestTable tbody');
     abBody.innerHTML = characters.ab_test.map(ab => `
         <tr>
@@ -268,8 +347,9 @@ function renderDashboard() {
             <td>v${c.prompt_version || '?'}</td>
         </tr>
     `).join('');
+}
 
-    // Financial tab
+function renderFinancial(financial) {
     document.getElementById('finRevenue').textContent = formatNumber(financial.total_revenue);
     document.getElementById('finPaying').textContent = formatNumber(financial.paying_users);
     document.getElementById('finArpu').textContent = financial.arpu;
@@ -302,8 +382,9 @@ function renderDashboard() {
             tension: 0.3
         }]
     });
+}
 
-    // Referrals tab
+function renderReferrals(referrals) {
     document.getElementById('refTotal').textContent = referrals.total_referred;
     document.getElementById('refActive').textContent = referrals.active_referrers;
     document.getElementById('refPaying').textContent = referrals.referred_paying;
@@ -320,6 +401,14 @@ function renderDashboard() {
     `).join('');
 }
 
+const TAB_RENDERERS = {
+    users: renderUsers,
+    messages: renderMessages,
+    characters: renderCharacters,
+    financial: renderFinancial,
+    referrals: renderReferrals
+};
+
 function renderChart(id, type, data) {
     const canvas = document.getElementById(id);
     if (!canvas) return;
@@ -353,6 +442,10 @@ function switchTab(tabName) {
 
     document.querySelector(`.tab[data-tab="${tabName}"]`).classList.add('active');
     document.getElementById(`${tabName}-tab`).classList.add('active');
+
+    // Графики рисуются на видимой вкладке: Chart.js не знает размер скрытого canvas
+    currentTab = tabName;
+    loadTab(tabName);
 }
 
 async function handleCompare() {
@@ -399,6 +492,17 @@ async function handleCompare() {
     }
 }
 
+function formatSize(bytes) {
+    if (bytes === null || bytes === undefined) return '-';
+    const units = ['B', 'KB', 'MB', 'GB'];
+    let i = 0;
+    while (bytes >= 1024 && i < units.length - 1) {
+        bytes /= 1024;
+        i++;
+    }
+    return `${bytes.toFixed(i ? 1 : 0)} ${units[i]}`;
+}
+
 function formatNumber(n) {
     if (n === null || n === undefined) return '-';
     return n.toLocaleString('ru-RU');
@@ -0,0 +1,607 @@
+"""
+Jani Analytics - генератор синтетических дампов pg_dump
+
+Пишет дамп всех таблиц backend/src/db/schema.ts так же, как pg_dump:
+сначала CREATE TYPE и CREATE TABLE, затем данные - в формате COPY
+(pg_dump по умолчанию) или INSERT (pg_dump --column-inserts [--rows-per-insert N]).
+
+Распределения скошенные, как в живой базе: активность пользователей и
+популярность персонажей - по Ципфу, аудитория растет со временем,
+пользователи уходят (экспоненциальный срок жизни), сообщения идут
+сессиями по суточному профилю. dialogs пишутся потоково по мере
+генерации, в памяти копятся только агрегаты по пользователям и парам
+пользователь-персонаж; остальные таблицы строятся по ним. Порядок
+таблиц в дампе загрузчику не важен. Тот же seed - тот же дамп.
+
+Пример:
+    python synthetic.py dump.sql --users 20000 --messages 1000000 --format insert
+"""
+import argparse
+import bisect
+import gzip
+import itertools
+import random
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, TextIO
+
+# Слова сообщений: кириллица, апострофы, табуляция, перевод строки, скобки и
+# запятые - проверяют экранирование COPY и разбор литералов INSERT
+WORDS = ['привет', 'как', 'дела', 'hello', "it's", 'ok', 'смотри', 'tab\there', 'line\nbreak', '(скобка)', 'a,b']
+
+# Вес часа суток (UTC) для начала сессии: ночью мало, пик вечером
+HOUR_WEIGHTS = [3, 2, 1, 1, 1, 2, 3, 4, 5, 6, 6, 7, 7, 7, 7, 8, 9, 10, 12, 13, 13, 11, 8, 5]
+
+# Множитель активности по дню недели (0 - понедельник)
+WEEKDAY_WEIGHTS = [1.0, 0.95, 0.95, 1.0, 1.05, 1.2, 1.25]
+
+MODELS = ['gemini-2.0-flash', 'gpt-4o-mini', 'llama-3.1-70b', 'mistral-large']
+MODEL_WEIGHTS = [60, 25, 10, 5]
+
+LANGUAGES = ['ru', 'en', 'uk', 'kk']
+LANGUAGE_WEIGHTS = [70, 20, 6, 4]
+
+PAYMENT_STATUSES = ['success', 'pending', 'canceled', 'error']
+PAYMENT_STATUS_WEIGHTS = [85, 5, 6, 4]
+
+# Тариф -> цена в Stars
+PAYMENT_TIERS = {'basic': 100, 'pro': 250, 'premium': 500}
+PAYMENT_TIER_WEIGHTS = [60, 30, 10]
+
+# Длительность подписки после успешного платежа, дней
+SUBSCRIPTION_DAYS = 30
+
+TAGS = ['romance', 'anime', 'fantasy', 'sci-fi', 'horror', 'comedy', 'drama', 'adventure', 'mystery', 'slice of life']
+
+NAMES = ['Алиса', 'Мария', 'Ева', 'Luna', 'Kira', "O'Neil", 'Саша', 'Max', 'Ника', 'Зоя']
+
+# Бонус сообщений рефереру: за регистрацию и за покупку приглашенного
+REFERRAL_REWARDS = {'registration': 10, 'purchase': 50}
+
+# Перечисления schema.ts: pg_dump пишет их CREATE TYPE перед таблицами
+ENUM_TYPES = {
+    'access_type': ['free', 'premium'],
+    'dialog_role': ['user', 'assistant'],
+    'payment_status': ['pending', 'success', 'canceled', 'error'],
+    'relationship_type': ['negative', 'stranger', 'neutral', 'friend', 'partner'],
+    'subscription_status': ['active', 'expired'],
+}
+
+TIMESTAMPTZ = 'timestamp with time zone'
+CREATED_AT = ('created_at', f'{TIMESTAMPTZ} DEFAULT now() NOT NULL')
+UPDATED_AT = ('updated_at', f'{TIMESTAMPTZ} DEFAULT now() NOT NULL')
+
+# Таблицы backend/src/db/schema.ts: [(колонка, определение как в pg_dump)] в физическом
+# порядке колонок - сначала CREATE TABLE, затем ALTER TABLE ADD COLUMN
+SCHEMA = {
+    'dialogs': [
+        ('id', 'bigint NOT NULL'), ('user_id', 'integer NOT NULL'), ('character_id', 'integer NOT NULL'),
+        ('role', 'public.dialog_role NOT NULL'), ('message_text', 'text NOT NULL'), CREATED_AT,
+        ('is_regenerated', 'boolean DEFAULT false'), ('tokens_used', 'integer'), ('model_used', 'text'),
+    ],
+    'users': [
+        ('id', 'integer NOT NULL'), ('telegram_user_id', 'bigint NOT NULL'), ('username', 'text'), CREATED_AT,
+        ('display_name', 'text'), ('gender', 'text'), ('language', "text DEFAULT 'ru'::text"),
+        ('is_adult_confirmed', 'boolean DEFAULT false'), ('last_active_at', TIMESTAMPTZ), ('nickname', 'text'),
+        ('voice_person', 'integer DEFAULT 3'), ('bonus_messages', 'integer DEFAULT 0'), ('limit_start_date', 'date'),
+        ('referred_by', 'integer'), ('active_days_count', 'integer DEFAULT 0'), ('last_activity_date', 'date'),
+        ('last_character_id', 'integer'),
+    ],
+    'characters': [
+        ('id', 'integer NOT NULL'), ('name', 'text NOT NULL'), ('description_long', 'text NOT NULL'),
+        ('avatar_url', 'text'), ('system_prompt', 'text NOT NULL'),
+        ('access_type', "public.access_type DEFAULT 'free'::public.access_type NOT NULL"),
+        ('is_active', 'boolean DEFAULT true NOT NULL'), CREATED_AT,
+        ('grammatical_gender', "text DEFAULT 'female'::text"), ('popularity_score', 'integer DEFAULT 0'),
+        ('messages_count', 'integer DEFAULT 0'), ('unique_users_count', 'integer DEFAULT 0'),
+        ('llm_provider', 'text'), ('llm_model', 'text'), ('llm_temperature', 'numeric(3,2)'),
+        ('llm_top_p', 'numeric(3,2)'), ('llm_repetition_penalty', 'numeric(4,2)'),
+        ('driver_prompt_version', 'integer DEFAULT 2'), ('initial_attraction', 'integer DEFAULT 0'),
+        ('initial_trust', 'integer DEFAULT 10'), ('initial_affection', 'integer DEFAULT 5'),
+        ('initial_dominance', 'integer DEFAULT 0'), ('created_by', 'integer'),
+        ('is_private', 'boolean DEFAULT false'), ('greeting_message', 'text'),
+        ('is_approved', 'boolean DEFAULT true'), ('rejection_reason', 'text'),
+    ],
+    'subscriptions': [
+        ('id', 'integer NOT NULL'), ('user_id', 'integer NOT NULL'),
+        ('status', 'public.subscription_status NOT NULL'), ('start_at', f'{TIMESTAMPTZ} NOT NULL'),
+        ('end_at', f'{TIMESTAMPTZ} NOT NULL'), CREATED_AT,
+    ],
+    'payments': [
+        ('id', 'integer NOT NULL'), ('user_id', 'integer NOT NULL'), ('amount_stars', 'integer NOT NULL'),
+        ('telegram_payment_id', 'text'),
+        ('status', "public.payment_status DEFAULT 'pending'::public.payment_status NOT NULL"),
+        ('tier', 'text'), ('charge_id', 'text'), CREATED_AT,
+    ],
+    'chat_sessions': [
+        ('id', 'integer NOT NULL'), ('user_id', 'integer NOT NULL'), ('character_id', 'integer NOT NULL'),
+        ('last_message_at', TIMESTAMPTZ), ('messages_count', 'integer DEFAULT 0'), CREATED_AT,
+        ('llm_model', 'text'), ('llm_temperature', 'numeric(3,2)'), ('llm_top_p', 'numeric(3,2)'),
+    ],
+    'character_ratings': [
+        ('user_id', 'integer NOT NULL'), ('character_id', 'integer NOT NULL'), ('rating', 'integer NOT NULL'),
+        CREATED_AT,
+        ('CONSTRAINT', "character_ratings_rating_check CHECK ((rating = ANY (ARRAY['-1'::integer, 1])))"),
+    ],
+    'referral_rewards': [
+        ('id', 'integer NOT NULL'), ('referrer_id', 'integer NOT NULL'), ('referred_id', 'integer NOT NULL'),
+        ('reward_type', 'text NOT NULL'), ('messages_awarded', 'integer NOT NULL'), CREATED_AT,
+    ],
+    'tags': [('id', 'integer NOT NULL'), ('name', 'text NOT NULL'), CREATED_AT],
+    'character_tags': [('character_id', 'integer NOT NULL'), ('tag_id', 'integer NOT NULL')],
+    'user_character_state': [
+        ('user_id', 'integer NOT NULL'), ('character_id', 'integer NOT NULL'),
+        ('attraction', 'integer DEFAULT 0'), ('trust', 'integer DEFAULT 10'), ('affection', 'integer DEFAULT 5'),
+        ('dominance', 'integer DEFAULT 0'), UPDATED_AT,
+    ],
+    'dialog_summaries': [
+        ('user_id', 'integer NOT NULL'), ('character_id', 'integer NOT NULL'), ('summary_text', 'text NOT NULL'),
+        UPDATED_AT, ('summarized_message_count', 'integer DEFAULT 0'),
+    ],
+    'character_memories': [
+        ('id', 'integer NOT NULL'), ('user_id', 'integer NOT NULL'), ('character_id', 'integer NOT NULL'),
+        ('content', 'text NOT NULL'), ('importance', 'integer DEFAULT 5'), CREATED_AT, UPDATED_AT,
+    ],
+    'character_comments': [
+        ('id', 'integer NOT NULL'), ('character_id', 'integer NOT NULL'), ('user_id', 'integer NOT NULL'),
+        ('parent_id', 'integer'), ('content', 'text NOT NULL'), CREATED_AT,
+    ],
+    'allowed_models': [
+        ('id', 'integer NOT NULL'), ('provider', 'text NOT NULL'), ('model_id', 'text NOT NULL'),
+        ('display_name', 'text NOT NULL'), ('is_default', 'boolean DEFAULT false'),
+        ('is_fallback', 'boolean DEFAULT false'), ('fallback_priority', 'integer'),
+        ('is_recommended', 'boolean DEFAULT false'), ('is_active', 'boolean DEFAULT true'),
+        ('created_at', f'{TIMESTAMPTZ} DEFAULT now()'),
+    ],
+    'app_settings': [('key', 'text NOT NULL'), ('value', 'text NOT NULL'), UPDATED_AT],
+}
+
+# Колонки данных (COPY/INSERT) по таблицам
+COLUMNS = {
+    table: [name for name, _ in columns if name != 'CONSTRAINT'] for table, columns in SCHEMA.items()
+}
+
+
+def _copy_escape(val) -> str:
+    if val is None:
+        return '\\N'
+    if isinstance(val, bool):
+        return 't' if val else 'f'
+    if isinstance(val, str):
+        return val.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+    return str(val)
+
+
+def _sql_literal(val) -> str:
+    if val is None:
+        return 'NULL'
+    if isinstance(val, bool):
+        return 'true' if val else 'false'
+    if isinstance(val, (int, float)):
+        return str(val)
+    return "'" + val.replace("'", "''") + "'"
+
+
+class DumpWriter:
+    """Пишет строки таблиц так, как их выводит pg_dump: COPY или INSERT"""
+
+    def __init__(self, f: TextIO, fmt: str = 'copy', rows_per_insert: int = 1):
+        if fmt not in ('copy', 'insert'):
+            raise ValueError(f"fmt must be 'copy' or 'insert', got {fmt!r}")
+        self.f = f
+        self.fmt = fmt
+        self.rows_per_insert = rows_per_insert
+        self.rows = {}  # {таблица: записано строк}
+
+    def header(self, dumped_at: str):
+        self.f.write(
+            "--\n-- PostgreSQL database dump\n--\n\n"
+            "-- Dumped from database version 16.2\n"
+            "-- Dumped by pg_dump version 16.2\n\n"
+            f"-- Started on {dumped_at} UTC\n\n"
+            "SET statement_timeout = 0;\nSET client_encoding = 'UTF8';\n\n"
+        )
+
+    def schema(self):
+        """CREATE TYPE и CREATE TABLE всех таблиц, как в секции pre-data pg_dump"""
+        for name, values in ENUM_TYPES.items():
+            labels = ',\n'.join(f"    '{v}'" for v in values)
+            self.f.write(
+                f"--\n-- Name: {name}; Type: TYPE; Schema: public; Owner: -\n--\n\n"
+                f"CREATE TYPE public.{name} AS ENUM (\n{labels}\n);\n\n\n"
+            )
+        for name in sorted(SCHEMA):
+            definitions = ',\n'.join(f"    {column} {definition}" for column, definition in SCHEMA[name])
+            self.f.write(
+                f"--\n-- Name: {name}; Type: TABLE; Schema: public; Owner: -\n--\n\n"
+                f"CREATE TABLE public.{name} (\n{definitions}\n);\n\n\n"
+            )
+
+    def table(self, name: str, rows: Iterable[list]):
+        columns = ', '.join(COLUMNS[name])
+        count = 0
+        if self.fmt == 'copy':
+            self.f.write(f"COPY public.{name} ({columns}) FROM stdin;\n")
+            for row in rows:
+                self.f.write('\t'.join(map(_copy_escape, row)) + '\n')
+                count += 1
+            self.f.write('\\.\n\n\n')
+        else:
+            rows = iter(rows)
+            while batch := list(itertools.islice(rows, self.rows_per_insert)):
+                values = ',\n\t'.join('(' + ', '.join(map(_sql_literal, row)) + ')' for row in batch)
+                self.f.write(f"INSERT INTO public.{name} ({columns}) VALUES {values};\n")
+                count += len(batch)
+            self.f.write('\n\n')
+        self.rows[name] = count
+
+
+def _zipf_cum_weights(n: int, skew: float, rnd: random.Random) -> list:
+    """Накопленные веса Ципфа для n объектов; ранги розданы случайно"""
+    ranks = list(range(1, n + 1))
+    rnd.shuffle(ranks)
+    return list(itertools.accumulate(1 / rank ** skew for rank in ranks))
+
+
+class SyntheticDump:
+    """Синтетическая база: генерирует строки всех таблиц в согласованном виде.
+
+    Пользователь с id i зарегистрирован раньше пользователя i + 1, поэтому
+    выбрать среди зарегистрированных к моменту t - значит выбрать из префикса
+    накопленных весов.
+    """
+
+    def __init__(self, users: int = 1000, characters: int = 50, messages: int = 100_000,
+                 days: int = 60, start: str = '2026-01-01', skew: float = 1.1,
+                 session_messages: int = 12, lifetime_days: int = 21, seed: int = 42):
+        self.n_users = max(users, 1)
+        self.n_characters = max(characters, 1)
+        self.n_messages = messages
+        self.days = max(days, 1)
+        self.session_messages = session_messages
+        self.rnd = rnd = random.Random(seed)
+        self.start = int(datetime.fromisoformat(start).replace(tzinfo=timezone.utc).timestamp())
+        self.end = self.start + self.days * 86400
+
+        # Регистрации ускоряются: доля зарегистрированных к моменту t - (t / T)^2
+        span = self.end - self.start
+        self.user_created = [self.start + int(span * ((i + rnd.random()) / self.n_users) ** 0.5)
+                             for i in range(self.n_users)]
+        self.user_weights = _zipf_cum_weights(self.n_users, skew, rnd)
+        # Срок жизни: большинство уходит, каждый пятый остается до конца
+        self.user_until = [
+            created + (span if rnd.random() < 0.2 else int(rnd.expovariate(1 / lifetime_days) * 86400))
+            for created in self.user_created
+        ]
+        self.referred_by = [
+            self._pick_user(i) if i and rnd.random() < 0.15 else None for i in range(self.n_users)
+        ]
+
+        self.character_weights = _zipf_cum_weights(self.n_characters, skew, rnd)
+        self.character_inactive = {c for c in range(1, self.n_characters + 1) if rnd.random() < 0.05}
+
+        # Копятся при генерации dialogs
+        self.favorite = [0] * self.n_users
+        self.last_active = [None] * self.n_users
+        self.last_day = [None] * self.n_users
+        self.active_days = [0] * self.n_users
+        self.user_messages = [0] * self.n_users
+        self.last_character = [None] * self.n_users
+        self.pairs = {}  # {(user_id, character_id): [первое, последнее сообщение, сообщений]}
+        self.payments_by_user = {}  # {user_id: [время успешных платежей]}
+        self._dates = {}  # {номер дня: 'YYYY-MM-DD'}
+
+    def _date(self, epoch: int) -> str:
+        day = epoch // 86400
+        date = self._dates.get(day)
+        if date is None:
+            date = self._dates[day] = datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y-%m-%d')
+        return date
+
+    def _ts(self, epoch: int) -> str:
+        """timestamptz как в pg_dump; дата кэшируется - это горячий путь dialogs"""
+        seconds = epoch % 86400
+        return f"{self._date(epoch)} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}+00"
+
+    @property
+    def dumped_at(self) -> str:
+        return datetime.fromtimestamp(self.end, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _pick_user(self, registered: int) -> int:
+        """Индекс пользователя среди первых registered по весам Ципфа"""
+        return bisect.bisect_right(self.user_weights, self.rnd.random() * self.user_weights[registered - 1])
+
+    def _pick_character(self) -> int:
+        weights = self.character_weights
+        return bisect.bisect_right(weights, self.rnd.random() * weights[-1]) + 1
+
+    def _daily_budgets(self) -> list:
+        """Сообщений на каждый день: пропорционально зарегистрированным и дню недели"""
+        weights = []
+        for day in range(self.days):
+            registered = bisect.bisect_right(self.user_created, self.start + (day + 1) * 86400)
+            weekday = datetime.fromtimestamp(self.start + day * 86400, timezone.utc).weekday()
+            weights.append(registered * WEEKDAY_WEIGHTS[weekday])
+        total = sum(weights)
+        budgets = [int(self.n_messages * w / total) for w in weights]
+        budgets[-1] += self.n_messages - sum(budgets)
+        return budgets
+
+    def dialogs(self) -> Iterator[list]:
+        rnd = self.rnd
+        texts = [' '.join(rnd.choices(WORDS, k=rnd.randint(2, 40))) for _ in range(1024)]
+        hours = list(itertools.accumulate(HOUR_WEIGHTS))
+        models = list(itertools.accumulate(MODEL_WEIGHTS))
+        message_id = 0
+        for day, budget in enumerate(self._daily_budgets()):
+            day_start = self.start + day * 86400
+            registered = bisect.bisect_right(self.user_created, day_start + 86400)
+            while budget > 0 and registered:
+                t = day_start + rnd.choices(range(24), cum_weights=hours)[0] * 3600 + rnd.randrange(3600)
+                # Ушедших пользователей перевыбираем несколько раз
+                for _ in range(8):
+                    user = self._pick_user(registered)
+                    if self.user_created[user] <= t <= self.user_until[user]:
+                        break
+                t = max(t, self.user_created[user] + 60)
+                if t >= self.end:
+                    continue
+                if not self.favorite[user] or rnd.random() < 0.3:
+                    character = self._pick_character()
+                    self.favorite[user] = self.favorite[user] or character
+                else:
+                    character = self.favorite[user]
+                user_id = user + 1
+                model = MODELS[bisect.bisect_right(models, rnd.random() * models[-1])]
+                # Сессия не выходит за момент снятия дампа
+                length = min(budget, 2 + int(rnd.expovariate(1 / self.session_messages)))
+                first = last = t
+                for i in range(length):
+                    if t >= self.end:
+                        length = i
+                        break
+                    message_id += 1
+                    created_at = self._ts(t)
+                    if i % 2 == 0:
+                        yield [message_id, user_id, character, 'user', rnd.choice(texts), created_at, False,
+                               None, None]
+                    else:
+                        yield [message_id, user_id, character, 'assistant',
+                               rnd.choice(texts) + ' ' + rnd.choice(texts), created_at,
+                               rnd.random() < 0.03, rnd.randint(50, 800), model]
+                    last = t
+                    t += rnd.randint(5, 90)
+                t = last
+                budget -= length
+
+                self.user_messages[user] += (length + 1) // 2
+                self.last_active[user] = max(self.last_active[user] or 0, t)
+                if self.last_day[user] != first // 86400:
+                    self.last_day[user] = first // 86400
+                    self.active_days[user] += 1
+                self.last_character[user] = character
+                pair = self.pairs.get((user_id, character))
+                if pair:
+                    pair[1] = t
+                    pair[2] += length
+                else:
+                    self.pairs[(user_id, character)] = [first, t, length]
+
+    def payments(self) -> Iterator[list]:
+        """Платят в основном активные пользователи: вероятность растет с числом сообщений"""
+        rnd = self.rnd
+        tiers = list(PAYMENT_TIERS)
+        payment_id = 0
+        for user, messages in enumerate(self.user_messages):
+            if not messages or rnd.random() >= min(0.6, messages / 400):
+                continue
+            created, until = self.user_created[user], self.last_active[user] or self.user_created[user]
+            for _ in range(1 + int(rnd.expovariate(1))):
+                payment_id += 1
+                t = rnd.randint(created, max(created, until))
+                status = rnd.choices(PAYMENT_STATUSES, PAYMENT_STATUS_WEIGHTS)[0]
+                tier = rnd.choices(tiers, PAYMENT_TIER_WEIGHTS)[0]
+                if status == 'success':
+                    self.payments_by_user.setdefault(user + 1, []).append(t)
+                yield [payment_id, user + 1, PAYMENT_TIERS[tier], f'tg_{payment_id}', status, tier,
+                       f'ch_{payment_id:08d}' if status == 'success' else None, self._ts(t)]
+
+    def subscriptions(self) -> Iterator[list]:
+        subscription_id = 0
+        for user_id, times in self.payments_by_user.items():
+            for t in times:
+                subscription_id += 1
+                end = t + SUBSCRIPTION_DAYS * 86400
+                yield [subscription_id, user_id, 'active' if end > self.end else 'expired',
+                       self._ts(t), self._ts(end), self._ts(t)]
+
+    def referral_rewards(self) -> Iterator[list]:
+        reward_id = 0
+        for user, referrer in enumerate(self.referred_by):
+            if referrer is None:
+                continue
+            reward_id += 1
+            yield [reward_id, referrer + 1, user + 1, 'registration', REFERRAL_REWARDS['registration'],
+                   self._ts(self.user_created[user])]
+            if user + 1 in self.payments_by_user:
+                reward_id += 1
+                yield [reward_id, referrer + 1, user + 1, 'purchase', REFERRAL_REWARDS['purchase'],
+                       self._ts(self.payments_by_user[user + 1][0])]
+
+    def users(self) -> Iterator[list]:
+        rnd = self.rnd
+        bonus = [0] * self.n_users
+        for user, referrer in enumerate(self.referred_by):
+            if referrer is not None:
+                bonus[referrer] += REFERRAL_REWARDS['registration']
+                if user + 1 in self.payments_by_user:
+                    bonus[referrer] += REFERRAL_REWARDS['purchase']
+        for user in range(self.n_users):
+            created = self.user_created[user]
+            last_active = self.last_active[user]
+            referrer = self.referred_by[user]
+            yield [
+                user + 1, 100_000_000 + user * 7 + rnd.randrange(7),
+                f'user{user + 1}' if rnd.random() < 0.7 else None, self._ts(created),
+                rnd.choice(NAMES) if rnd.random() < 0.6 else None,
+                rnd.choice(['male', 'female', None]),
+                rnd.choices(LANGUAGES, LANGUAGE_WEIGHTS)[0],
+                rnd.random() < 0.4,
+                self._ts(last_active or created),
+                f'nick{user + 1}' if rnd.random() < 0.1 else None,
+                3, bonus[user],
+                self._date(last_active) if last_active else None,
+                referrer + 1 if referrer is not None else None,
+                self.active_days[user],
+                self._date(last_active) if last_active else None,
+                self.last_character[user],
+            ]
+
+    def characters(self) -> Iterator[list]:
+        rnd = self.rnd
+        messages = [0] * (self.n_characters + 1)
+        users = [0] * (self.n_characters + 1)
+        for (_, character), (_, _, count) in self.pairs.items():
+            messages[character] += count
+            users[character] += 1
+        for character in range(1, self.n_characters + 1):
+            created_by = self._pick_user(self.n_users) + 1 if rnd.random() < 0.3 else None
+            approved = created_by is None or rnd.random() < 0.9
+            name = f'{rnd.choice(NAMES)} #{character}'
+            yield [
+                character, name, 'Описание персонажа, длинное; с "кавычками"',
+                f'https://cdn.example.com/avatars/{character}.png', 'You are a friendly character.',
+                'premium' if rnd.random() < 0.2 else 'free',
+                character not in self.character_inactive, self._ts(self.start - rnd.randint(1, 90) * 86400),
+                rnd.choice(['female', 'male']), users[character] * 10 + messages[character] // 100,
+                messages[character], users[character],
+                'openrouter' if rnd.random() < 0.5 else None, rnd.choice(MODELS) if rnd.random() < 0.5 else None,
+                round(rnd.uniform(0.5, 1.2), 2), round(rnd.uniform(0.8, 1.0), 2), round(rnd.uniform(1.0, 1.3), 2),
+                rnd.choice([1, 2]), 0, 10, 5, 0,
+                created_by, created_by is not None and rnd.random() < 0.2,
+                # Приветствие задают в каталоге, у пользовательских персонажей его нет
+                None if created_by else f'Привет! Я {name}.\nО чем поговорим?', approved,
+                None if approved else 'Нарушение правил',
+            ]
+
+    def chat_sessions(self) -> Iterator[list]:
+        rnd = self.rnd
+        for session_id, ((user_id, character), (first, last, count)) in enumerate(self.pairs.items(), 1):
+            custom = rnd.random() < 0.1
+            yield [session_id, user_id, character, self._ts(last), count, self._ts(first),
+                   rnd.choice(MODELS) if custom else None,
+                   round(rnd.uniform(0.5, 1.2), 2) if custom else None,
+                   round(rnd.uniform(0.8, 1.0), 2) if custom else None]
+
+    def character_ratings(self) -> Iterator[list]:
+        rnd = self.rnd
+        for (user_id, character), (_, last, count) in self.pairs.items():
+            if count >= 10 and rnd.random() < 0.3:
+                yield [user_id, character, 1 if rnd.random() < 0.8 else -1, self._ts(last)]
+
+    def user_character_state(self) -> Iterator[list]:
+        rnd = self.rnd
+        for (user_id, character), (_, last, count) in self.pairs.items():
+            growth = min(count // 10, 40)
+            yield [user_id, character, growth + rnd.randint(-5, 5), 10 + growth + rnd.randint(-5, 5),
+                   5 + growth + rnd.randint(-5, 5), rnd.randint(-50, 50), self._ts(last)]
+
+    def dialog_summaries(self) -> Iterator[list]:
+        for (user_id, character), (_, last, count) in self.pairs.items():
+            if count >= 40:
+                yield [user_id, character, f"Сводка диалога: {count} сообщений, it's going well", self._ts(last),
+                       count - count % 20]
+
+    def character_memories(self) -> Iterator[list]:
+        """Долгосрочная память: несколько фактов на долгий диалог"""
+        rnd = self.rnd
+        memory_id = 0
+        for (user_id, character), (first, last, count) in self.pairs.items():
+            if count < 20:
+                continue
+            # Сессии пары идут не по порядку времени: первая по генерации не обязательно раньше
+            first, last = min(first, last), max(first, last)
+            for _ in range(rnd.randint(1, 3)):
+                memory_id += 1
+                created = rnd.randint(first, last)
+                yield [memory_id, user_id, character, f"Пользователь любит {rnd.choice(TAGS)}, it's important",
+                       rnd.randint(1, 10), self._ts(created), self._ts(rnd.randint(created, last))]
+
+    def character_comments(self) -> Iterator[list]:
+        """Комментарии к персонажам; часть - ответы на предыдущий комментарий того же персонажа"""
+        rnd = self.rnd
+        last_comment = {}  # {character_id: id последнего комментария}
+        comment_id = 0
+        for (user_id, character), (_, last, count) in self.pairs.items():
+            if count < 10 or rnd.random() >= 0.1:
+                continue
+            comment_id += 1
+            parent = last_comment.get(character) if rnd.random() < 0.3 else None
+            last_comment[character] = comment_id
+            yield [comment_id, character, user_id, parent, ' '.join(rnd.choices(WORDS, k=rnd.randint(3, 15))),
+                   self._ts(last)]
+
+    def allowed_models(self) -> Iterator[list]:
+        for model_id, model in enumerate(MODELS, 1):
+            yield [model_id, 'gemini' if model.startswith('gemini') else 'openrouter', model, model.title(),
+                   model_id == 1, model_id == 2, model_id if model_id > 1 else None, model_id <= 2, True,
+                   self._ts(self.start - 120 * 86400)]
+
+    def app_settings(self) -> Iterator[list]:
+        updated = self._ts(self.start - 120 * 86400)
+        yield ['summary_provider', 'openrouter', updated]
+        yield ['summary_model', '', updated]
+
+    def tags(self) -> Iterator[list]:
+        for tag_id, name in enumerate(TAGS, 1):
+            yield [tag_id, name, self._ts(self.start - 180 * 86400)]
+
+    def character_tags(self) -> Iterator[list]:
+        for character in range(1, self.n_characters + 1):
+            for tag_id in sorted(self.rnd.sample(range(1, len(TAGS) + 1), self.rnd.randint(1, 3))):
+                yield [character, tag_id]
+
+    def write(self, writer: DumpWriter):
+        """Пишет схему и все таблицы: dialogs первыми - остальные строятся по их агрегатам"""
+        writer.header(self.dumped_at)
+        writer.schema()
+        writer.table('dialogs', self.dialogs())
+        writer.table('payments', self.payments())
+        for name in ('subscriptions', 'referral_rewards', 'users', 'characters', 'chat_sessions',
+                     'character_ratings', 'user_character_state', 'dialog_summaries', 'tags', 'character_tags',
+                     'character_memories', 'character_comments', 'allowed_models', 'app_settings'):
+            writer.table(name, getattr(self, name)())
+
+
+def write_dump(path: Path, users: int = 1000, characters: int = 50, messages: int = 100_000,
+               fmt: str = 'copy', rows_per_insert: int = 1, days: int = 60, skew: float = 1.1,
+               seed: int = 42) -> dict:
+    """Пишет синтетический дамп (в .gz - сжатый), возвращает {таблица: строк}"""
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8', newline='\n') as f:
+        writer = DumpWriter(f, fmt, rows_per_insert)
+        SyntheticDump(users=users, characters=characters, messages=messages, days=days, skew=skew,
+                      seed=seed).write(writer)
+    return writer.rows
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', type=Path)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--characters', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--skew', type=float, default=1.1, help="показатель Ципфа активности и популярности")
+    parser.add_argument('--format', choices=['copy', 'insert'], default='copy')
+    parser.add_argument('--rows-per-insert', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+    rows = write_dump(args.path, users=args.users, characters=args.characters, messages=args.messages,
+                      fmt=args.format, rows_per_insert=args.rows_per_insert, days=args.days, skew=args.skew,
+                      seed=args.seed)
+    print(', '.join(f"{table}={count}" for table, count in rows.items()))
+
+
+if __name__ == '__main__':
+    main()
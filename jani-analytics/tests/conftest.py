@@ -0,0 +1,35 @@
+"""
+Общие фикстуры тестов: БД бэкапа из синтетического дампа (synthetic.py)
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+# Модули приложения лежат плоско в jani-analytics/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench import load_with_rollup_plans  # noqa: E402
+from synthetic import write_dump  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def dump_path(tmp_path_factory) -> Path:
+    """Небольшой синтетический дамп в формате COPY"""
+    path = tmp_path_factory.mktemp('dump') / 'dump.copy.sql'
+    write_dump(path, users=500, characters=20, messages=20_000)
+    return path
+
+
+@pytest.fixture(scope='session')
+def loaded_backup(dump_path, tmp_path_factory):
+    """(соединение с БД бэкапа, планы build_rollups на момент загрузки)"""
+    conn, rollup_plans = load_with_rollup_plans(dump_path, tmp_path_factory.mktemp('db') / 'backup.db')
+    yield conn, rollup_plans
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def backup_conn(loaded_backup):
+    """Соединение с загруженной БД бэкапа"""
+    return loaded_backup[0]
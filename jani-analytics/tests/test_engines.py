@@ -0,0 +1,99 @@
+"""
+Паритет выгрузки в DuckDB с SQLite: пустые таблицы, BLOB, колонки без типа и NUMERIC, текст \\N
+"""
+import sqlite3
+
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+
+from analytics import build_rollups  # noqa: E402
+from engines import DuckDBEngine, export_to_duckdb, parity_mismatches  # noqa: E402
+
+
+@pytest.fixture
+def backup_copy(backup_conn, tmp_path):
+    """Копия БД бэкапа, которую тест может менять"""
+    conn = sqlite3.connect(str(tmp_path / 'backup.db'))
+    backup_conn.backup(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def export(backup_copy, tmp_path):
+    """Выгрузка копии в DuckDB; export_to_duckdb сам падает при расхождении аналитики"""
+    engines = []
+
+    def run() -> DuckDBEngine:
+        backup_copy.commit()
+        export_to_duckdb(backup_copy, tmp_path / 'backup.duckdb')
+        engines.append(DuckDBEngine(tmp_path / 'backup.duckdb'))
+        return engines[-1]
+
+    yield run
+    for engine in engines:
+        engine.close()
+
+
+def duck_types(engine: DuckDBEngine, table_name: str) -> dict:
+    return dict(engine.execute(
+        "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ?", [table_name]
+    ).fetchall())
+
+
+def test_parity(backup_copy, export):
+    assert parity_mismatches(backup_copy, export()) == []
+
+
+def test_empty_tables(backup_copy, export):
+    for table_name in ('dialogs', 'payments', 'subscriptions', 'character_ratings', 'referral_rewards'):
+        backup_copy.execute(f"DELETE FROM {table_name}")
+    build_rollups(backup_copy)
+    engine = export()
+    assert engine.execute("SELECT COUNT(*) FROM daily_messages").fetchone() == (0,)
+    # Агрегаты без объявленного типа в пустой таблице: числа, кроме UNTYPED_TEXT_COLUMNS
+    assert duck_types(engine, 'daily_messages') == {
+        'day': 'VARCHAR', 'messages': 'BIGINT', 'user_messages': 'BIGINT', 'tokens': 'BIGINT',
+        'tokens_count': 'BIGINT', 'active_users': 'BIGINT',
+    }
+
+
+def test_blob_columns(backup_copy, export):
+    backup_copy.execute("UPDATE user_activity SET days = X'' WHERE user_id = (SELECT MIN(user_id) FROM user_activity)")
+    engine = export()
+    query = "SELECT user_id, days FROM user_activity ORDER BY user_id"
+    assert duck_types(engine, 'user_activity')['days'] == 'BLOB'
+    assert [(u, bytes(d)) for u, d in engine.execute(query).fetchall()] == backup_copy.execute(query).fetchall()
+
+
+def test_untyped_numeric_columns(backup_copy, export):
+    # Дамп без CREATE TABLE: колонки NUMERIC, тип виден только по данным
+    backup_copy.executescript("""
+        ALTER TABLE character_ratings RENAME TO character_ratings_typed;
+        CREATE TABLE character_ratings (user_id NUMERIC, character_id NUMERIC, rating NUMERIC, created_at NUMERIC);
+        INSERT INTO character_ratings SELECT * FROM character_ratings_typed;
+        DROP TABLE character_ratings_typed;
+    """)
+    # Целые и дробные в одной колонке агрегата
+    backup_copy.execute("UPDATE daily_revenue SET revenue = revenue + 0.5 WHERE rowid = 1")
+    engine = export()
+    assert duck_types(engine, 'character_ratings') == {
+        'user_id': 'BIGINT', 'character_id': 'BIGINT', 'rating': 'BIGINT', 'created_at': 'VARCHAR',
+    }
+    assert duck_types(engine, 'daily_revenue')['revenue'] == 'DOUBLE'
+    query = "SELECT SUM(revenue) FROM daily_revenue"
+    assert engine.execute(query).fetchone() == backup_copy.execute(query).fetchone()
+
+
+def test_backslash_text_is_not_null(backup_copy, export):
+    backup_copy.execute("UPDATE users SET language = '\\N' WHERE id % 3 = 0")
+    backup_copy.execute("UPDATE users SET nickname = 'a\\b\\\\N' WHERE id % 3 = 1")
+    build_rollups(backup_copy)
+    engine = export()
+    for query in (
+        "SELECT language, COUNT(*) FROM users GROUP BY language ORDER BY language NULLS FIRST",
+        "SELECT nickname, COUNT(*) FROM users GROUP BY nickname ORDER BY nickname NULLS FIRST",
+        "SELECT language, COUNT(*) FROM user_segments GROUP BY language ORDER BY language NULLS FIRST",
+    ):
+        assert engine.execute(query).fetchall() == backup_copy.execute(query).fetchall()
@@ -0,0 +1,33 @@
+"""
+Инкрементальная загрузка: база используется, только если ее строки совпадают с дампом
+"""
+from analytics import Analytics, get_ingest_base, get_ingest_stats, load_backup_to_sqlite
+from synthetic import write_dump
+
+
+def test_previous_backup_is_used_as_base(dump_path, backup_conn, tmp_path):
+    # Предыдущий бэкап - тот же дамп без последних сообщений
+    lines = dump_path.read_text().splitlines(keepends=True)
+    start = next(i for i, line in enumerate(lines) if line.startswith('COPY public.dialogs '))
+    end = lines.index('\\.\n', start)
+    old_dump = tmp_path / 'old.sql'
+    old_dump.write_text(''.join(lines[:end - 100] + lines[end:]))
+    load_backup_to_sqlite(old_dump, tmp_path / 'old.db').close()
+
+    conn = load_backup_to_sqlite(dump_path, tmp_path / 'new.db', base_db=tmp_path / 'old.db')
+    assert get_ingest_base(conn) == 'old.db'
+    assert get_ingest_stats(conn)['dialogs']['inserted'] == 100
+    assert Analytics(conn).get_all_analytics() == Analytics(backup_conn).get_all_analytics()
+    conn.close()
+
+
+def test_foreign_base_falls_back_to_full_load(dump_path, backup_conn, tmp_path):
+    # Другая БД с теми же id сообщений: строкам базы доверять нельзя
+    write_dump(tmp_path / 'other.sql', users=500, characters=20, messages=20_000, fmt='insert', seed=7)
+    load_backup_to_sqlite(tmp_path / 'other.sql', tmp_path / 'other.db').close()
+
+    conn = load_backup_to_sqlite(dump_path, tmp_path / 'new.db', base_db=tmp_path / 'other.db')
+    assert get_ingest_base(conn) is None
+    assert get_ingest_stats(conn)['dialogs']['unchanged'] == 0
+    assert Analytics(conn).get_all_analytics() == Analytics(backup_conn).get_all_analytics()
+    conn.close()
@@ -0,0 +1,39 @@
+"""
+EXPLAIN QUERY PLAN запросов, которые выполняют Analytics и build_rollups,
+в порядке загрузки: агрегаты - до индексов, аналитика - после
+"""
+import pytest
+
+from bench import HISTORY_TABLE_PATTERN, PLAN_CHECKS, analytics_plans, plan_ok
+
+
+@pytest.fixture(scope='module')
+def plans(loaded_backup):
+    conn, rollup_plans = loaded_backup
+    return {**rollup_plans, **analytics_plans(conn)}
+
+
+@pytest.mark.parametrize('name', sorted(PLAN_CHECKS))
+def test_expected_plan(plans, name):
+    assert name in plans, f"{name} is not executed any more: update PLAN_CHECKS"
+    _, plan = plans[name]
+    assert PLAN_CHECKS[name] in plan
+
+
+def test_rollups_built_before_indexes(plans):
+    # user_revenue строится до idx_payments_status_user: покрывающий индекс ему недоступен
+    _, plan = plans['rollups.user_revenue']
+    assert 'INDEX' not in plan
+
+
+def test_dialogs_read_once_at_ingest(plans):
+    readers = [
+        name for name, (sql, _) in plans.items()
+        if name.startswith('rollups.') and 'dialogs' in HISTORY_TABLE_PATTERN.findall(sql)
+    ]
+    assert readers == ['rollups.dialog_grain']
+
+
+def test_analytics_skips_history_tables(plans):
+    failed = {name: sql for name, (sql, plan) in plans.items() if not plan_ok(name, sql, plan)}
+    assert not failed
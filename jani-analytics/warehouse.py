@@ -0,0 +1,301 @@
+"""
+Jani Analytics - хранилище временных рядов по всем бэкапам
+
+При загрузке каждого бэкапа в общую SQLite-БД пишется компактная
+выжимка: строка итогов на момент снятия дампа, дневной ряд, итоги по
+персонажам и по тарифам. Тренды за недели ночных бэкапов и сравнение
+N бэкапов (/api/trends) читаются только из нее, без открытия БД бэкапов.
+Выжимка остается и после удаления файлов бэкапа: история не теряется.
+"""
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional
+
+from analytics import Analytics, UPLOADS_DIR, get_dump_timestamp
+from db import get_pool
+
+# Не .db, чтобы не путать с БД бэкапов
+WAREHOUSE_PATH = UPLOADS_DIR / "warehouse.sqlite"
+
+# Итоги бэкапа на момент снятия дампа (колонки backup_metrics после служебных)
+SNAPSHOT_METRICS = (
+    'total_users', 'total_messages', 'total_characters', 'total_payments', 'total_revenue',
+    'paying_users', 'conversion_rate', 'dau', 'wau', 'mau',
+)
+
+# Метрики дневного ряда (колонки daily_metrics после backup_id, day)
+DAILY_METRICS = (
+    'new_users', 'messages', 'user_messages', 'active_users', 'dau', 'wau', 'mau', 'payments', 'revenue',
+)
+
+# Сколько персонажей с наибольшим ростом показывать в трендах по умолчанию
+TOP_CHARACTERS = 10
+
+
+def extract_backup_metrics(conn: sqlite3.Connection) -> dict:
+    """Выжимка БД бэкапа для хранилища: итоги, дневной ряд, персонажи, тарифы.
+
+    Читает только агрегаты, построенные при загрузке (ROLLUPS и activity_daily).
+    DAU/WAU/MAU - как в аналитике бэкапа: на последний полный день до снятия дампа.
+    """
+    dumped_at = get_dump_timestamp(conn)
+    analytics = Analytics(conn)
+    totals = {**analytics.get_overview(), **analytics.get_activity_totals()}
+
+    # Дни, в которые было хоть что-то: регистрации, сообщения, активность или платежи
+    daily = conn.execute("""
+        WITH days AS (
+            SELECT day FROM daily_signups UNION SELECT day FROM daily_messages
+            UNION SELECT day FROM activity_daily UNION SELECT day FROM daily_revenue WHERE status = 'success'
+        ),
+        revenue AS (
+            SELECT day, SUM(payments) AS payments, SUM(revenue) AS revenue
+            FROM daily_revenue WHERE status = 'success' GROUP BY day
+        )
+        SELECT d.day, COALESCE(s.users, 0), COALESCE(m.messages, 0), COALESCE(m.user_messages, 0),
+               COALESCE(m.active_users, 0), COALESCE(a.dau, 0), COALESCE(a.wau, 0), COALESCE(a.mau, 0),
+               COALESCE(r.payments, 0), COALESCE(r.revenue, 0)
+        FROM days d
+        LEFT JOIN daily_signups s ON s.day = d.day
+        LEFT JOIN daily_messages m ON m.day = d.day
+        LEFT JOIN activity_daily a ON a.day = d.day
+        LEFT JOIN revenue r ON r.day = d.day
+        WHERE d.day IS NOT NULL
+        ORDER BY d.day
+    """).fetchall()
+
+    characters = conn.execute("""
+        SELECT s.character_id, c.name, SUM(s.messages), SUM(s.user_messages),
+               COUNT(*), MAX(s.active_users)
+        FROM character_daily_stats s
+        LEFT JOIN characters c ON c.id = s.character_id
+        WHERE s.character_id IS NOT NULL
+        GROUP BY s.character_id
+    """).fetchall()
+
+    tiers = conn.execute("""
+        SELECT COALESCE(tier, 'unknown'), SUM(payments), SUM(revenue)
+        FROM daily_revenue WHERE status = 'success' GROUP BY 1
+    """).fetchall()
+
+    return {
+        'dumped_at': dumped_at,
+        'totals': totals,
+        'daily': [tuple(r) for r in daily],
+        'characters': [tuple(r) for r in characters],
+        'tiers': [tuple(r) for r in tiers],
+    }
+
+
+class Warehouse:
+    """Хранилище выжимок бэкапов: одна строка итогов на бэкап плюс дневные ряды и разрезы"""
+
+    def __init__(self, path: Path = WAREHOUSE_PATH):
+        self.path = path
+        with self._connect() as conn:
+            # WAL: читатели из разных процессов не блокируют запись
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(f"""
+                CREATE TABLE IF NOT EXISTS backup_metrics (
+                    backup_id TEXT PRIMARY KEY,
+                    name TEXT,
+                    dumped_at TEXT NOT NULL,
+                    recorded_at TEXT NOT NULL,
+                    {', '.join(f'{m} REAL' if m == 'conversion_rate' else f'{m} INTEGER' for m in SNAPSHOT_METRICS)}
+                );
+                CREATE INDEX IF NOT EXISTS idx_backup_metrics_dumped ON backup_metrics(dumped_at);
+
+                CREATE TABLE IF NOT EXISTS daily_metrics (
+                    day TEXT NOT NULL,
+                    backup_id TEXT NOT NULL,
+                    {', '.join(f'{m} INTEGER' for m in DAILY_METRICS)},
+                    PRIMARY KEY (day, backup_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_daily_metrics_backup ON daily_metrics(backup_id);
+
+                CREATE TABLE IF NOT EXISTS character_metrics (
+                    character_id INTEGER NOT NULL,
+                    backup_id TEXT NOT NULL,
+                    name TEXT,
+                    messages INTEGER,
+                    user_messages INTEGER,
+                    active_days INTEGER,
+                    peak_daily_users INTEGER,
+                    PRIMARY KEY (character_id, backup_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_character_metrics_backup ON character_metrics(backup_id);
+
+                CREATE TABLE IF NOT EXISTS tier_metrics (
+                    tier TEXT NOT NULL,
+                    backup_id TEXT NOT NULL,
+                    payments INTEGER,
+                    revenue INTEGER,
+                    PRIMARY KEY (tier, backup_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_tier_metrics_backup ON tier_metrics(backup_id);
+            """)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, backup_id: str, name: str, conn: sqlite3.Connection):
+        """Пишет (или перезаписывает) выжимку БД бэкапа"""
+        self.record_metrics(backup_id, name, extract_backup_metrics(conn))
+
+    def record_metrics(self, backup_id: str, name: str, metrics: dict):
+        now = datetime.now().isoformat(timespec='seconds')
+        # Без времени снятия в дампе точкой ряда считается момент загрузки
+        dumped_at = metrics['dumped_at'] or now.replace('T', ' ')
+        with self._connect() as conn:
+            self._delete(conn, backup_id)
+            conn.execute(
+                f"INSERT INTO backup_metrics VALUES (?, ?, ?, ?, {', '.join('?' * len(SNAPSHOT_METRICS))})",
+                (backup_id, name, dumped_at, now, *(metrics['totals'][m] for m in SNAPSHOT_METRICS))
+            )
+            conn.executemany(
+                f"INSERT INTO daily_metrics VALUES (?, ?, {', '.join('?' * len(DAILY_METRICS))})",
+                ((day, backup_id, *values) for day, *values in metrics['daily'])
+            )
+            conn.executemany(
+                "INSERT INTO character_metrics VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((character_id, backup_id, *values) for character_id, *values in metrics['characters'])
+            )
+            conn.executemany(
+                "INSERT INTO tier_metrics VALUES (?, ?, ?, ?)",
+                ((tier, backup_id, *values) for tier, *values in metrics['tiers'])
+            )
+
+    def has(self, backup_id: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute("SELECT 1 FROM backup_metrics WHERE backup_id = ?", (backup_id,)).fetchone()
+        return row is not None
+
+    def delete(self, backup_id: str):
+        with self._connect() as conn:
+            self._delete(conn, backup_id)
+
+    @staticmethod
+    def _delete(conn: sqlite3.Connection, backup_id: str):
+        for table in ('backup_metrics', 'daily_metrics', 'character_metrics', 'tier_metrics'):
+            conn.execute(f"DELETE FROM {table} WHERE backup_id = ?", (backup_id,))
+
+    def backfill(self, backups: list[dict]):
+        """Записывает бэкапы каталога, загруженные до появления хранилища"""
+        for backup in backups:
+            db_path = Path(backup['db_path'])
+            if not db_path.exists() or self.has(backup['id']):
+                continue
+            # Пул SQLite достраивает агрегаты в БД, загруженной старой версией
+            with get_pool(db_path, engine='sqlite').connection() as conn:
+                self.record(backup['id'], backup['name'], conn)
+
+    def trends(self, date_from: Optional[str] = None, date_to: Optional[str] = None,
+               backup_ids: Optional[list[str]] = None, top_characters: int = TOP_CHARACTERS) -> dict:
+        """Тренды по бэкапам в диапазоне дат снятия или сравнение заданных бэкапов.
+
+        backups - итоги каждого бэкапа и изменение к предыдущему в выборке;
+        daily - дневной ряд за [date_from, date_to] по самому свежему бэкапу
+        (из сравниваемых, если заданы backup_ids), в котором есть день; characters - персонажи с наибольшим ростом
+        сообщений между первым и последним бэкапом выборки; tiers - доход по тарифам.
+        """
+        date_from = date_from or '0000-01-01'
+        date_to = date_to or '9999-12-31'
+        with self._connect() as conn:
+            if backup_ids:
+                rows = conn.execute(f"""
+                    SELECT * FROM backup_metrics WHERE backup_id IN ({', '.join('?' * len(backup_ids))})
+                    ORDER BY dumped_at, backup_id
+                """, backup_ids).fetchall()
+            else:
+                rows = conn.execute("""
+                    SELECT * FROM backup_metrics WHERE DATE(dumped_at) BETWEEN ? AND ?
+                    ORDER BY dumped_at, backup_id
+                """, (date_from, date_to)).fetchall()
+            backups = [dict(r) for r in rows]
+            ids = [b['backup_id'] for b in backups]
+
+            # Один день есть в нескольких бэкапах: берем самый свежий (из сравниваемых, если заданы)
+            only_ids = f"AND d.backup_id IN ({', '.join('?' * len(ids))})" if backup_ids else ''
+            daily = conn.execute(f"""
+                SELECT day, {', '.join(DAILY_METRICS)} FROM (
+                    SELECT d.*, ROW_NUMBER() OVER (PARTITION BY d.day ORDER BY b.dumped_at DESC) AS rn
+                    FROM daily_metrics d JOIN backup_metrics b ON b.backup_id = d.backup_id
+                    WHERE d.day BETWEEN ? AND ? {only_ids}
+                ) WHERE rn = 1 ORDER BY day
+            """, (date_from, date_to, *(ids if backup_ids else ()))).fetchall()
+
+            characters = self._character_trends(conn, ids, top_characters) if ids else []
+
+            tiers = {}
+            if ids:
+                for r in conn.execute(f"""
+                    SELECT tier, backup_id, payments, revenue FROM tier_metrics
+                    WHERE backup_id IN ({', '.join('?' * len(ids))})
+                """, ids):
+                    tiers.setdefault(r['tier'], {})[r['backup_id']] = {
+                        'payments': r['payments'], 'revenue': r['revenue']
+                    }
+
+        previous = None
+        for backup in backups:
+            backup['change'] = {
+                m: round(backup[m] - previous[m], 2) for m in SNAPSHOT_METRICS
+            } if previous else None
+            previous = backup
+
+        return {
+            'from': date_from if not backup_ids else None,
+            'to': date_to if not backup_ids else None,
+            'backups': backups,
+            'daily': [dict(r) for r in daily],
+            'characters': characters,
+            'tiers': [
+                {'tier': tier, 'points': [
+                    {'backup_id': i, **by_backup.get(i, {'payments': 0, 'revenue': 0})} for i in ids
+                ]} for tier, by_backup in sorted(tiers.items())
+            ],
+        }
+
+    @staticmethod
+    def _character_trends(conn: sqlite3.Connection, ids: list[str], limit: int) -> list[dict]:
+        """Персонажи с наибольшим ростом сообщений от первого до последнего бэкапа ids"""
+        first, last = ids[0], ids[-1]
+        top = conn.execute("""
+            SELECT c.character_id, c.name, c.messages - COALESCE(f.messages, 0) AS growth
+            FROM character_metrics c
+            LEFT JOIN character_metrics f ON f.character_id = c.character_id AND f.backup_id = ?
+            WHERE c.backup_id = ?
+            ORDER BY growth DESC, c.character_id LIMIT ?
+        """, (first, last, limit)).fetchall()
+        if not top:
+            return []
+
+        points = {}
+        for r in conn.execute(f"""
+            SELECT character_id, backup_id, messages, user_messages, peak_daily_users FROM character_metrics
+            WHERE character_id IN ({', '.join('?' * len(top))}) AND backup_id IN ({', '.join('?' * len(ids))})
+        """, (*(r['character_id'] for r in top), *ids)):
+            points[(r['character_id'], r['backup_id'])] = {
+                'messages': r['messages'], 'user_messages': r['user_messages'],
+                'peak_daily_users': r['peak_daily_users']
+            }
+
+        empty = {'messages': 0, 'user_messages': 0, 'peak_daily_users': 0}
+        return [
+            {
+                'id': r['character_id'], 'name': r['name'], 'growth': r['growth'],
+                'points': [{'backup_id': i, **points.get((r['character_id'], i), empty)} for i in ids],
+            } for r in top
+        ]
+
+
+WAREHOUSE = Warehouse()